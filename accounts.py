@@ -0,0 +1,84 @@
+import random
+import uuid
+from flask import current_app, g, request, session
+from sqlalchemy.exc import SQLAlchemyError
+from models import db, User
+
+# --- ユーザー名 ---
+FOREIGN_FIRST_NAMES = [
+    "Alex", "Ben", "Chris", "Dana", "Eli", "Finn", "Gaby", "Hael", "Ira", "Jean",
+    "Kim", "Lee", "Max", "Nat", "Oli", "Pat", "Quin", "Ramy", "Sam", "Teo",
+    "Uli", "Val", "Wes", "Xei", "Yael", "Ziv",
+    "Ace", "Ash", "Blue", "Cole", "Dean", "Eden", "Gray", "Hope", "Ivy", "Jay",
+    "Kai", "Luna", "Mika", "Nova"
+]
+
+FOREIGN_LAST_NAMES = [
+    "Smith", "Jones", "Williams", "Brown", "Davis", "Miller", "Wilson", "Moore",
+    "Taylor", "Anderson", "Thomas", "Jackson", "White", "Harris", "Martin",
+    "Thompson", "Garcia", "Martinez", "Robinson", "Clark",
+    "Lewis", "Lee", "Walker", "Hall", "Allen", "Young", "King", "Wright",
+    "Lopez", "Hill", "Scott", "Green", "Adams", "Baker", "Gonzalez", "Nelson",
+    "Carter", "Mitchell", "Perez", "Roberts"
+]
+
+def generate_random_username():
+    return f"{random.choice(FOREIGN_FIRST_NAMES)} {random.choice(FOREIGN_LAST_NAMES)}"
+
+def generate_username(user_id: int) -> str:
+    # ユーザーIDを含めるので重複チェックのクエリが不要（旧形式「名前 数字」とも衝突しない）
+    return f"{generate_random_username()} #{user_id}"
+
+# --- ボット・プレビュー判定 ---
+BOT_USER_AGENT_PATTERNS = (
+    "bot", "crawler", "spider", "slurp", "uptimerobot", "uptime robot",
+    "facebookexternalhit", "facebookcatalog", "line-poker", "embedly", "preview",
+    "whatsapp", "skypeuripreview", "bitlybot", "vkshare", "quora link",
+    "headlesschrome", "lighthouse", "pingdom", "statuscake",
+    "curl/", "wget/", "python-requests", "python-urllib", "go-http-client",
+    "okhttp", "httpclient", "axios/", "node-fetch",
+)
+
+def is_bot_request() -> bool:
+    """クローラー・リンクプレビュー・監視などの自動アクセスかを判定"""
+    if request.method in ("HEAD", "OPTIONS"):
+        return True
+    # ブラウザの先読み（prefetch/prerender）
+    purpose = (request.headers.get("Sec-Purpose") or request.headers.get("Purpose") or "").lower()
+    if "prefetch" in purpose or "prerender" in purpose:
+        return True
+    user_agent = request.headers.get("User-Agent", "").lower()
+    if not user_agent:
+        return True
+    return any(pattern in user_agent for pattern in BOT_USER_AGENT_PATTERNS)
+
+# --- ユーザーの遅延作成 ---
+def ensure_user():
+    """書き込み操作（いいね・投稿・クーポン等）の直前に呼ぶ
+
+    セッションにユーザーが無ければ、ここで初めてusersに行を作成する。
+    閲覧だけのアクセスではDBに書き込まない。作成できない場合は None。
+    """
+    user = g.get("user")
+    if user is not None:
+        return user
+    if is_bot_request():
+        return None
+
+    try:
+        # 一時的な一意名で挿入し、採番されたIDからユーザー名を決める
+        user = User(username=f"guest-{uuid.uuid4().hex}", gender=None)
+        db.session.add(user)
+        db.session.flush()
+        user.username = generate_username(user.id)
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        current_app.logger.error(f"Failed to create user: {e}")
+        return None
+
+    session["user_id"] = user.id
+    session["username"] = user.username
+    g.user = user
+    current_app.logger.info(f"New user created: {user.id} ({user.username})")
+    return user
@@ -0,0 +1,182 @@
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func, or_
+from sqlalchemy.exc import SQLAlchemyError
+from models import db, Post, Like, dialect_insert
+
+HOUR = "hour"
+DAY = "day"
+GRANULARITIES = (HOUR, DAY)
+
+# 日別の集計はJSTの0時で区切る（時間別はUTCでもJSTでも同じ区切り）
+JST_OFFSET = timedelta(hours=9)
+
+METRICS = ("map_clicks", "coupon_issues", "likes")
+
+# --- 集計テーブル ---
+class AdStatsRollup(db.Model):
+    """投稿ごとの時間別・日別の集計（地図クリック・クーポン発行・いいね）
+
+    イベントの書き込みと同じトランザクションで加算する。bucket_start はUTC（naive）で、
+    日別は JST 0時 をUTCに直した時刻。いいねは取り消し時に元のいいねの時間帯から引くので、
+    likes テーブルの created_at で数え直した値と一致する。
+    """
+    __tablename__ = "ad_stats_rollups"
+    post_id = db.Column(db.Integer, db.ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True)
+    granularity = db.Column(db.String(8), primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    map_clicks = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    coupon_issues = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    likes = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+def bucket_start(granularity: str, created_at: datetime) -> datetime:
+    hour = created_at.replace(minute=0, second=0, microsecond=0)
+    if granularity == HOUR:
+        return hour
+    return (hour + JST_OFFSET).replace(hour=0) - JST_OFFSET
+
+# --- 差分更新 ---
+def _upsert(deltas: dict):
+    """{(post_id, granularity, bucket_start): {指標: 増減}} を加算する（1文の複数行UPSERT）"""
+    if not deltas:
+        return
+    table = AdStatsRollup.__table__
+    rows = [
+        {"post_id": post_id, "granularity": granularity, "bucket_start": start,
+         **{metric: values.get(metric, 0) for metric in METRICS}}
+        for (post_id, granularity, start), values in deltas.items()
+    ]
+    stmt = dialect_insert(table).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.post_id, table.c.granularity, table.c.bucket_start],
+        set_={metric: table.c[metric] + stmt.excluded[metric] for metric in METRICS},
+    )
+    db.session.execute(stmt)
+
+def _add(deltas: dict, post_id: int, created_at: datetime, metric: str, amount: int = 1):
+    for granularity in GRANULARITIES:
+        key = (post_id, granularity, bucket_start(granularity, created_at))
+        values = deltas.setdefault(key, {})
+        values[metric] = values.get(metric, 0) + amount
+
+def _run_safely(fn, *args):
+    # 集計の失敗で本来の書き込み（クリック・クーポン・いいね）を失敗させない
+    try:
+        with db.session.begin_nested():
+            fn(*args)
+    except SQLAlchemyError as e:
+        current_app.logger.warning(f"Ad stats rollup failed ({fn.__name__}): {e}")
+
+def _map_clicks_recorded(rows):
+    deltas = {}
+    for row in rows:
+        _add(deltas, row["post_id"], row["created_at"], "map_clicks")
+    _upsert(deltas)
+
+def _metric_changed(post_id, created_at, metric, amount):
+    deltas = {}
+    _add(deltas, post_id, created_at, metric, amount)
+    _upsert(deltas)
+
+def _likes_changed(changes):
+    deltas = {}
+    for post_id, created_at, amount in changes:
+        _add(deltas, post_id, created_at, "likes", amount)
+    _upsert(deltas)
+
+def on_map_clicks_recorded(rows):
+    """EventBuffer が書き込んだクリック（dict の list）を集計に反映（同じトランザクション内）"""
+    _run_safely(_map_clicks_recorded, rows)
+
+def on_coupon_issued(post_id, created_at):
+    _run_safely(_metric_changed, post_id, created_at, "coupon_issues", 1)
+
+def _is_ad_post(post_id) -> bool:
+    # 集計するのは広告投稿のいいねだけ（広告情報はワーカーごとにキャッシュ済み）
+    from tracking_ad import ad_info_for_id
+    info = ad_info_for_id(post_id)
+    return info is not None and info.is_ad
+
+def on_likes_changed(changes):
+    """まとめて書き込んだいいね [(post_id, いいねの created_at, +1 / -1), ...] を1文で反映（広告投稿の分のみ）"""
+    ad_post_ids = {post_id for post_id in {change[0] for change in changes} if _is_ad_post(post_id)}
+    changes = [change for change in changes if change[0] in ad_post_ids]
+    if changes:
+        _run_safely(_likes_changed, changes)
+
+# --- 全件再集計 ---
+def _hour_expression(column):
+    if db.engine.dialect.name == "postgresql":
+        return func.date_trunc("hour", column)
+    return func.strftime("%Y-%m-%d %H:00:00", column)
+
+def _as_datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+def rebuild_rollups(since: datetime = None) -> int:
+    """イベントテーブルから集計を作り直す（導入時の移行・ずれの修正用）
+
+    since を指定した場合はその時刻を含む日以降だけを作り直す。書き込んだ集計行の数を返す。
+    """
+    from tracking_ad import MapClick, CouponEvent
+
+    if since is not None:
+        since = bucket_start(DAY, since)
+    deleted = AdStatsRollup.query
+    if since is not None:
+        deleted = deleted.filter(AdStatsRollup.bucket_start >= since)
+    deleted.delete(synchronize_session=False)
+
+    deltas = {}
+    for model, metric in ((MapClick, "map_clicks"), (CouponEvent, "coupon_issues"), (Like, "likes")):
+        hour = _hour_expression(model.created_at)
+        query = db.session.query(model.post_id, hour.label("hour"), func.count().label("count")) \
+            .join(Post, Post.id == model.post_id)
+        if model is Like:
+            # いいねは広告投稿の分だけ（on_like_* と同じ条件）
+            query = query.filter(or_(Post.user_id == current_app.config.get("ADVERTISER_USER_ID", 1),
+                                     Post.google_maps_url.isnot(None)))
+        if since is not None:
+            query = query.filter(model.created_at >= since)
+        for row in query.group_by(model.post_id, hour):
+            _add(deltas, row.post_id, _as_datetime(row.hour), metric, row.count)
+
+    items = list(deltas.items())
+    for i in range(0, len(items), 1000):
+        _upsert(dict(items[i:i + 1000]))
+    db.session.commit()
+    return len(deltas)
+
+# --- 読み出し ---
+def get_ad_stats(granularity: str, start: datetime, end: datetime, post_id: int = None) -> list:
+    """広告投稿の期間内の集計を投稿ごとにまとめて返す（集計テーブルだけを読む）
+
+    [{"post_id", "store_name", "area", 指標の合計..., "series": [{"bucket_start", 指標...}]}]
+    を地図クリックの多い順で返す。
+    """
+    query = db.session.query(AdStatsRollup, Post.store_name, Post.area) \
+        .join(Post, Post.id == AdStatsRollup.post_id) \
+        .filter(AdStatsRollup.granularity == granularity,
+                AdStatsRollup.bucket_start >= start,
+                AdStatsRollup.bucket_start < end)
+    # 広告投稿: 投稿者が広告アカウント または MapsURLあり（tracking_ad.is_ad_post と同じ条件）
+    adv_id = current_app.config.get("ADVERTISER_USER_ID", 1)
+    query = query.filter(or_(Post.user_id == adv_id, Post.google_maps_url.isnot(None)))
+    if post_id:
+        query = query.filter(AdStatsRollup.post_id == post_id)
+
+    stats = {}
+    for rollup, store_name, area in query.order_by(AdStatsRollup.bucket_start):
+        item = stats.get(rollup.post_id)
+        if item is None:
+            item = stats[rollup.post_id] = {
+                "post_id": rollup.post_id, "store_name": store_name, "area": area,
+                **{metric: 0 for metric in METRICS}, "series": [],
+            }
+        point = {"bucket_start": rollup.bucket_start}
+        for metric in METRICS:
+            value = getattr(rollup, metric)
+            point[metric] = value
+            item[metric] += value
+        item["series"].append(point)
+    return sorted(stats.values(), key=lambda item: (item["map_clicks"], item["coupon_issues"], item["post_id"]), reverse=True)
@@ -1,9 +1,8 @@
 # app.py
 
 import os
-import random
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, make_response
 from dotenv import load_dotenv
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
@@ -11,19 +10,31 @@ from flask_wtf.csrf import CSRFProtect, generate_csrf
 from PIL import Image
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-import logging
-from logging.handlers import RotatingFileHandler
 from functools import wraps
 import shutil
 from flask_talisman import Talisman
 import html
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import func, desc, or_, text
+from sqlalchemy import func, desc, or_, and_, text
 from models import db, User, Post, Like
-from supabase import create_client, Client
 import base64
-from urllib.parse import urlparse
-from tracking_ad import tracking_ad_bp, MapClick, CouponEvent
+import click
+from tracking_ad import tracking_ad_bp, MapClick, CouponEvent, map_click_buffer
+import rankings
+import analytics
+from accounts import ensure_user, is_bot_request
+from likes import toggle_like, like_buffer, like_hook_buffer
+from search import search_terms, cached_search_post_ids, cached_page_rows, paginate_post_ids, rebuild_search_text, SEARCH_RESULT_LIMIT
+from images import base_name_for, variant_key, PENDING_VARIANTS
+from storage import get_storage
+import jobs
+from jobs import job_runner
+import migrations
+from profiling import request_profiler
+from logs import log_pipeline, mobile_logger, mobile_debug_enabled
+from metrics import metrics_collector, METRICS_TOKEN
+import hmac
+from cache import app_cache, post_info_cache, invalidate_post_caches, CACHE_KEY_USED_SCHOOLS, CACHE_KEY_RANKING_SCHOOLS
 
 
 load_dotenv()
@@ -39,32 +50,30 @@ if not DATABASE_URL:
 SUPABASE_URL = os.environ.get('SUPABASE_URL')
 SUPABASE_ANON_KEY = os.environ.get('SUPABASE_ANON_KEY')
 
-if not SUPABASE_URL or not SUPABASE_ANON_KEY:
-    raise ValueError("SUPABASE_URLとSUPABASE_ANON_KEYが.envファイルに設定されていません。")
-
-# Supabaseクライアント初期化
-supabase = None
+# 画像の保存先（supabase / local）。local は開発・検証用
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'supabase').lower()
 
-def get_supabase_client():
-    global supabase
-    if supabase is None:
-        supabase = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
-    return supabase
+if STORAGE_BACKEND != 'local' and (not SUPABASE_URL or not SUPABASE_ANON_KEY):
+    raise ValueError("SUPABASE_URLとSUPABASE_ANON_KEYが.envファイルに設定されていません。")
 
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'pool_timeout': 60,  # モバイル回線を考慮して60秒に延長
-    'pool_recycle': 1800,  # 30分に短縮してコネクション更新を頻繁に
-    'pool_pre_ping': True,  # 接続前にpingで確認
-    'pool_size': 10,  # 接続プールサイズを明示的に設定
-    'max_overflow': 20,  # 最大オーバーフロー接続数
-    'connect_args': {
-        'client_encoding': 'utf8',
-        'connect_timeout': 30,  # 接続タイムアウトを30秒に設定
-        'options': '-c statement_timeout=30000'  # クエリタイムアウトを30秒に設定
+if DATABASE_URL.startswith('sqlite'):
+    # ローカル検証用（SQLite）ではPostgreSQL向けのプール設定・接続引数を使わない
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {}
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_timeout': 60,  # モバイル回線を考慮して60秒に延長
+        'pool_recycle': 1800,  # 30分に短縮してコネクション更新を頻繁に
+        'pool_pre_ping': True,  # 接続前にpingで確認
+        'pool_size': 10,  # 接続プールサイズを明示的に設定
+        'max_overflow': 20,  # 最大オーバーフロー接続数
+        'connect_args': {
+            'client_encoding': 'utf8',
+            'connect_timeout': 30,  # 接続タイムアウトを30秒に設定
+            'options': '-c statement_timeout=30000'  # クエリタイムアウトを30秒に設定
+        }
     }
-}
 
 
 
@@ -77,6 +86,12 @@ if not SECRET_KEY:
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
+# フィードの1ページあたりの件数
+FEED_PAGE_SIZE = 20
+
+# 価格帯の選択肢（投稿フォーム・検索の絞り込み）
+PRICE_OPTIONS = ["〜500円", "〜1000円", "〜2000円", "5000円以上"]
+
 # 高校リスト
 SCHOOLS = [
     "北杜高等学校",
@@ -119,6 +134,20 @@ app.config.setdefault("ADVERTISER_USER_ID", 1)
 
 #データベース初期化
 db.init_app(app)
+job_runner.init_app(app)
+map_click_buffer.init_app(app)
+like_buffer.init_app(app)
+like_hook_buffer.init_app(app)
+# リクエストごとのSQL・描画時間の計測（PROFILE_SAMPLE_RATE の割合だけ）
+request_profiler.init_app(app, skip=lambda: is_fast_path_request())
+# /metrics 用のレイテンシ・プール・キャッシュの計測
+metrics_collector.init_app(
+    app,
+    pool=lambda: db.engine.pool,
+    caches={'app_cache': app_cache, 'post_info_cache': post_info_cache},
+    buffers={'map_clicks': map_click_buffer, 'likes': like_buffer, 'like_hooks': like_hook_buffer},
+    skip=lambda: request.endpoint in ('static', 'metrics_endpoint'),
+)
 # CSRFProtect設定
 csrf = CSRFProtect(app)
 
@@ -132,8 +161,8 @@ def inject_csrf_token():
 
 @app.context_processor
 def inject_coupon_functions():
-    from tracking_ad import has_used_coupon, current_user_id
-    return dict(has_used_coupon=has_used_coupon, current_user_id=current_user_id)
+    from tracking_ad import used_coupon_post_ids, current_user_id
+    return dict(used_coupon_post_ids=used_coupon_post_ids, current_user_id=current_user_id)
 
 # CSRFエラーのハンドリング
 @app.errorhandler(400)
@@ -149,133 +178,15 @@ limiter = Limiter(
 )
 limiter.init_app(app)
 
-if not app.debug:
-    file_handler = RotatingFileHandler('app.log', maxBytes=10240, backupCount=10)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-    ))
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-    app.logger.setLevel(logging.INFO)
+@limiter.request_filter
+def exempt_fast_path_requests():
+    # 静的ファイル・ヘルスチェックはレート制限の記録もしない
+    return is_fast_path_request()
 
-# --- Supabase Storage関連関数 ---
+# ログはキューに積むだけにして、書き込み・ローテーションは専用スレッドで行う（logs.py）
+log_pipeline.init_app(app)
 
-def upload_image_to_supabase(file, filename):
-    """Supabase Storageに画像をアップロード"""
-    try:
-        client = get_supabase_client()
-        print(f"Supabase client created: {client}")
-        
-        # ファイルの内容を読み取り
-        file.seek(0)
-        file_content = file.read()
-        print(f"File content length: {len(file_content)}")
-        
-        # Supabase Storageにアップロード
-        result = client.storage.from_("uploads").upload(
-            path=filename,
-            file=file_content,
-            file_options={"content-type": file.content_type}
-        )
-        
-        print(f"Upload result: {result}")
-        
-        if hasattr(result, 'status_code') and result.status_code == 200:
-            # 公開URLを取得
-            public_url = client.storage.from_("uploads").get_public_url(filename)
-            print(f"Public URL: {public_url}")
-            return public_url, None
-        else:
-            print(f"Upload failed: {result}")
-            return None, f"アップロードエラー: {result}"
-            
-    except Exception as e:
-        print(f"Supabase upload error: {e}")
-        return None, "ファイルのアップロードに失敗しました。"
-
-def delete_image_from_supabase(image_path):
-    """Supabase Storageから画像を削除（改良版）"""
-    if not image_path:
-        print("Warning: image_path is empty or None")
-        return False
-        
-    try:
-        client = get_supabase_client()
-        print(f"Attempting to delete image: {image_path}")
-        
-        # URLからファイル名を抽出（改良版）
-        filename = None
-        
-        # URLパースしてクエリパラメータを除去
-        parsed_url = urlparse(image_path)
-        clean_url = parsed_url.scheme + "://" + parsed_url.netloc + parsed_url.path
-        
-        # 1. Supabase公開URLの場合
-        if "supabase.co" in clean_url and "/object/public/uploads/" in clean_url:
-            # 例: https://xxx.supabase.co/storage/v1/object/public/uploads/filename.jpg
-            parts = clean_url.split("/object/public/uploads/")
-            if len(parts) > 1:
-                filename = parts[1]
-        # 2. /uploads/が含まれる場合（従来の方法）
-        elif "/uploads/" in clean_url:
-            filename = clean_url.split("/uploads/")[-1]
-        # 3. 単純なファイル名の場合
-        else:
-            # パス部分からファイル名を抽出
-            path_parts = parsed_url.path.split('/')
-            if path_parts:
-                filename = path_parts[-1]
-        
-        # ファイル名のクリーンアップ（追加の安全対策）
-        if filename:
-            # URLデコード（日本語ファイル名対応）
-            from urllib.parse import unquote
-            filename = unquote(filename)
-            # 不要な文字を除去
-            filename = filename.strip('?&')
-        
-        if not filename:
-            print(f"Error: Could not extract filename from path: {image_path}")
-            return False
-        
-        print(f"Extracted clean filename: {filename}")
-        
-        # Supabase Storageから削除
-        result = client.storage.from_("uploads").remove([filename])
-        print(f"Supabase delete result: {result}")
-        
-        # 削除結果の確認
-        if isinstance(result, list):
-            if len(result) == 0:
-                # 空のリストはファイルが見つからなかった可能性
-                print(f"File not found or already deleted: {filename}")
-                return True  # 既に削除済みと判断
-            else:
-                deleted_file = result[0]
-                if isinstance(deleted_file, dict):
-                    if 'name' in deleted_file and deleted_file['name'] == filename:
-                        print(f"Successfully deleted file: {filename}")
-                        return True
-                    elif deleted_file.get('error'):
-                        print(f"Supabase delete error: {deleted_file['error']}")
-                        return False
-                print(f"File deletion completed: {deleted_file}")
-                return True
-        elif isinstance(result, dict):
-            if result.get('error'):
-                print(f"Supabase delete error: {result['error']}")
-                return False
-            else:
-                print(f"Successfully deleted file: {filename}")
-                return True
-        else:
-            print(f"Unknown result format: {result}")
-            return True
-            
-    except Exception as e:
-        print(f"Exception during Supabase delete: {str(e)}")
-        print(f"Exception type: {type(e).__name__}")
-        return False
+# --- 画像アップロード関連 ---
 
 def process_uploaded_image(file):
     """アップロード画像の処理（Supabase Storage版）"""
@@ -300,10 +211,17 @@ def process_uploaded_image(file):
         if img.format.lower() not in ['jpeg', 'jpg', 'png']:
             return None, "JPEG、PNG形式の画像のみ対応しています。"
         
+        # 最後までデコードできるかチェック（途中で切れた画像はジョブで変換できず、投稿が準備中のまま残るため）
+        img.verify()
+        file.seek(0)
+        with Image.open(file) as decoded:
+            decoded.load()
+        file.seek(0)
+        
         return file, None
         
     except Exception as e:
-        print(f"Image processing error: {e}")
+        app.logger.warning(f"Image processing error: {e}")
         return None, "画像ファイルの処理中にエラーが発生しました。"
 
 # --- データベース関連 ---
@@ -348,41 +266,96 @@ def reset_db_command():
     db.create_all()
     print('Database reset complete.')
 
-# --- ユーザー関連 ---
-FOREIGN_FIRST_NAMES = [
-    "Alex", "Ben", "Chris", "Dana", "Eli", "Finn", "Gaby", "Hael", "Ira", "Jean",
-    "Kim", "Lee", "Max", "Nat", "Oli", "Pat", "Quin", "Ramy", "Sam", "Teo",
-    "Uli", "Val", "Wes", "Xei", "Yael", "Ziv",
-    "Ace", "Ash", "Blue", "Cole", "Dean", "Eden", "Gray", "Hope", "Ivy", "Jay",
-    "Kai", "Luna", "Mika", "Nova"
-]
+@app.cli.command('reconcile-like-counts')
+def reconcile_like_counts_command():
+    """Recompute posts.like_count from the likes table."""
+    actual_count = db.session.query(func.count(Like.id)) \
+                             .filter(Like.post_id == Post.id) \
+                             .correlate(Post) \
+                             .scalar_subquery()
+    result = db.session.execute(
+        Post.__table__.update()
+        .where(Post.like_count != actual_count)
+        .values(like_count=actual_count)
+    )
+    db.session.commit()
+    print(f'Reconciled like counts for {result.rowcount} posts.')
+
+@app.cli.command('rebuild-rankings')
+def rebuild_rankings_command():
+    """Rebuild all precomputed rankings (run periodically, e.g. from a scheduler)."""
+    scope_count = rankings.rebuild_all()
+    db.session.commit()
+    print(f'Rebuilt {scope_count} ranking snapshots.')
+
+@app.cli.command('rebuild-ad-stats')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Only rebuild days from this date (JST) on.')
+def rebuild_ad_stats_command(since):
+    """Recompute the hourly/daily ad stats rollups from map_clicks, coupon_events and likes."""
+    print(f'Rebuilt {analytics.rebuild_rollups(since)} ad stats rollup rows.')
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Recompute posts.search_text (after applying the migration or changing normalization)."""
+    print(f'Updated search_text for {rebuild_search_text()} posts.')
+
+@app.cli.command('run-storage-jobs')
+def run_storage_jobs_command():
+    """Process pending storage jobs (image uploads/deletions) in the foreground."""
+    succeeded, failed = jobs.run_pending()
+    print(f'Storage jobs: {succeeded} succeeded, {failed} failed. Remaining: {jobs.job_counts()}')
+
+@app.cli.command('retry-storage-jobs')
+def retry_storage_jobs_command():
+    """Put permanently failed storage jobs back into the queue."""
+    print(f'Requeued {jobs.retry_failed()} failed storage jobs.')
+
+@app.cli.command('db-status')
+def db_status_command():
+    """Show which sql/ migrations have been applied."""
+    applied = migrations.applied_versions()
+    for version in migrations.available_versions():
+        print(f"{'applied' if version in applied else 'pending'}  {version}")
+
+@app.cli.command('db-migrate')
+@click.option('--target', default=None, help='Stop after this version (e.g. 20261018_add_listing_indexes).')
+def db_migrate_command(target):
+    """Apply pending sql/ migrations in order and record them in schema_migrations."""
+    applied = migrations.migrate(target)
+    for version in applied:
+        print(f'Applied {version}')
+    print(f'{len(applied)} migration(s) applied.')
+
+@app.cli.command('db-mark-applied')
+@click.argument('version')
+def db_mark_applied_command(version):
+    """Record migrations up to VERSION as applied without running them (for files already run by hand)."""
+    marked = [v for v in migrations.pending_versions() if v <= version]
+    for v in marked:
+        migrations.mark_applied(v)
+    db.session.commit()
+    print(f'Marked {len(marked)} migration(s) as applied.')
 
-FOREIGN_LAST_NAMES = [
-    "Smith", "Jones", "Williams", "Brown", "Davis", "Miller", "Wilson", "Moore", 
-    "Taylor", "Anderson", "Thomas", "Jackson", "White", "Harris", "Martin", 
-    "Thompson", "Garcia", "Martinez", "Robinson", "Clark",
-    "Lewis", "Lee", "Walker", "Hall", "Allen", "Young", "King", "Wright", 
-    "Lopez", "Hill", "Scott", "Green", "Adams", "Baker", "Gonzalez", "Nelson", 
-    "Carter", "Mitchell", "Perez", "Roberts"
-]
+# --- ユーザー関連 ---
 
-def generate_random_username():
-    return f"{random.choice(FOREIGN_FIRST_NAMES)} {random.choice(FOREIGN_LAST_NAMES)}"
+def _query_used_schools():
+    used_schools = db.session.query(
+        Post.school, 
+        func.count(Post.id).label('usage_count')
+    ).filter(
+        Post.school.isnot(None),
+        Post.school != ''
+    ).group_by(Post.school).order_by(desc('usage_count')).all()
+    
+    return [school[0] for school in used_schools]
 
 def get_used_schools():
-    """使用されたことのある高校を取得し、頻度順でソート"""
+    """使用されたことのある高校を取得し、頻度順でソート（キャッシュあり）"""
     try:
-        used_schools = db.session.query(
-            Post.school, 
-            func.count(Post.id).label('usage_count')
-        ).filter(
-            Post.school.isnot(None),
-            Post.school != ''
-        ).group_by(Post.school).order_by(desc('usage_count')).all()
-        
-        return [school[0] for school in used_schools]
+        return app_cache.get_or_set(CACHE_KEY_USED_SCHOOLS, _query_used_schools)
     except SQLAlchemyError as e:
-        print(f"Error getting used schools: {e}")
+        app.logger.error(f"Error getting used schools: {e}")
         return []
 
 def get_sorted_schools():
@@ -405,103 +378,77 @@ def is_uptimerobot_request():
     
     return False
 
+# before_request の処理（ユーザー読み込み・セッション更新・モバイルログ）を省略するエンドポイント
+FAST_PATH_ENDPOINTS = {'static', 'robots', 'health_check', 'uptimerobot_check', 'metrics_endpoint'}
+
+def is_fast_path_request():
+    """静的ファイル・ヘルスチェックなど、セッションやDBが不要なリクエストか"""
+    return request.endpoint in FAST_PATH_ENDPOINTS
+
 def is_mobile_device():
     """モバイルデバイスかどうかを判定"""
     user_agent = request.headers.get('User-Agent', '').lower()
     mobile_agents = ['mobile', 'android', 'iphone', 'ipad', 'ipod', 'blackberry', 'windows phone']
     return any(agent in user_agent for agent in mobile_agents)
 
+# ログに値を残さないヘッダー
+REDACTED_HEADERS = {'cookie', 'authorization', 'x-csrftoken'}
+
+def loggable_headers():
+    return {name: ('***' if name.lower() in REDACTED_HEADERS else value) for name, value in request.headers.items()}
+
 def log_request_details():
-    """リクエストの詳細をログに記録（モバイル問題調査用）"""
-    if is_mobile_device():
-        app.logger.info(f"Mobile Request: {request.method} {request.path}")
-        app.logger.info(f"User-Agent: {request.headers.get('User-Agent', 'Unknown')}")
-        app.logger.info(f"Remote Addr: {request.remote_addr}")
-        app.logger.info(f"Headers: {dict(request.headers)}")
-        if request.args:
-            app.logger.info(f"Args: {dict(request.args)}")
-        if request.form:
-            app.logger.info(f"Form: {dict(request.form)}")
+    """リクエストの詳細をログに記録（モバイル問題調査用）
+
+    MOBILE_DEBUG_LOG_LEVEL=DEBUG のときだけ、MOBILE_DEBUG_SAMPLE_RATE の割合のリクエストを1行で記録する。
+    フォームの値は残さずキーだけ記録する。
+    """
+    if is_mobile_device() and mobile_debug_enabled():
+        mobile_logger.debug('mobile request', extra={
+            'method': request.method,
+            'path': request.path,
+            'remote_addr': request.remote_addr,
+            'headers': loggable_headers(),
+            'query_args': dict(request.args),
+            'form_keys': list(request.form.keys()),
+        })
         return True
     return False
 
 @app.before_request
 def load_logged_in_user():
-    from flask import g
-    import time
-    
-    # UptimeRobotからのアクセスの場合、ユーザーを作成しない
-    if is_uptimerobot_request():
-        g.user = None
+    """セッションのユーザーを g.user に読み込む
+
+    ユーザー行はここでは作成しない（いいね・投稿などの書き込み時に ensure_user で作成）。
+    """
+    g.user = None
+
+    # 静的ファイル・ヘルスチェック、UptimeRobotやクローラーからのアクセスはセッションを参照しない
+    if is_fast_path_request() or is_uptimerobot_request() or is_bot_request():
         return
     
-    # モバイルアクセス時の詳細ログ
-    if is_mobile_device():
-        app.logger.info(f"Mobile before_request: {request.method} {request.path}")
-        app.logger.info(f"Session data: {dict(session)}")
+    # モバイルアクセス時の詳細ログ（サンプリングしたリクエストのみ。セッションは値を残さずキーだけ）
+    if is_mobile_device() and mobile_debug_enabled():
+        mobile_logger.debug('mobile before_request', extra={
+            'method': request.method,
+            'path': request.path,
+            'session_keys': list(session.keys()),
+        })
     
     user_id = session.get('user_id')
+    if user_id is None:
+        return
 
-    if user_id is not None:
-        try:
-            user = User.query.get(user_id)
-            if user:
-                g.user = user
-                session['username'] = user.username
-                return
-            else:
-                session.clear()
-                user_id = None
-        except SQLAlchemyError as e:
-            app.logger.error(f"Error loading user {user_id}: {e}")
+    try:
+        user = User.query.get(user_id)
+        if user:
+            g.user = user
+            session['username'] = user.username
+        else:
             session.clear()
-            user_id = None
-
-    if user_id is None:
-        # モバイルデバイスの場合、より慎重にユーザー作成
-        max_retries = 3 if is_mobile_device() else 1
-        
-        for attempt in range(max_retries):
-            try:
-                # 一意なユーザー名を生成（より確実な方法）
-                base_username = generate_random_username()
-                timestamp = int(time.time() * 1000) % 10000
-                username = f"{base_username} {timestamp}"
-                
-                # より厳密な重複チェック
-                retry_count = 0
-                while User.query.filter_by(username=username).first() and retry_count < 5:
-                    timestamp = int(time.time() * 1000) % 10000
-                    username = f"{base_username} {timestamp}"
-                    retry_count += 1
-                
-                new_user = User(
-                    username=username,
-                    gender=None
-                )
-                db.session.add(new_user)
-                db.session.commit()
-                
-                session['user_id'] = new_user.id
-                session['username'] = username
-                g.user = new_user
-                
-                app.logger.info(f"New user created: {new_user.id} ({username}) - Attempt {attempt + 1}")
-                return
-                
-            except SQLAlchemyError as e:
-                db.session.rollback()
-                app.logger.warning(f"User creation attempt {attempt + 1} failed: {e}")
-                
-                if attempt == max_retries - 1:
-                    # 最後の試行でも失敗した場合
-                    app.logger.error(f"Failed to create user after {max_retries} attempts: {e}")
-                    g.user = None
-                    if not is_mobile_device():  # モバイルではフラッシュメッセージを控えめに
-                        flash('ユーザー情報の作成に失敗しました。ページを更新してお試しください。', 'error')
-                else:
-                    # 短時間待機してリトライ
-                    time.sleep(0.1 * (attempt + 1))
+    except SQLAlchemyError as e:
+        app.logger.error(f"Error loading user {user_id}: {e}")
+        session.clear()
 
 
 def allowed_file(filename):
@@ -528,6 +475,92 @@ def validate_required_fields(**kwargs):
         return f"以下の項目は必須です: {', '.join(missing_fields)}"
     return None
 
+# --- フィード（キーセットページネーション） ---
+
+def encode_feed_cursor(created_at, post_id):
+    """(created_at, id) をURLに載せられるカーソル文字列に変換"""
+    raw = f"{created_at.isoformat()}|{post_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_feed_cursor(cursor):
+    """カーソル文字列を (created_at, id) に戻す。不正な値の場合は None"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+        created_at_str, post_id_str = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at_str), int(post_id_str)
+    except (ValueError, UnicodeError):
+        return None
+
+def get_feed_page(cursor=None, limit=FEED_PAGE_SIZE):
+    """新着順フィードを1ページ分取得し、(posts, next_cursor) を返す"""
+    query = db.session.query(
+        Post.id,
+        Post.user_id,
+        User.username,
+        Post.image_path,
+        Post.image_variants,
+        Post.caption,
+        Post.price_range,
+        Post.area,
+        Post.store_name,
+        Post.school,
+        Post.created_at,
+        Post.like_count
+    ).join(User, Post.user_id == User.id)
+
+    position = decode_feed_cursor(cursor)
+    if position:
+        created_at, post_id = position
+        query = query.filter(or_(
+            Post.created_at < created_at,
+            and_(Post.created_at == created_at, Post.id < post_id)
+        ))
+
+    # 1件多く取得して次ページの有無を判定
+    rows = query.order_by(desc(Post.created_at), desc(Post.id)) \
+                .limit(limit + 1) \
+                .all()
+
+    posts = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit and posts:
+        last = posts[-1]
+        next_cursor = encode_feed_cursor(last.created_at, last.id)
+    return posts, next_cursor
+
+def get_liked_post_ids(user_id, post_ids):
+    """表示中の投稿のうち、ユーザーがいいね済みの投稿IDの集合を返す
+
+    いいね履歴全体ではなく post_ids に含まれる投稿だけを問い合わせ、
+    結果はリクエスト内で g にキャッシュする。
+    """
+    post_ids = set(post_ids)
+    if not user_id or not post_ids:
+        return set()
+
+    checked_ids = g.setdefault('liked_checked_post_ids', set())
+    liked_ids = g.setdefault('liked_post_ids', set())
+
+    unchecked_ids = post_ids - checked_ids
+    if unchecked_ids:
+        rows = db.session.query(Like.post_id).filter(
+            Like.user_id == user_id,
+            Like.post_id.in_(unchecked_ids)
+        ).all()
+        liked_ids.update(row.post_id for row in rows)
+        checked_ids.update(unchecked_ids)
+
+    result = liked_ids & post_ids
+    if like_buffer.enabled:
+        # まだDBに書き込まれていないいいね・取り消しを反映
+        for post_id, liked in like_buffer.pending_for_user(user_id).items():
+            if post_id in post_ids:
+                (result.add if liked else result.discard)(post_id)
+    return result
+
 # --- ルーティング ---
 @app.route('/')
 def index():
@@ -535,54 +568,43 @@ def index():
     log_request_details()
     
     current_user_id = session.get('user_id')
+    cursor = request.args.get('cursor')
 
     try:
-        posts_query = db.session.query(
-            Post.id,
-            Post.user_id,
-            User.username,
-            Post.image_path,
-            Post.caption,
-            Post.price_range,
-            Post.area,
-            Post.store_name,
-            Post.school,
-            Post.created_at,
-            func.count(Like.id).label('like_count')
-        ).join(User, Post.user_id == User.id) \
-         .outerjoin(Like, Post.id == Like.post_id) \
-         .group_by(Post.id, User.username) \
-         .order_by(desc(Post.created_at)) \
-         .all()
-
-        liked_posts_ids = set()
-        if current_user_id:
-            likes_by_current_user = Like.query.filter_by(user_id=current_user_id).all()
-            liked_posts_ids = {like.post_id for like in likes_by_current_user}
+        posts, next_cursor = get_feed_page(cursor)
+        liked_posts_ids = get_liked_post_ids(current_user_id, [post.id for post in posts])
 
-        return render_template('index.html', posts=posts_query, liked_posts=liked_posts_ids)
+        return render_template('index.html', posts=posts, liked_posts=liked_posts_ids, next_cursor=next_cursor)
     except SQLAlchemyError as e:
         app.logger.error(f"Database error in index: {e} - User Agent: {request.headers.get('User-Agent', 'Unknown')}")
         error_message = 'データの取得中にエラーが発生しました。'
         if is_mobile_device():
             error_message = 'データの読み込みに失敗しました。ネットワーク接続を確認して再読み込みしてください。'
         flash(error_message, 'error')
-        return render_template('index.html', posts=[], liked_posts=set())
-
+        return render_template('index.html', posts=[], liked_posts=set(), next_cursor=None)
 
+@app.route('/feed')
+def feed():
+    """無限スクロール用：次ページの投稿カードHTMLとカーソルをJSONで返す"""
+    cursor = request.args.get('cursor')
+    if not decode_feed_cursor(cursor):
+        return jsonify({'status': 'error', 'message': 'カーソルが不正です。'}), 400
 
+    try:
+        posts, next_cursor = get_feed_page(cursor)
+        liked_posts_ids = get_liked_post_ids(session.get('user_id'), [post.id for post in posts])
+        html_fragment = render_template('_feed_items.html', posts=posts, liked_posts=liked_posts_ids)
+        return jsonify({'status': 'ok', 'html': html_fragment, 'next_cursor': next_cursor})
+    except SQLAlchemyError as e:
+        app.logger.error(f"Database error in feed: {e} - User Agent: {request.headers.get('User-Agent', 'Unknown')}")
+        return jsonify({'status': 'error', 'message': 'データの取得中にエラーが発生しました。'}), 500
 
 
 @app.route('/post', methods=['GET', 'POST'])
 @limiter.limit("5 per minute")
 def post():
-    if not g.user:
-        flash('ユーザー情報が取得できません。ページを更新してお試しください。', 'error')
-        return redirect(url_for('index'))
-    
-    user_id = g.user.id
-    username = g.user.username
-    price_options = ["〜500円", "〜1000円", "〜2000円", "5000円以上"]
+    username = g.user.username if g.user else 'ゲスト'
+    price_options = PRICE_OPTIONS
     school_options = get_sorted_schools()
 
     if request.method == 'POST':
@@ -628,23 +650,37 @@ def post():
                                  store_name=store_name, area=area, caption=caption, price_range_selected=price_range,
                                  school_selected=school)
 
-        # Supabase Storageにファイルアップロード
-        safe_filename = secure_filename(image.filename)
-        filename = f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}_{safe_filename}"
-        
-        # 画像をSupabaseにアップロード
-        public_url, upload_error = upload_image_to_supabase(image, filename)
-        
-        if upload_error:
-            flash(upload_error, 'error')
+        # 画像の検証（サイズ・形式）
+        image, image_error = process_uploaded_image(image)
+        if image_error:
+            flash(image_error, 'error')
+            return render_template('post.html', price_options=price_options, school_options=school_options, username=username,
+                                 store_name=store_name, area=area, caption=caption, price_range_selected=price_range,
+                                 school_selected=school)
+
+        # 初めての書き込みであればここでユーザーを作成（入力・画像の検証が通ってから）
+        user = ensure_user()
+        if not user:
+            flash('ユーザー情報が取得できません。ページを更新してお試しください。', 'error')
             return render_template('post.html', price_options=price_options, school_options=school_options, username=username,
                                  store_name=store_name, area=area, caption=caption, price_range_selected=price_range,
                                  school_selected=school)
+        user_id = user.id
+
+        # 画像の変換・アップロードはバックグラウンドのジョブで行う（jobs.py）
+        safe_filename = secure_filename(image.filename)
+        filename = f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}_{safe_filename}"
+        base_name = base_name_for(filename)
+        # 詳細表示用のJPEGをメイン画像とする（URLはアップロード前に確定できる）
+        public_url = get_storage().public_url(variant_key(base_name, 'medium', 'jpeg'))
+        image.seek(0)
+        image_data = image.read()
         
         try:
             new_post = Post(
                 user_id=user_id,
                 image_path=public_url,  # Supabaseの公開URLを保存
+                image_variants=PENDING_VARIANTS,
                 caption=caption,
                 price_range=price_range,
                 area=area,
@@ -653,85 +689,116 @@ def post():
             )
             
             db.session.add(new_post)
+            db.session.flush()
+            rankings.on_post_created(new_post)
+            # 投稿と同じトランザクションでジョブを登録
+            jobs.enqueue_post_image(new_post.id, base_name, image_data)
             db.session.commit()
+            invalidate_post_caches()
+            job_runner.notify()
             
             flash('投稿が完了しました！', 'success')
             return redirect(url_for('index'))
             
         except SQLAlchemyError as e:
             db.session.rollback()
-            # アップロード済みの画像を削除（修正版）
-            if public_url:
-                delete_success = delete_image_from_supabase(public_url)
-                if delete_success:
-                    print(f"Successfully cleaned up uploaded image after database error: {public_url}")
-                else:
-                    print(f"Failed to clean up uploaded image after database error: {public_url}")
-            print(f"Database error in post: {e}")
+            app.logger.error(f"Database error in post: {e}")
             flash('データベースエラーが発生しました。もう一度お試しください。', 'error')
         except Exception as e:
             db.session.rollback()
-            # アップロード済みの画像を削除（修正版）
-            if public_url:
-                delete_success = delete_image_from_supabase(public_url)
-                if delete_success:
-                    print(f"Successfully cleaned up uploaded image after unexpected error: {public_url}")
-                else:
-                    print(f"Failed to clean up uploaded image after unexpected error: {public_url}")
-            print(f"Unexpected error in post: {e}")
+            app.logger.exception(f"Unexpected error in post: {e}")
             flash('投稿の保存中にエラーが発生しました。もう一度お試しください。', 'error')
 
     return render_template('post.html', price_options=price_options, school_options=school_options, username=username,
                            store_name="", area="", caption="", price_range_selected="", school_selected="")
 
+# --- 検索 ---
+
+SEARCH_FIELDS = ('q', 'area', 'store_name', 'price_range', 'school')
+
+# 検索結果ページのブラウザキャッシュ（いいね状態などを含むので private）
+SEARCH_HTTP_MAX_AGE = 30
+
+def get_search_criteria(source):
+    """クエリ文字列（旧フォームの場合はPOSTの値）から検索条件を取り出す"""
+    return {field: source.get(field, '').strip() for field in SEARCH_FIELDS}
+
+def search_query_args(criteria):
+    """URL用に空でない検索条件だけを返す（同じ検索が同じURLになるように）"""
+    return {field: value for field, value in criteria.items() if value}
+
+def get_search_page(criteria, cursor=None):
+    """検索結果を1ページ分取得し、(posts, next_cursor, total) を返す。カーソルが不正なら None
+
+    total は SEARCH_RESULT_LIMIT 件で打ち切った数（total_is_capped で判定する）。
+
+    条件に合う投稿IDの並びは条件ごとに、各ページの表示用の行はページの投稿IDごとにキャッシュする
+    （search.cached_search_post_ids / cached_page_rows）。キャッシュが無いときだけそのページの投稿を主キーで取得する。
+    """
+    # 文字の検索語は正規化して search_text（店名・地域・紹介文）から探す（search.py）
+    terms = search_terms(criteria['q'], criteria['area'], criteria['store_name'])
+    post_ids = cached_search_post_ids(terms, price_range=criteria['price_range'], school=criteria['school'])
+
+    page = paginate_post_ids(post_ids, cursor)
+    if page is None:
+        return None
+    page_ids, next_cursor = page
+
+    posts = cached_page_rows(page_ids, load_search_rows) if page_ids else []
+    return posts, next_cursor, len(post_ids)
+
+def load_search_rows(page_ids):
+    """検索結果の1ページ分の投稿を関連度順（page_ids の順）で取得"""
+    rows = db.session.query(
+        Post.id,
+        Post.user_id,
+        User.username,
+        Post.image_path,
+        Post.image_variants,
+        Post.caption,
+        Post.price_range,
+        Post.area,
+        Post.store_name,
+        Post.school,
+        Post.created_at,
+        Post.like_count
+    ).join(User, Post.user_id == User.id) \
+     .filter(Post.id.in_(page_ids)) \
+     .all()
+    # 関連度順に並べ直す
+    rows_by_id = {row.id: row for row in rows}
+    return [rows_by_id[post_id] for post_id in page_ids if post_id in rows_by_id]
+
+def total_is_capped(total):
+    """検索結果が SEARCH_RESULT_LIMIT 件で打ち切られているか（件数は「200+」のように表示する）"""
+    return total >= SEARCH_RESULT_LIMIT
+
+def set_search_cache_headers(response):
+    response.headers['Cache-Control'] = f'private, max-age={SEARCH_HTTP_MAX_AGE}'
+    response.vary.add('Cookie')
+    return response
+
 @app.route('/search', methods=['GET', 'POST'])
 def search():
+    if request.method == 'POST':
+        # 旧フォーム（POST）からの検索は同じ条件のGETに転送する
+        criteria = get_search_criteria(request.form)
+        return redirect(url_for('search', **search_query_args(criteria)), code=303)
+
     user_id = session.get('user_id')
     results = []
-    search_criteria = {}
-    price_options = ["", "〜500円", "〜1000円", "〜2000円", "5000円以上"]
+    next_cursor = None
+    total = 0
+    price_options = [""] + PRICE_OPTIONS
     school_options = [""] + get_sorted_schools()
-    
-    if request.method == 'POST':
-        area_query = request.form.get('area', '').strip()
-        store_name_query = request.form.get('store_name', '').strip()
-        price_range_query = request.form.get('price_range', '')
-        school_query = request.form.get('school', '')
-
-        search_criteria = {
-            'area': area_query,
-            'store_name': store_name_query,
-            'price_range': price_range_query,
-            'school': school_query
-        }
+    search_criteria = get_search_criteria(request.args)
+    searched = any(search_criteria.values())
 
+    if searched:
         try:
-            query = db.session.query(
-                Post.id,
-                Post.user_id,
-                User.username,
-                Post.image_path,
-                Post.caption,
-                Post.price_range,
-                Post.area,
-                Post.store_name,
-                Post.school,
-                Post.created_at,
-                func.count(Like.id).label('like_count')
-            ).join(User, Post.user_id == User.id) \
-             .outerjoin(Like, Post.id == Like.post_id)
-
-            if area_query:
-                query = query.filter(Post.area.like(f"%{area_query}%"))
-            if store_name_query:
-                query = query.filter(Post.store_name.like(f"%{store_name_query}%"))
-            if price_range_query:
-                query = query.filter(Post.price_range == price_range_query)
-            if school_query:
-                query = query.filter(Post.school == school_query)
-
-            results = query.group_by(Post.id, User.username).order_by(desc(Post.created_at)).all()
-            
+            # 不正・期限切れのカーソルは1ページ目から表示
+            page = get_search_page(search_criteria, request.args.get('cursor')) or get_search_page(search_criteria)
+            results, next_cursor, total = page
         except SQLAlchemyError as e:
             app.logger.error(f"Database error in search: {e} - User Agent: {request.headers.get('User-Agent', 'Unknown')}")
             error_message = '検索中にエラーが発生しました。'
@@ -739,25 +806,62 @@ def search():
                 error_message = '検索に失敗しました。ネットワーク接続を確認して再試行してください。'
             flash(error_message, 'error')
 
-    liked_posts_ids = set()
-    if user_id and results:
-        likes_by_current_user = Like.query.filter_by(user_id=user_id).all()
-        liked_posts_ids = {like.post_id for like in likes_by_current_user}
+    liked_posts_ids = get_liked_post_ids(user_id, [post.id for post in results])
 
-    return render_template('search.html', results=results, price_options=price_options, 
-                         school_options=school_options, search_criteria=search_criteria, 
-                         user_id=user_id, liked_posts=liked_posts_ids)
+    response = make_response(render_template('search.html', results=results, price_options=price_options,
+                                             school_options=school_options, search_criteria=search_criteria,
+                                             search_args=search_query_args(search_criteria), searched=searched,
+                                             total=total, total_capped=total_is_capped(total), next_cursor=next_cursor,
+                                             user_id=user_id, liked_posts=liked_posts_ids))
+    return set_search_cache_headers(response)
+
+@app.route('/api/search')
+def search_api():
+    """検索API：条件はクエリ文字列、結果はJSON（無限スクロール用の投稿カードHTMLを含む）"""
+    criteria = get_search_criteria(request.args)
+
+    try:
+        page = get_search_page(criteria, request.args.get('cursor'))
+        if page is None:
+            return jsonify({'status': 'error', 'message': 'カーソルが不正です。'}), 400
+        posts, next_cursor, total = page
+        liked_posts_ids = get_liked_post_ids(session.get('user_id'), [post.id for post in posts])
+        html_fragment = render_template('_feed_items.html', posts=posts, liked_posts=liked_posts_ids)
+    except SQLAlchemyError as e:
+        app.logger.error(f"Database error in search_api: {e} - User Agent: {request.headers.get('User-Agent', 'Unknown')}")
+        return jsonify({'status': 'error', 'message': '検索中にエラーが発生しました。'}), 500
+
+    response = jsonify({
+        'status': 'ok',
+        'total': total,
+        'total_capped': total_is_capped(total),
+        'posts': [{
+            'id': post.id,
+            'store_name': post.store_name,
+            'area': post.area,
+            'price_range': post.price_range,
+            'school': post.school,
+            'username': post.username,
+            'like_count': post.like_count,
+            'is_liked': post.id in liked_posts_ids,
+            'image_path': post.image_path,
+            'created_at': post.created_at.isoformat() if post.created_at else None,
+        } for post in posts],
+        'html': html_fragment,
+        'next_cursor': next_cursor
+    })
+    return set_search_cache_headers(response)
 
 
 @app.route('/account')
 def account():
     user_id = session.get('user_id')
     username = session.get('username')
-    if not user_id:
-        flash('ユーザー情報の取得に失敗しました。', 'error')
-        return redirect(url_for('index'))
-        
     is_admin = session.get('is_admin', False)
+
+    # まだ書き込みをしていない閲覧ユーザー（DBに行がない）
+    if not user_id:
+        return render_template('account.html', posts=[], username=username, is_admin=is_admin)
     
     try:
         posts_query = db.session.query(
@@ -765,17 +869,16 @@ def account():
             Post.user_id,
             User.username.label('username'),
             Post.image_path,
+            Post.image_variants,
             Post.caption,
             Post.price_range,
             Post.area,
             Post.store_name,
             Post.school,
             Post.created_at,
-            func.count(Like.id).label('like_count')
+            Post.like_count
         ).join(User, Post.user_id == User.id) \
-         .outerjoin(Like, Post.id == Like.post_id) \
          .filter(Post.user_id == user_id) \
-         .group_by(Post.id, User.username) \
          .order_by(desc(Post.created_at)) \
          .all()
         
@@ -830,7 +933,7 @@ def admin_login():
                     flash('広告アカウントが見つかりません。', 'error')
             else:
                 # 管理者パスワードでログイン：現在のアカウントに管理者権限のみ付与
-                user = User.query.get(current_user_id)
+                user = ensure_user()
                 if user:
                     user.is_admin = True
                     user.is_advertiser = False
@@ -841,7 +944,7 @@ def admin_login():
             
         except SQLAlchemyError as e:
             db.session.rollback()
-            print(f"Error in admin login: {e}")
+            app.logger.error(f"Error in admin login: {e}")
             flash('ログイン処理中にエラーが発生しました。', 'error')
     else:
         flash('パスワードが間違っています。', 'error')
@@ -886,7 +989,7 @@ def update_admin_username():
             
     except SQLAlchemyError as e:
         db.session.rollback()
-        print(f"Error updating username: {e}")
+        app.logger.error(f"Error updating username: {e}")
         flash('ユーザー名の更新に失敗しました。', 'error')
     
     return redirect(url_for('account'))
@@ -924,7 +1027,12 @@ def privileged_logout():
                 else:
                     flash('前のアカウント情報が見つかりません。', 'error')
             else:
-                flash('前のアカウント情報がありません。', 'error')
+                # 閲覧のみのユーザー（DBに行がない）から広告アカウントに入った場合はゲストに戻す
+                for key in ('user_id', 'username', 'is_admin', 'is_advertiser',
+                            'previous_user_id', 'previous_username', 'previous_is_admin', 'previous_is_advertiser'):
+                    session.pop(key, None)
+                g.user = None
+                flash('広告アカウントからログアウトしました。', 'success')
         else:
             # 通常の管理者権限からのログアウト
             user = User.query.get(current_user_id)
@@ -940,7 +1048,7 @@ def privileged_logout():
         
     except SQLAlchemyError as e:
         db.session.rollback()
-        print(f"Error in privileged_logout: {e}")
+        app.logger.error(f"Error in privileged_logout: {e}")
         flash('ログアウト処理中にエラーが発生しました。', 'error')
     
     return redirect(url_for('account'))
@@ -967,29 +1075,26 @@ def admin_delete_post(post_id):
         if post:
             # 画像パスを保存（削除前に）
             image_path = post.image_path
+            image_variants = post.image_variants
             
             # 関連するいいねを削除
             Like.query.filter_by(post_id=post_id).delete()
             # 投稿を削除
             db.session.delete(post)
+            db.session.flush()
+            rankings.on_post_deleted(post_id, post.school)
+            # 画像ファイルの削除は投稿の削除と同時に登録し、バックグラウンドで行う
+            jobs.enqueue_image_deletion(image_path, image_variants)
             db.session.commit()
-            
-            # 画像ファイルも削除（修正版）
-            if image_path:
-                delete_success = delete_image_from_supabase(image_path)
-                if delete_success:
-                    print(f"Successfully deleted image file: {image_path}")
-                else:
-                    print(f"Failed to delete image file: {image_path}")
-                    # 画像削除失敗はログに記録するが、ユーザーエラーにはしない
-                    # （投稿データの削除は成功しているため）
+            invalidate_post_caches(post_id)
+            job_runner.notify()
             
             flash('投稿を削除しました。', 'success')
         else:
             flash('投稿が存在しません。', 'error')
     except SQLAlchemyError as e:
         db.session.rollback()
-        print(f"Error deleting post: {e}")
+        app.logger.error(f"Error deleting post: {e}")
         flash('投稿の削除中にエラーが発生しました。', 'error')
     
     return redirect(request.referrer or url_for('index'))
@@ -1009,29 +1114,26 @@ def delete_post(post_id):
         
         # 画像パスを保存（削除前に）
         image_path = post.image_path
+        image_variants = post.image_variants
         
         # 関連するいいねを削除
         Like.query.filter_by(post_id=post_id).delete()
         
         # 投稿を削除
         db.session.delete(post)
+        db.session.flush()
+        rankings.on_post_deleted(post_id, post.school)
+        # 画像ファイルの削除は投稿の削除と同時に登録し、バックグラウンドで行う
+        jobs.enqueue_image_deletion(image_path, image_variants)
         db.session.commit()
-        
-        # 画像ファイルの削除（修正版）
-        if image_path:
-            delete_success = delete_image_from_supabase(image_path)
-            if delete_success:
-                print(f"Successfully deleted image file: {image_path}")
-            else:
-                print(f"Failed to delete image file: {image_path}")
-                # 画像削除失敗はログに記録するが、ユーザーエラーにはしない
-                # （投稿データの削除は成功しているため）
+        invalidate_post_caches(post_id)
+        job_runner.notify()
         
         flash('投稿を削除しました。', 'success')
         
     except SQLAlchemyError as e:
         db.session.rollback()
-        print(f"Database error in delete_post: {e}")
+        app.logger.error(f"Database error in delete_post: {e}")
         flash('投稿の削除中にデータベースエラーが発生しました。', 'error')
     
     return redirect(url_for('account'))
@@ -1039,37 +1141,64 @@ def delete_post(post_id):
 
 @app.route('/like/<int:post_id>', methods=['POST'])
 def like_post(post_id):
-    if 'user_id' not in session:
+    # 初めての書き込みであればここでユーザーを作成
+    user = ensure_user()
+    if not user:
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({'status': 'error', 'message': 'ユーザー情報がありません。ページを更新してください。'}), 401
         flash('ユーザー情報がありません。', 'error')
         return redirect(url_for('index'))
     
-    user_id = session['user_id']
+    user_id = user.id
     
+    if like_buffer.enabled:
+        # 書き込み遅延モード：記録だけして楽観的ないいね数を返す（DBへはまとめて書き込む）
+        liked = request.form.get('liked')
+        try:
+            recorded = like_buffer.record(post_id, user_id, liked=None if liked is None else liked == '1')
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            app.logger.error(f"Error in like_post: {e}")
+            recorded = False
+        if recorded is None:
+            if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+                return jsonify({'status': 'error', 'message': '投稿が存在しません。'}), 404
+            flash('投稿が存在しません。', 'error')
+            return redirect(request.referrer or url_for('index'))
+        if recorded is False:
+            if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+                return jsonify({'status': 'error', 'message': '処理中にエラーが発生しました。'}), 500
+            flash('エラーが発生しました。もう一度お試しください。', 'error')
+            return redirect(request.referrer or url_for('index'))
+
+        is_now_liked, like_count = recorded
+        message_for_flash = 'いいねしました！' if is_now_liked else 'いいねを取り消しました。'
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return jsonify({
+                'status': 'ok',
+                'message': message_for_flash,
+                'like_count': like_count,
+                'is_liked': is_now_liked
+            })
+        flash(message_for_flash, 'success' if is_now_liked else 'info')
+        return redirect(request.referrer or url_for('index'))
+
     try:
-        post = Post.query.get(post_id)
-        if not post:
+        # 付け外しと新しいいいね数の取得を1文で行う（likes.py）
+        result = toggle_like(post_id, user_id)
+        if result is None:
             if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
                 return jsonify({'status': 'error', 'message': '投稿が存在しません。'}), 404
             flash('投稿が存在しません。', 'error')
             return redirect(request.referrer or url_for('index'))
-        
-        existing_like = Like.query.filter_by(post_id=post_id, user_id=user_id).first()
 
-        if existing_like:
-            db.session.delete(existing_like)
-            message_for_flash = 'いいねを取り消しました。'
-            is_now_liked = False
-        else:
-            new_like = Like(post_id=post_id, user_id=user_id)
-            db.session.add(new_like)
-            message_for_flash = 'いいねしました！'
-            is_now_liked = True
+        like_count = result.like_count
+        is_now_liked = result.is_liked
+        message_for_flash = 'いいねしました！' if is_now_liked else 'いいねを取り消しました。'
 
         db.session.commit()
-        
-        like_count = Like.query.filter_by(post_id=post_id).count()
+        # 広告の集計・ランキングの更新はバックグラウンドでまとめて行う
+        like_hook_buffer.record_toggle(post_id, result)
 
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({
@@ -1083,7 +1212,7 @@ def like_post(post_id):
 
     except SQLAlchemyError as e:
         db.session.rollback()
-        print(f"Error in like_post: {e}")
+        app.logger.error(f"Error in like_post: {e}")
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({'status': 'error', 'message': '処理中にエラーが発生しました。'}), 500
         flash('エラーが発生しました。もう一度お試しください。', 'error')
@@ -1098,62 +1227,43 @@ def ranking():
     user_id = session.get('user_id')
     
     try:
-        # 高校リストを取得（投稿があるもののみ）
-        schools_with_posts = db.session.query(
-            Post.school,
-            func.count(Post.id).label('post_count')
-        ).filter(
-            Post.school.isnot(None),
-            Post.school != ''
-        ).group_by(Post.school) \
-         .order_by(desc('post_count')) \
-         .all()
+        # 高校リストを取得（投稿があるもののみ、事前集計済み）
+        schools_with_posts = app_cache.get_or_set(CACHE_KEY_RANKING_SCHOOLS, rankings.get_schools_with_posts)
 
         if ranking_type == 'school' and selected_school:
-            posts = db.session.query(
-                Post.id,
-                Post.user_id,
-                User.username,
-                Post.image_path,
-                Post.caption,
-                Post.price_range,
-                Post.area,
-                Post.store_name,
-                Post.school,
-                Post.created_at,
-                func.count(Like.id).label('like_count')
-            ).join(User, Post.user_id == User.id) \
-             .outerjoin(Like, Post.id == Like.post_id) \
-             .filter(Post.school == selected_school) \
-             .group_by(Post.id, User.username) \
-             .order_by(desc('like_count'), desc(Post.created_at)) \
-             .limit(20).all()
             page_title = f"🏆 {selected_school} ランキング"
+            # 投稿のない高校（不正な値を含む）のランキングは作らない
+            known_schools = {school['school'] for school in schools_with_posts}
+            ranked_ids = rankings.get_ranked_post_ids(rankings.school_scope(selected_school)) \
+                if selected_school in known_schools else []
         else:
-            posts = db.session.query(
+            page_title = "🏆 総合ランキング"
+            ranked_ids = rankings.get_ranked_post_ids(rankings.OVERALL_SCOPE)
+
+        # 事前集計済みの順位に従って投稿を主キーで取得
+        posts = []
+        if ranked_ids:
+            rows = db.session.query(
                 Post.id,
                 Post.user_id,
                 User.username,
                 Post.image_path,
+                Post.image_variants,
                 Post.caption,
                 Post.price_range,
                 Post.area,
                 Post.store_name,
                 Post.school,
                 Post.created_at,
-                func.count(Like.id).label('like_count')
+                Post.like_count
             ).join(User, Post.user_id == User.id) \
-             .outerjoin(Like, Post.id == Like.post_id) \
-             .group_by(Post.id, User.username) \
-             .order_by(desc('like_count'), desc(Post.created_at)) \
-             .limit(20).all()
-            page_title = "🏆 総合ランキング"
+             .filter(Post.id.in_(ranked_ids)) \
+             .all()
+            rows_by_id = {row.id: row for row in rows}
+            posts = [rows_by_id[post_id] for post_id in ranked_ids if post_id in rows_by_id]
         
         # いいねした投稿のIDを取得
-        liked_posts_ids = set()
-        if user_id:
-            likes_by_current_user = Like.query.filter_by(user_id=user_id).all()
-            liked_posts_ids = {like.post_id for like in likes_by_current_user}
+        liked_posts_ids = get_liked_post_ids(user_id, [post.id for post in posts])
 
         return render_template('ranking.html', 
                              posts=posts, 
@@ -1190,25 +1300,21 @@ def advertisements():
             Post.user_id,
             User.username,
             Post.image_path,
+            Post.image_variants,
             Post.caption,
             Post.price_range,
             Post.area,
             Post.store_name,
             Post.school,
             Post.created_at,
-            func.count(Like.id).label('like_count')
+            Post.like_count
         ).join(User, Post.user_id == User.id) \
-         .outerjoin(Like, Post.id == Like.post_id) \
          .filter(Post.user_id == 1) \
-         .group_by(Post.id, User.username) \
          .order_by(desc(Post.created_at)) \
          .all()
         
         # いいねした投稿のIDを取得
-        liked_posts_ids = set()
-        if user_id:
-            likes_by_current_user = Like.query.filter_by(user_id=user_id).all()
-            liked_posts_ids = {like.post_id for like in likes_by_current_user}
+        liked_posts_ids = get_liked_post_ids(user_id, [post.id for post in posts])
 
         return render_template('advertisements.html', 
                              posts=posts, 
@@ -1282,6 +1388,9 @@ app.config['WTF_CSRF_SSL_STRICT'] = False  # モバイルでの SSL 厳格モー
 # セッションを永続化する設定
 @app.before_request
 def make_session_permanent():
+    # 静的ファイル等でセッションを変更するとSet-Cookieが付くので触らない
+    if is_fast_path_request():
+        return
     session.permanent = True
 
 @app.route('/robots.txt')
@@ -1306,6 +1415,27 @@ def health_check():
     except Exception:
         return 'ERROR', 500
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 用のメトリクス（全ワーカーの合計。METRICS_TOKEN による Bearer 認証）"""
+    # トークン未設定のまま公開しない（内部の数値・エンドポイント名が見えるため）
+    if not METRICS_TOKEN:
+        return 'Not Found', 404
+    expected = f'Bearer {METRICS_TOKEN}'
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+        return 'Unauthorized', 401
+    body, content_type = metrics_collector.render()
+    return body, 200, {'Content-Type': content_type}
+
+@app.route('/admin/cache-stats')
+@admin_required
+def cache_stats():
+    """プロセス内キャッシュのヒット率など（監視用、ワーカー単位）"""
+    return jsonify({'pid': os.getpid(), 'app_cache': app_cache.stats(), 'post_info_cache': post_info_cache.stats(),
+                    'map_click_buffer': map_click_buffer.stats(), 'like_buffer': like_buffer.stats(),
+                    'like_hook_buffer': like_hook_buffer.stats(),
+                    'request_profiler': request_profiler.stats(), 'log_pipeline': log_pipeline.stats()})
+
 @app.route('/mobile-debug')
 def mobile_debug():
     """モバイル接続問題調査用エンドポイント"""
@@ -1315,7 +1445,7 @@ def mobile_debug():
     debug_info = {
         'user_agent': user_agent,
         'is_mobile': is_mobile,
-        'headers': dict(request.headers),
+        'headers': loggable_headers(),
         'session_id': session.get('user_id', 'None'),
         'csrf_token': generate_csrf(),
         'request_method': request.method,
@@ -1323,7 +1453,7 @@ def mobile_debug():
         'path': request.path
     }
     
-    app.logger.info(f"Mobile Debug Request: {debug_info}")
+    mobile_logger.info('mobile debug request', extra={k: v for k, v in debug_info.items() if k != 'csrf_token'})
     return jsonify(debug_info)
 
 @app.route('/admin/fix-db', methods=['POST'])
@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# --- 名前付きキャッシュキー ---
+# 投稿の作成・削除・編集で無効化するもの
+CACHE_KEY_USED_SCHOOLS = "schools:used"
+CACHE_KEY_RANKING_SCHOOLS = "ranking:schools"
+
+POST_WRITE_KEYS = (
+    CACHE_KEY_USED_SCHOOLS,
+    CACHE_KEY_RANKING_SCHOOLS,
+)
+
+# 検索結果（search.py が条件ごとのキーで保存）。投稿の書き込みで前方一致で無効化する
+CACHE_PREFIX_SEARCH = "search:"
+
+_MISSING = object()
+
+
+class TTLCache:
+    """TTL付き・件数上限ありのLRUキャッシュ
+
+    gunicornのワーカープロセスごとに独立している。無効化は同じワーカー内にしか
+    届かないため、他のワーカーの古い値はTTLで消える前提の短いTTLで使う。
+    """
+
+    def __init__(self, maxsize=512, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and item[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not _MISSING:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_set(self, key, loader, ttl=None):
+        """キャッシュがあれば返し、無ければ loader() の結果を保存して返す"""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._data.pop(key, _MISSING) is not _MISSING:
+                    self.invalidations += 1
+
+    def invalidate_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if isinstance(k, str) and k.startswith(prefix)]:
+                del self._data[key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+app_cache = TTLCache(
+    maxsize=int(os.environ.get("APP_CACHE_MAXSIZE", 512)),
+    ttl=int(os.environ.get("APP_CACHE_TTL", 60)),
+)
+
+# 投稿IDごとの派生データ（tracking_ad.ad_info）。投稿の件数だけ入るので app_cache とは分ける
+# 管理者による広告の編集（地図URL・店名）は他のワーカーには届かないため、TTLで反映されるまでの時間を短くしておく
+post_info_cache = TTLCache(
+    maxsize=int(os.environ.get("POST_INFO_CACHE_MAXSIZE", 4096)),
+    ttl=int(os.environ.get("POST_INFO_CACHE_TTL", 30)),
+)
+
+
+def invalidate_post_caches(post_id=None):
+    """投稿の作成・削除・編集後に呼ぶ（削除・編集では post_id を渡す）"""
+    app_cache.invalidate(*POST_WRITE_KEYS)
+    if post_id is not None:
+        post_info_cache.invalidate(post_id)
+    app_cache.invalidate_prefix(CACHE_PREFIX_SEARCH)
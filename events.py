@@ -0,0 +1,200 @@
+import atexit
+import os
+import threading
+from collections import deque
+from datetime import datetime
+from flask import current_app
+from sqlalchemy.exc import DisconnectionError, InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+from models import db, Post
+
+# --- 設定 ---
+# この件数たまったらすぐ書き込む
+EVENT_FLUSH_SIZE = int(os.environ.get("EVENT_FLUSH_SIZE", 200))
+# 件数に達しなくてもこの秒数ごとに書き込む（0以下ならバッファせずリクエスト内で書き込む）
+EVENT_FLUSH_INTERVAL = float(os.environ.get("EVENT_FLUSH_INTERVAL", 2))
+# DBに書けない間に保持する上限。超えたら古いものから捨てる
+EVENT_BUFFER_MAX = int(os.environ.get("EVENT_BUFFER_MAX", 50000))
+# 1回のINSERTに含める行数
+EVENT_INSERT_BATCH = 1000
+# 書き込めなかった行（制約違反など）をメモリに残す上限（/admin/cache-stats で件数を確認）
+EVENT_DEAD_LETTER_MAX = 1000
+
+# 接続断・タイムアウトなど、やり直せば書き込める可能性があるエラー
+_TRANSIENT_ERRORS = (OperationalError, InterfaceError, DisconnectionError, PoolTimeoutError)
+
+
+class EventBuffer:
+    """計測イベントをメモリにためて、まとめて INSERT するバッファ
+
+    リクエストは record() でキューに積むだけで、書き込みはワーカープロセスごとの
+    バックグラウンドスレッドが複数行INSERTで行う。プロセス終了時（atexit）に残りを書き込む。
+    プロセスが強制終了された場合、未書き込みのイベント（最大 EVENT_FLUSH_INTERVAL 秒分）は失われる。
+    """
+
+    def __init__(self, table, name, on_flush=None, flush_size=EVENT_FLUSH_SIZE,
+                 flush_interval=EVENT_FLUSH_INTERVAL, max_size=EVENT_BUFFER_MAX):
+        self.table = table
+        self.name = name
+        # 書き込んだ行（dict の list）を受け取り、同じトランザクションで集計などを更新する
+        self.on_flush = on_flush
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.app = None
+        self._events = deque()
+        self._lock = threading.Lock()
+        # 書き込み（バックグラウンド・atexit）を1つずつにする
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._worker = None
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.discarded = 0
+        self.failed_flushes = 0
+        self.dead_letters = deque(maxlen=EVENT_DEAD_LETTER_MAX)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions[f"event_buffer:{self.name}"] = self
+
+    @property
+    def buffered(self):
+        return self.flush_interval > 0 and self.app is not None
+
+    def record(self, **values):
+        """イベントを1件積む。created_at を省略した場合は現在時刻"""
+        values.setdefault("created_at", datetime.utcnow())
+        if not self.buffered:
+            written = self._write([values])
+            db.session.commit()
+            self.recorded += 1
+            self.written += written
+            return
+
+        self._start()
+        with self._lock:
+            self._events.append(values)
+            self.recorded += 1
+            while len(self._events) > self.max_size:
+                self._events.popleft()
+                self.dropped += 1
+            pending = len(self._events)
+        if pending >= self.flush_size:
+            self._wakeup.set()
+
+    def _start(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is not None:
+                return
+            self._worker = threading.Thread(target=self._work, name=f"event-buffer-{self.name}", daemon=True)
+            self._worker.start()
+        atexit.register(self.stop)
+
+    def _take(self, limit):
+        with self._lock:
+            count = min(limit, len(self._events))
+            return [self._events.popleft() for _ in range(count)]
+
+    def _requeue(self, rows):
+        # 書き込みに失敗した分を先頭に戻す（上限を超える分は捨てる）
+        with self._lock:
+            self._events.extendleft(reversed(rows))
+            while len(self._events) > self.max_size:
+                self._events.pop()
+                self.dropped += 1
+
+    def _write(self, rows):
+        """rows を INSERT する。書き込んだ行数を返す"""
+        if "post_id" in self.table.c:
+            # 書き込むまでの間に削除された投稿（他のワーカーのキャッシュで記録され続けたもの）のイベントは捨てる
+            post_ids = {row["post_id"] for row in rows}
+            existing = {row.id for row in db.session.query(Post.id).filter(Post.id.in_(post_ids))}
+            kept = [row for row in rows if row["post_id"] in existing]
+            self.discarded += len(rows) - len(kept)
+            rows = kept
+        if not rows:
+            return 0
+        db.session.execute(self.table.insert().values(rows))
+        if self.on_flush is not None:
+            self.on_flush(rows)
+        return len(rows)
+
+    def _write_each(self, rows):
+        """1行ずつ書き込み、書き込めない行は dead_letters に移してログに残す。書き込んだ行数を返す"""
+        written = 0
+        for row in rows:
+            try:
+                with db.session.begin_nested():
+                    written += self._write([row])
+            except Exception as e:
+                self.dead_letters.append(row)
+                current_app.logger.error(f"Event buffer {self.name}: dropped an event that cannot be written: {row} ({e})")
+        db.session.commit()
+        return written
+
+    def flush(self):
+        """たまっているイベントを全て書き込む。書き込んだ件数を返す（app_context 内で呼ぶ）"""
+        written = 0
+        with self._flush_lock:
+            while True:
+                rows = self._take(EVENT_INSERT_BATCH)
+                if not rows:
+                    break
+                try:
+                    count = self._write(rows)
+                    db.session.commit()
+                except _TRANSIENT_ERRORS as e:
+                    # DBに繋がらない間は戻して次回やり直す
+                    db.session.rollback()
+                    self._requeue(rows)
+                    self.failed_flushes += 1
+                    current_app.logger.error(f"Event buffer {self.name}: failed to write {len(rows)} events: {e}")
+                    break
+                except Exception as e:
+                    # 制約違反などはやり直しても通らないので、書ける行だけ書いて残りは捨てる
+                    # （戻すと同じ失敗を繰り返し、後から来たイベントが上限で捨てられ続ける）
+                    db.session.rollback()
+                    self.failed_flushes += 1
+                    current_app.logger.error(f"Event buffer {self.name}: failed to write {len(rows)} events, "
+                                             f"retrying one by one: {e}")
+                    count = self._write_each(rows)
+                written += count
+                self.written += count
+        return written
+
+    def stop(self):
+        """バックグラウンドスレッドを止めて残りを書き込む"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._worker is not None:
+            self._worker.join(timeout=10)
+        if self.app is not None and self._events:
+            with self.app.app_context():
+                self.flush()
+
+    def _work(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception as e:
+                    current_app.logger.error(f"Event buffer {self.name} worker error: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._events)
+        return {
+            "pending": pending,
+            "recorded": self.recorded,
+            "written": self.written,
+            "dropped": self.dropped,
+            "discarded": self.discarded,
+            "dead_letters": len(self.dead_letters),
+            "failed_flushes": self.failed_flushes,
+        }
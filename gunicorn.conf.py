@@ -0,0 +1,20 @@
+import os
+import shutil
+import tempfile
+
+# /metrics で全ワーカーの値をまとめるための共有ディレクトリ
+# （prometheus_client の import より前に設定する必要があるので、ワーカーがアプリを読み込む前にここで決める）
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "oshimeshi-metrics"))
+
+
+def on_starting(server):
+    # 前回起動時の値を残さない
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    # 終了したワーカーのゲージ（livesum）を集計から外す
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
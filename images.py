@@ -0,0 +1,96 @@
+import io
+import os
+from PIL import Image, ImageOps
+
+# 生成する画像サイズ（名前: 最大幅px）
+# thumb: 一覧のカード用 / medium: 詳細モーダル用
+IMAGE_VARIANT_WIDTHS = {
+    "thumb": 480,
+    "medium": 1280,
+}
+
+# 出力形式（名前: (Pillowの形式, Content-Type, 拡張子, 保存オプション)）
+IMAGE_VARIANT_FORMATS = {
+    "webp": ("WEBP", "image/webp", "webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", "jpg", {"quality": 82, "optimize": True, "progressive": True}),
+}
+
+# 変換・アップロードがバックグラウンドで完了するまでの Post.image_variants
+PENDING_VARIANTS = {"pending": True}
+# 変換に失敗し、再試行しても表示できない画像の Post.image_variants
+FAILED_VARIANTS = {"failed": True}
+
+def variant_key(base_name: str, size_name: str, format_name: str) -> str:
+    """元ファイル名（拡張子なし）から各サイズ・形式の保存キーを作る"""
+    ext = IMAGE_VARIANT_FORMATS[format_name][2]
+    return f"{base_name}_{size_name}.{ext}"
+
+def base_name_for(filename: str) -> str:
+    return os.path.splitext(filename)[0]
+
+def _normalize(img: Image.Image) -> Image.Image:
+    # EXIFの向き情報を画素に反映（以降の保存でEXIFは書き出さない）
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        # 透過PNGは白背景に合成（JPEGは透過を持てないため）
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img.convert("RGBA"), mask=img.convert("RGBA").split()[-1])
+        return background
+    return img.convert("RGB")
+
+def _resize(img: Image.Image, max_width: int) -> Image.Image:
+    if img.width <= max_width:
+        return img
+    height = max(1, round(img.height * max_width / img.width))
+    return img.resize((max_width, height), Image.LANCZOS)
+
+def build_image_variants(file, base_name: str) -> list:
+    """アップロード画像からサイズ・形式ごとの画像を生成する
+
+    戻り値は dict のリスト:
+    {"size", "format", "key", "width", "height", "content_type", "data"}
+    EXIFなどのメタデータは含めない。
+    """
+    file.seek(0)
+    with Image.open(file) as opened:
+        source = _normalize(opened)
+
+    variants = []
+    for size_name, max_width in IMAGE_VARIANT_WIDTHS.items():
+        resized = _resize(source, max_width)
+        for format_name, (pil_format, content_type, _, options) in IMAGE_VARIANT_FORMATS.items():
+            buf = io.BytesIO()
+            resized.save(buf, format=pil_format, **options)
+            variants.append({
+                "size": size_name,
+                "format": format_name,
+                "key": variant_key(base_name, size_name, format_name),
+                "width": resized.width,
+                "height": resized.height,
+                "content_type": content_type,
+                "data": buf.getvalue(),
+            })
+    file.seek(0)
+    return variants
+
+def variants_manifest(variants: list, url_for_key) -> dict:
+    """Post.image_variants に保存する形式に変換
+
+    {"thumb": {"width": 480, "height": 360, "webp": URL, "jpeg": URL}, ...}
+    """
+    manifest = {}
+    for v in variants:
+        entry = manifest.setdefault(v["size"], {"width": v["width"], "height": v["height"]})
+        entry[v["format"]] = url_for_key(v["key"])
+    return manifest
+
+def manifest_urls(manifest) -> list:
+    """image_variants に含まれる全画像URL"""
+    urls = []
+    for entry in (manifest or {}).values():
+        if not isinstance(entry, dict):
+            continue
+        for format_name in IMAGE_VARIANT_FORMATS:
+            if entry.get(format_name):
+                urls.append(entry[format_name])
+    return urls
@@ -0,0 +1,287 @@
+import atexit
+import io
+import os
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, or_, update
+from models import db, Post
+from images import build_image_variants, variants_manifest, manifest_urls, FAILED_VARIANTS, PENDING_VARIANTS
+from storage import get_storage, extract_storage_filename
+
+# --- 設定 ---
+# ワーカースレッド数（0ならバックグラウンド実行しない。flask run-storage-jobs で処理する）
+JOB_WORKER_THREADS = int(os.environ.get("JOB_WORKER_THREADS", 2))
+# 新しいジョブの通知が無いときの確認間隔（秒）
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 5))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 5))
+# 再試行の待ち時間（秒）。試行ごとに倍にする
+JOB_RETRY_BASE_SECONDS = 10
+# 実行中のままこの秒数を過ぎたジョブは、ワーカーが落ちたものとして再実行する
+JOB_STALE_SECONDS = 600
+
+JOB_STATUS_PENDING = "pending"
+JOB_STATUS_RUNNING = "running"
+JOB_STATUS_FAILED = "failed"
+
+# ジョブの種類
+JOB_PROCESS_POST_IMAGE = "process_post_image"
+JOB_DELETE_IMAGES = "delete_images"
+
+
+class PermanentJobError(Exception):
+    """再試行しても成功しない失敗（壊れた画像など）"""
+
+
+# --- ジョブテーブル ---
+class StorageJob(db.Model):
+    """ストレージ操作のジョブ
+
+    DBに保存するので、ワーカーの再起動・デプロイをまたいでも失われない。
+    成功したジョブは削除し、失敗し続けたものは failed として残す。
+    """
+    __tablename__ = "storage_jobs"
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    # アップロードされた元画像（処理が終わるまでの一時保存）
+    data = db.Column(db.LargeBinary, nullable=True)
+    status = db.Column(db.String(20), nullable=False, default=JOB_STATUS_PENDING, index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+_HANDLERS = {}
+_FAILURE_HANDLERS = {}
+
+def job_handler(kind, on_failure=None):
+    """on_failure: ジョブが failed になったときに呼ぶ関数（対象を失敗の状態にするなど）"""
+    def decorator(func):
+        _HANDLERS[kind] = func
+        if on_failure is not None:
+            _FAILURE_HANDLERS[kind] = on_failure
+        return func
+    return decorator
+
+def enqueue(kind, payload, data=None):
+    """ジョブを登録する
+
+    呼び出し側のトランザクションでcommitされるので、投稿の保存・削除と同時に確定する。
+    commit後に job_runner.notify() を呼ぶとすぐに処理が始まる。
+    """
+    job = StorageJob(kind=kind, payload=payload, data=data, status=JOB_STATUS_PENDING, run_after=datetime.utcnow())
+    db.session.add(job)
+    return job
+
+def enqueue_post_image(post_id, base_name, data):
+    return enqueue(JOB_PROCESS_POST_IMAGE, {"post_id": post_id, "base_name": base_name}, data=data)
+
+def enqueue_image_deletion(image_path, image_variants):
+    """投稿に紐づく画像（メイン画像と全サイズ）の削除を登録"""
+    paths = manifest_urls(image_variants)
+    if image_path and image_path not in paths:
+        paths.append(image_path)
+    if paths:
+        return enqueue(JOB_DELETE_IMAGES, {"paths": paths})
+    return None
+
+
+# --- ジョブの実行 ---
+def _runnable_filter(now):
+    stale_before = now - timedelta(seconds=JOB_STALE_SECONDS)
+    return or_(
+        and_(StorageJob.status == JOB_STATUS_PENDING, StorageJob.run_after <= now),
+        and_(StorageJob.status == JOB_STATUS_RUNNING, StorageJob.locked_at < stale_before),
+    )
+
+def _claim_next_job():
+    """実行可能なジョブを1件確保する（複数ワーカーで同じジョブを取らないよう条件付きUPDATE）
+
+    戻り値: 確保したジョブID / 他のワーカーに先を越された場合 False / ジョブが無ければ None
+    """
+    now = datetime.utcnow()
+    job_id = db.session.query(StorageJob.id).filter(_runnable_filter(now)) \
+        .order_by(StorageJob.run_after, StorageJob.id).limit(1).scalar()
+    if job_id is None:
+        db.session.rollback()
+        return None
+
+    claimed = db.session.execute(
+        update(StorageJob)
+        .where(StorageJob.id == job_id, _runnable_filter(now))
+        .values(status=JOB_STATUS_RUNNING, locked_at=now, attempts=StorageJob.attempts + 1)
+    ).rowcount
+    db.session.commit()
+    return job_id if claimed else False
+
+def _run_job(job_id):
+    job = db.session.get(StorageJob, job_id)
+    handler = _HANDLERS.get(job.kind)
+    try:
+        if handler is None:
+            raise PermanentJobError(f"Unknown job kind: {job.kind}")
+        handler(job)
+        db.session.delete(job)
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(StorageJob, job_id)
+        job.last_error = f"{type(e).__name__}: {e}"[:2000]
+        job.locked_at = None
+        if isinstance(e, PermanentJobError) or job.attempts >= JOB_MAX_ATTEMPTS:
+            job.status = JOB_STATUS_FAILED
+            current_app.logger.error(f"Storage job {job.id} ({job.kind}) failed permanently: {job.last_error}")
+            on_failure = _FAILURE_HANDLERS.get(job.kind)
+            if on_failure is not None:
+                on_failure(job)
+        else:
+            job.status = JOB_STATUS_PENDING
+            job.run_after = datetime.utcnow() + timedelta(seconds=JOB_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1))
+            current_app.logger.warning(f"Storage job {job.id} ({job.kind}) failed (attempt {job.attempts}), retrying: {job.last_error}")
+        db.session.commit()
+        return False
+
+def run_next_job():
+    """ジョブを1件実行する。実行するものが無ければ None"""
+    job_id = _claim_next_job()
+    if job_id is None:
+        return None
+    if job_id is False:
+        return False
+    return _run_job(job_id)
+
+def run_pending(limit=None):
+    """実行可能なジョブを同期的に処理する（CLI・検証用）。(成功数, 失敗数) を返す"""
+    succeeded = failed = 0
+    while limit is None or succeeded + failed < limit:
+        result = run_next_job()
+        if result is None:
+            break
+        if result is True:
+            succeeded += 1
+        elif result is False:
+            failed += 1
+    return succeeded, failed
+
+def retry_failed():
+    """failed のジョブを再実行待ちに戻す（画像の投稿は準備中の表示に戻す）"""
+    failed_image_jobs = StorageJob.query.filter_by(status=JOB_STATUS_FAILED, kind=JOB_PROCESS_POST_IMAGE).all()
+    for job in failed_image_jobs:
+        _set_post_variants(job, PENDING_VARIANTS)
+    count = StorageJob.query.filter_by(status=JOB_STATUS_FAILED).update(
+        {"status": JOB_STATUS_PENDING, "attempts": 0, "run_after": datetime.utcnow()},
+        synchronize_session=False,
+    )
+    db.session.commit()
+    return count
+
+def job_counts():
+    rows = db.session.query(StorageJob.status, db.func.count(StorageJob.id)).group_by(StorageJob.status).all()
+    return {status: count for status, count in rows}
+
+
+# --- ジョブの種類 ---
+def _set_post_variants(job, variants):
+    post = db.session.get(Post, job.payload["post_id"])
+    if post is not None:
+        post.image_variants = variants
+
+def _mark_post_image_failed(job):
+    # 準備中のまま残さず、画像を表示できない投稿として扱う（_post_image.html）
+    _set_post_variants(job, FAILED_VARIANTS)
+
+@job_handler(JOB_PROCESS_POST_IMAGE, on_failure=_mark_post_image_failed)
+def process_post_image(job):
+    """元画像からサイズ別画像を作ってアップロードし、投稿に記録する"""
+    storage = get_storage()
+    base_name = job.payload["base_name"]
+    try:
+        variants = build_image_variants(io.BytesIO(job.data), base_name)
+    except Exception as e:
+        raise PermanentJobError(f"Image variant generation error: {e}") from e
+
+    urls = {}
+    for variant in variants:
+        urls[variant["key"]] = storage.upload(variant["key"], variant["data"], variant["content_type"])
+
+    post = db.session.get(Post, job.payload["post_id"])
+    if post is None:
+        # 処理中に投稿が削除された場合はアップロードした画像も消す
+        storage.remove(list(urls))
+        return
+
+    manifest = variants_manifest(variants, urls.get)
+    post.image_variants = manifest
+    post.image_path = manifest["medium"]["jpeg"]
+
+@job_handler(JOB_DELETE_IMAGES)
+def delete_images(job):
+    keys = [key for key in (extract_storage_filename(path) for path in job.payload["paths"]) if key]
+    get_storage().remove(keys)
+
+
+# --- バックグラウンド実行 ---
+class JobRunner:
+    """ワーカープロセスごとのスレッドプール
+
+    最初のリクエストで起動し、起動時に残っていたジョブ（再起動前の未処理分）も処理する。
+    """
+
+    def __init__(self, threads=JOB_WORKER_THREADS, poll_interval=JOB_POLL_INTERVAL):
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.app = None
+        self._workers = []
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions["job_runner"] = self
+        app.before_request(self._start_on_first_request)
+
+    def _start_on_first_request(self):
+        if not self._workers:
+            self.start()
+
+    def start(self):
+        if self.threads <= 0 or self.app is None:
+            return
+        with self._lock:
+            if self._workers:
+                return
+            for i in range(self.threads):
+                worker = threading.Thread(target=self._work, name=f"storage-job-{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+        atexit.register(self.stop)
+
+    def notify(self):
+        """新しいジョブを登録した後に呼ぶ"""
+        self.start()
+        self._wakeup.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _work(self):
+        while not self._stop.is_set():
+            result = None
+            with self.app.app_context():
+                try:
+                    result = run_next_job()
+                except Exception as e:
+                    db.session.rollback()
+                    current_app.logger.error(f"Storage job worker error: {e}")
+            if result is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+
+job_runner = JobRunner()
@@ -0,0 +1,354 @@
+import atexit
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import delete, select, text, tuple_, update
+from models import db, Post, Like, dialect_insert
+import analytics
+import rankings
+from events import EventBuffer
+
+# いいねの切り替え結果
+# added_at / removed_at: 追加・削除したいいねの日時（集計の更新用。変化が無ければ None）
+LikeToggle = namedtuple("LikeToggle", ["is_liked", "like_count", "school", "post_created_at", "added_at", "removed_at"])
+
+# PostgreSQL: 削除・追加・いいね数の更新を1文で行う
+# 同じユーザーの同時タップで追加が衝突した場合は DO NOTHING になり、いいね数も変えない
+_TOGGLE_LIKE_SQL = text("""
+WITH deleted AS (
+    DELETE FROM likes
+    WHERE post_id = :post_id AND user_id = :user_id
+    RETURNING created_at
+), inserted AS (
+    INSERT INTO likes (post_id, user_id, created_at)
+    SELECT :post_id, :user_id, :now
+    WHERE NOT EXISTS (SELECT 1 FROM deleted)
+      AND EXISTS (SELECT 1 FROM posts WHERE id = :post_id)
+    ON CONFLICT (post_id, user_id) DO NOTHING
+    RETURNING created_at
+), updated AS (
+    UPDATE posts
+    SET like_count = like_count + (SELECT count(*) FROM inserted) - (SELECT count(*) FROM deleted)
+    WHERE id = :post_id
+    RETURNING like_count, school, created_at
+)
+SELECT updated.like_count,
+       updated.school,
+       updated.created_at AS post_created_at,
+       NOT EXISTS (SELECT 1 FROM deleted) AS is_liked,
+       (SELECT created_at FROM inserted) AS added_at,
+       (SELECT created_at FROM deleted) AS removed_at
+FROM updated
+""")
+
+def _toggle_like_statements(post_id, user_id, now):
+    """SQLite用（データ変更を含むWITHが使えないので、同じトランザクション内で順に実行）"""
+    post = db.session.execute(
+        select(Post.school, Post.created_at).where(Post.id == post_id)
+    ).first()
+    if post is None:
+        return None
+
+    removed_at = db.session.execute(
+        delete(Like).where(Like.post_id == post_id, Like.user_id == user_id).returning(Like.created_at)
+    ).scalar()
+    added_at = None
+    if removed_at is None:
+        added_at = db.session.execute(
+            dialect_insert(Like.__table__)
+            .values(post_id=post_id, user_id=user_id, created_at=now)
+            .on_conflict_do_nothing(index_elements=["post_id", "user_id"])
+            .returning(Like.created_at)
+        ).scalar()
+    delta = (1 if added_at else 0) - (1 if removed_at else 0)
+    like_count = db.session.execute(
+        update(Post).where(Post.id == post_id).values(like_count=Post.like_count + delta).returning(Post.like_count)
+    ).scalar_one()
+    return LikeToggle(removed_at is None, like_count, post.school, post.created_at, added_at, removed_at)
+
+def toggle_like(post_id, user_id):
+    """いいねを付け外しし、LikeToggle を返す（投稿が無ければ None）。commit は呼び出し側で行う
+
+    PostgreSQL では1往復。同じユーザーの連打が同時に届いても likes と posts.like_count がずれない。
+    """
+    now = datetime.utcnow()
+    if db.engine.dialect.name != "postgresql":
+        return _toggle_like_statements(post_id, user_id, now)
+
+    row = db.session.execute(_TOGGLE_LIKE_SQL, {"post_id": post_id, "user_id": user_id, "now": now}).first()
+    if row is None:
+        return None
+    return LikeToggle(row.is_liked, row.like_count, row.school, row.post_created_at, row.added_at, row.removed_at)
+
+
+# --- いいね後の集計・ランキング更新 ---
+class LikeHookBuffer(EventBuffer):
+    """付け外しの結果をためて、広告の集計とランキングの更新をバックグラウンドでまとめて行う
+
+    いいねのリクエストは toggle_like の1文と commit だけで応答する。ランキングは投稿ごとに1回だけ、
+    書き込み時点のDBのいいね数で更新する（ワーカーごとに書き込むので、記録した時点の数は古いことがある）。
+    """
+
+    def __init__(self, name="like_hooks", **kwargs):
+        super().__init__(None, name, **kwargs)
+
+    def _write(self, rows):
+        post_ids = {row["post_id"] for row in rows}
+        # 反映するまでの間に削除された投稿は飛ばす
+        posts = {
+            post.id: post for post in
+            db.session.query(Post.id, Post.school, Post.like_count, Post.created_at).filter(Post.id.in_(post_ids))
+        }
+        self.discarded += sum(1 for row in rows if row["post_id"] not in posts)
+        changes = []
+        for row in rows:
+            if row["post_id"] not in posts:
+                continue
+            if row["removed_at"]:
+                changes.append((row["post_id"], row["removed_at"], -1))
+            if row["added_at"]:
+                changes.append((row["post_id"], row["added_at"], 1))
+        analytics.on_likes_changed(changes)
+        for post in posts.values():
+            rankings.on_like_changed(post.id, post.school, post.like_count, post.created_at)
+        return len(rows)
+
+    def record_toggle(self, post_id, result: LikeToggle):
+        """toggle_like の結果を積む（いいね数が変わらなかった場合は何もしない）。commit の後に呼ぶ"""
+        if result.added_at or result.removed_at:
+            self.record(post_id=post_id, added_at=result.added_at, removed_at=result.removed_at)
+
+
+like_hook_buffer = LikeHookBuffer()
+
+
+# --- 書き込み遅延（write-behind）モード ---
+# 人気の投稿にいいねが集中したときに、1タップごとのcommitでDB接続を使い切らないようにする
+# 有効にすると、いいねの付け外しはメモリ上の記録だけで応答し、まとめてDBに書き込む
+LIKE_WRITE_BEHIND = os.environ.get("LIKE_WRITE_BEHIND", "0").lower() in ("1", "true", "yes")
+LIKE_FLUSH_INTERVAL = float(os.environ.get("LIKE_FLUSH_INTERVAL", 1))
+# この件数の (ユーザー, 投稿) がたまったら間隔を待たずに書き込む
+LIKE_FLUSH_SIZE = int(os.environ.get("LIKE_FLUSH_SIZE", 500))
+
+
+class LikeBuffer:
+    """いいね・取り消しの意図を (user_id, post_id) ごとにまとめ、バックグラウンドで書き込む
+
+    同じユーザーが同じ投稿を何度押しても、書き込むのは最後の状態だけ（INSERT ... ON CONFLICT DO NOTHING /
+    DELETE をそれぞれ1文で）。いいね数は実際に増減した行から投稿ごとに1回だけ更新する。
+    応答には「最後に書き込んだ時点のいいね数 + 未書き込みの増減」を楽観的な値として返す。
+
+    ワーカープロセスごとのメモリ上の記録なので、プロセスが強制終了されると最大 LIKE_FLUSH_INTERVAL 秒分の
+    いいねが失われる。通常の終了時（atexit）には残りを書き込む。
+    """
+
+    def __init__(self, flush_interval=LIKE_FLUSH_INTERVAL, flush_size=LIKE_FLUSH_SIZE):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.app = None
+        # {(user_id, post_id): いいねした状態にするか}
+        self._intents = {}
+        # 書き込み中の分（書き込みが終わるまで状態の判定に使う）
+        self._flushing = {}
+        # {post_id: 未書き込みのいいね数の増減}（_flushing_delta は書き込み中の分）
+        self._pending_delta = {}
+        self._flushing_delta = {}
+        # {post_id: 最後にDBで確認したいいね数}
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._worker = None
+        self.recorded = 0
+        self.written = 0
+        self.failed_flushes = 0
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions["like_buffer"] = self
+
+    @property
+    def enabled(self):
+        return LIKE_WRITE_BEHIND and self.flush_interval > 0 and self.app is not None
+
+    def _current_state(self, user_id, post_id):
+        key = (user_id, post_id)
+        if key in self._intents:
+            return self._intents[key]
+        if key in self._flushing:
+            return self._flushing[key]
+        return None
+
+    def record(self, post_id, user_id, liked=None):
+        """いいねの付け外しを記録し、(いいね状態, 楽観的ないいね数) を返す。投稿が無ければ None
+
+        liked: 押した後の状態（クライアントが送る）。None の場合は現在の状態を調べて反転する。
+        """
+        with self._lock:
+            previous = self._current_state(user_id, post_id)
+        if previous is None and liked is None:
+            previous = db.session.query(
+                db.session.query(Like.id).filter_by(post_id=post_id, user_id=user_id).exists()
+            ).scalar()
+        if liked is None:
+            liked = not previous
+
+        base = self._counts.get(post_id)
+        if base is None:
+            base = db.session.query(Post.like_count).filter(Post.id == post_id).scalar()
+            if base is None:
+                return None
+
+        self._start()
+        with self._lock:
+            if previous is None:
+                # DB上の状態が分からない場合は押す前の逆とみなす（書き込み時に実際の増減で補正される）
+                previous = not liked
+            self._intents[(user_id, post_id)] = liked
+            if liked != previous:
+                self._pending_delta[post_id] = self._pending_delta.get(post_id, 0) + (1 if liked else -1)
+            self._counts.setdefault(post_id, base)
+            count = max(0, self._counts[post_id] + self._flushing_delta.get(post_id, 0)
+                        + self._pending_delta.get(post_id, 0))
+            self.recorded += 1
+            pending = len(self._intents)
+        if pending >= self.flush_size:
+            self._wakeup.set()
+        return liked, count
+
+    def pending_for_user(self, user_id) -> dict:
+        """未書き込みのいいね状態 {post_id: いいね済みか}（ページ表示に反映する）"""
+        with self._lock:
+            states = {post_id: liked for (uid, post_id), liked in self._flushing.items() if uid == user_id}
+            states.update({post_id: liked for (uid, post_id), liked in self._intents.items() if uid == user_id})
+        return states
+
+    def _start(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is not None:
+                return
+            self._worker = threading.Thread(target=self._work, name="like-buffer", daemon=True)
+            self._worker.start()
+        atexit.register(self.stop)
+
+    def flush(self):
+        """たまっている付け外しを書き込む。変更した likes の行数を返す（app_context 内で呼ぶ）"""
+        with self._flush_lock:
+            with self._lock:
+                intents, self._intents = self._intents, {}
+                pending_delta, self._pending_delta = self._pending_delta, {}
+                self._flushing = intents
+                self._flushing_delta = pending_delta
+            if not intents:
+                return 0
+            try:
+                changed, counts = self._write(intents)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self.failed_flushes += 1
+                with self._lock:
+                    # 失敗した分は、その後の操作を優先して戻す
+                    for key, liked in intents.items():
+                        self._intents.setdefault(key, liked)
+                    for post_id, delta in pending_delta.items():
+                        self._pending_delta[post_id] = self._pending_delta.get(post_id, 0) + delta
+                    self._flushing = {}
+                    self._flushing_delta = {}
+                current_app.logger.error(f"Like buffer: failed to write {len(intents)} likes: {e}")
+                return 0
+            with self._lock:
+                self._flushing = {}
+                self._flushing_delta = {}
+                # 楽観的な値の基準を、書き込んだ後のいいね数にする（増減の無かった投稿は次回DBから読み直す）
+                for post_id in {post_id for (_, post_id) in intents}:
+                    if post_id in counts:
+                        self._counts[post_id] = counts[post_id]
+                    else:
+                        self._counts.pop(post_id, None)
+            self.written += changed
+            return changed
+
+    def _write(self, intents):
+        now = datetime.utcnow()
+        # 書き込むまでの間に削除された投稿へのいいねは捨てる
+        liked_post_ids = {post_id for (_, post_id), liked in intents.items() if liked}
+        existing_post_ids = {row.id for row in db.session.query(Post.id).filter(Post.id.in_(liked_post_ids))} \
+            if liked_post_ids else set()
+        added = [{"post_id": post_id, "user_id": user_id, "created_at": now}
+                 for (user_id, post_id), liked in intents.items() if liked and post_id in existing_post_ids]
+        removed = [(user_id, post_id) for (user_id, post_id), liked in intents.items() if not liked]
+
+        deltas = {}
+        changes = []
+        if added:
+            rows = db.session.execute(
+                dialect_insert(Like.__table__).values(added)
+                .on_conflict_do_nothing(index_elements=["post_id", "user_id"])
+                .returning(Like.post_id, Like.created_at)
+            ).all()
+            for row in rows:
+                deltas[row.post_id] = deltas.get(row.post_id, 0) + 1
+                changes.append((row.post_id, row.created_at, 1))
+        if removed:
+            rows = db.session.execute(
+                delete(Like).where(tuple_(Like.user_id, Like.post_id).in_(removed))
+                .returning(Like.post_id, Like.created_at)
+            ).all()
+            for row in rows:
+                deltas[row.post_id] = deltas.get(row.post_id, 0) - 1
+                changes.append((row.post_id, row.created_at, -1))
+        analytics.on_likes_changed(changes)
+
+        counts = {}
+        for post_id, delta in deltas.items():
+            if not delta:
+                continue
+            post = db.session.execute(
+                update(Post).where(Post.id == post_id).values(like_count=Post.like_count + delta)
+                .returning(Post.like_count, Post.school, Post.created_at)
+            ).first()
+            if post is None:
+                continue
+            counts[post_id] = post.like_count
+            rankings.on_like_changed(post_id, post.school, post.like_count, post.created_at)
+
+        return sum(abs(delta) for delta in deltas.values()), counts
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._worker is not None:
+            self._worker.join(timeout=10)
+        if self.app is not None and self._intents:
+            with self.app.app_context():
+                self.flush()
+
+    def _work(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception as e:
+                    current_app.logger.error(f"Like buffer worker error: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._intents)
+        return {
+            "enabled": self.enabled,
+            "pending": pending,
+            "recorded": self.recorded,
+            "written": self.written,
+            "failed_flushes": self.failed_flushes,
+        }
+
+
+like_buffer = LikeBuffer()
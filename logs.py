@@ -0,0 +1,126 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from flask import g, has_request_context
+
+# --- 設定 ---
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# json（1行1レコード）/ text
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+# 出力先のファイル。空なら標準エラー出力のみ
+LOG_FILE = os.environ.get("LOG_FILE", "app.log")
+LOG_FILE_MAX_BYTES = int(os.environ.get("LOG_FILE_MAX_BYTES", 10 * 1024 * 1024))
+LOG_FILE_BACKUP_COUNT = int(os.environ.get("LOG_FILE_BACKUP_COUNT", 5))
+# 書き込み待ちの上限。あふれた分はリクエストを待たせずに捨てる
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+# モバイル調査用ログ（ヘッダー・セッションのキーなど）。DEBUG 以下にしたときだけ出る
+MOBILE_DEBUG_LOG_LEVEL = os.environ.get("MOBILE_DEBUG_LOG_LEVEL", "INFO").upper()
+# モバイル調査用ログを出すリクエストの割合（0〜1）
+MOBILE_DEBUG_SAMPLE_RATE = float(os.environ.get("MOBILE_DEBUG_SAMPLE_RATE", 0.01))
+
+mobile_logger = logging.getLogger("oshimeshi.mobile")
+
+# LogRecord が最初から持っている属性（extra= で渡された項目と区別する）
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行のJSONにする。extra= で渡した項目もそのまま含める"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """キューが一杯なら待たずに捨てて数える"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """ログの書き込みを専用スレッドに任せる
+
+    リクエストのスレッドは QueueHandler でキューに積むだけで、ファイル・標準エラー出力への
+    書き込み（ローテーションを含む）は QueueListener のスレッドが行う。
+    ワーカープロセスごとに1つ。プロセス終了時（atexit）に残りを書き出す。
+    """
+
+    def __init__(self):
+        self.handler = None
+        self.listener = None
+
+    def init_app(self, app):
+        formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s: %(message)s [in %(pathname)s:%(lineno)d]"
+        )
+        outputs = [logging.StreamHandler(sys.stderr)]
+        if LOG_FILE:
+            outputs.append(RotatingFileHandler(LOG_FILE, maxBytes=LOG_FILE_MAX_BYTES,
+                                               backupCount=LOG_FILE_BACKUP_COUNT, encoding="utf-8"))
+        for output in outputs:
+            output.setFormatter(formatter)
+
+        self.handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        self.listener = QueueListener(self.handler.queue, *outputs, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.stop)
+
+        # app.logger・current_app.logger・各モジュールのロガーはすべてルートに伝わる
+        root = logging.getLogger()
+        root.handlers = [self.handler]
+        root.setLevel(LOG_LEVEL)
+        from flask.logging import default_handler
+        app.logger.removeHandler(default_handler)
+        app.logger.setLevel(LOG_LEVEL)
+        mobile_logger.setLevel(MOBILE_DEBUG_LOG_LEVEL)
+        app.extensions["log_pipeline"] = self
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.handler.queue.qsize() if self.handler else 0,
+            "dropped": self.handler.dropped if self.handler else 0,
+        }
+
+
+def mobile_debug_enabled() -> bool:
+    """このリクエストでモバイル調査用ログを出すか（リクエストごとに1回だけ抽選する）"""
+    if not mobile_logger.isEnabledFor(logging.DEBUG):
+        return False
+    if not has_request_context():
+        return False
+    if "_mobile_debug" not in g:
+        g._mobile_debug = random.random() < MOBILE_DEBUG_SAMPLE_RATE
+    return g._mobile_debug
+
+
+log_pipeline = LogPipeline()
@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+from flask import g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+)
+
+# --- 設定 ---
+# gunicorn の複数ワーカーの値をまとめるための共有ディレクトリ（gunicorn.conf.py で設定）。
+# 未設定なら1プロセス分の値だけを出す
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+# /metrics に必要な Bearer トークン（未設定なら /metrics は 404 で公開しない）
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# プール・キャッシュの値をワーカーから書き出す間隔（秒）
+METRICS_SYNC_INTERVAL = float(os.environ.get("METRICS_SYNC_INTERVAL", 5))
+
+# --- メトリクス ---
+REQUEST_SECONDS = Histogram(
+    "oshimeshi_request_duration_seconds", "Request latency by endpoint",
+    ["endpoint", "method", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "oshimeshi_db_pool_checked_out", "Connections currently checked out of the SQLAlchemy pool",
+    multiprocess_mode="livesum",
+)
+DB_POOL_OVERFLOW = Gauge(
+    "oshimeshi_db_pool_overflow", "Connections opened beyond pool_size (max_overflow)",
+    multiprocess_mode="livesum",
+)
+DB_POOL_SIZE = Gauge(
+    "oshimeshi_db_pool_size", "Configured pool_size", multiprocess_mode="livesum",
+)
+STORAGE_UPLOAD_SECONDS = Histogram(
+    "oshimeshi_storage_upload_duration_seconds", "Image upload latency to the storage backend",
+    ["backend", "outcome"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30),
+)
+CACHE_REQUESTS = Counter(
+    "oshimeshi_cache_requests_total", "In-process cache lookups (hit rate = hit / (hit + miss))",
+    ["cache", "result"],
+)
+AD_EVENTS = Counter(
+    "oshimeshi_ad_events_total", "Ad events (map_click / coupon_issued / coupon_repeat)",
+    ["event"],
+)
+EVENT_BUFFER_PENDING = Gauge(
+    "oshimeshi_event_buffer_pending", "Events waiting to be written", ["buffer"],
+    multiprocess_mode="livesum",
+)
+
+
+class MetricsCollector:
+    """リクエストのレイテンシを記録し、プール・キャッシュ・バッファの値を定期的に書き出す
+
+    ゲージ（プール・バッファ）はワーカーごとの値の合計（livesum）、キャッシュのヒット数は
+    TTLCache の累計との差分をカウンターに足していく。書き出しはリクエストの終わりに
+    METRICS_SYNC_INTERVAL 秒に1回だけ行う。
+    """
+
+    def __init__(self):
+        self.app = None
+        self._lock = threading.Lock()
+        self._last_sync = 0.0
+        self._cache_totals = {}
+
+    def init_app(self, app, pool=None, caches=None, buffers=None, skip=None):
+        """pool: 現在のコネクションプールを返す関数、caches / buffers: 名前 → TTLCache / stats() を持つもの"""
+        self.app = app
+        self.pool = pool
+        self.caches = caches or {}
+        self.buffers = buffers or {}
+        self.skip = skip
+        app.extensions["metrics_collector"] = self
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def _before_request(self):
+        g._metrics_started = time.perf_counter()
+
+    def _after_request(self, response):
+        started = g.pop("_metrics_started", None)
+        if started is not None and not (self.skip is not None and self.skip()):
+            # 存在しないURLはエンドポイントが無いのでまとめる（ラベルの種類が増え続けないように）
+            REQUEST_SECONDS.labels(request.endpoint or "unmatched", request.method, str(response.status_code)) \
+                .observe(time.perf_counter() - started)
+        now = time.monotonic()
+        if now - self._last_sync >= METRICS_SYNC_INTERVAL:
+            self._last_sync = now
+            try:
+                self.sync()
+            except Exception as e:
+                self.app.logger.warning(f"Metrics sync failed: {e}")
+        return response
+
+    def sync(self):
+        if self.pool is not None:
+            pool = self.pool()
+            # SQLite の NullPool などは数を持たない
+            if hasattr(pool, "checkedout"):
+                DB_POOL_CHECKED_OUT.set(pool.checkedout())
+                DB_POOL_OVERFLOW.set(max(pool.overflow(), 0))
+                DB_POOL_SIZE.set(pool.size())
+        with self._lock:
+            for name, cache in self.caches.items():
+                for result, total in (("hit", cache.hits), ("miss", cache.misses)):
+                    previous = self._cache_totals.get((name, result), 0)
+                    if total > previous:
+                        CACHE_REQUESTS.labels(name, result).inc(total - previous)
+                    self._cache_totals[(name, result)] = total
+        for name, buffer in self.buffers.items():
+            EVENT_BUFFER_PENDING.labels(name).set(buffer.stats()["pending"])
+
+    def render(self):
+        """Prometheus のテキスト形式（本文, Content-Type）を返す"""
+        self.sync()
+        if PROMETHEUS_MULTIPROC_DIR:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+metrics_collector = MetricsCollector()
@@ -0,0 +1,115 @@
+import os
+import re
+from datetime import datetime
+from models import db
+
+# sql/ 以下のファイル名（YYYYMMDD_説明.sql）の拡張子を除いた部分をバージョンとして記録する
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql")
+
+_CONCURRENTLY = re.compile(r"\bCONCURRENTLY\b", re.IGNORECASE)
+
+
+class SchemaMigration(db.Model):
+    """適用済みのマイグレーション"""
+    __tablename__ = "schema_migrations"
+    version = db.Column(db.String(200), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+def available_versions() -> list:
+    return sorted(name[:-4] for name in os.listdir(MIGRATIONS_DIR) if name.endswith(".sql"))
+
+def applied_versions() -> set:
+    SchemaMigration.__table__.create(db.engine, checkfirst=True)
+    return {row.version for row in db.session.query(SchemaMigration.version)}
+
+def pending_versions() -> list:
+    applied = applied_versions()
+    return [version for version in available_versions() if version not in applied]
+
+def split_statements(sql: str) -> list:
+    """SQLファイルを文ごとに分ける（コメント・文字列・$$ で囲んだ関数本体の中の ; では区切らない）"""
+    statements = []
+    current = []
+    i = 0
+    quote = None  # "'" / '"' / "$tag$"
+    while i < len(sql):
+        ch = sql[i]
+        if quote:
+            if sql.startswith(quote, i):
+                current.append(quote)
+                i += len(quote)
+                quote = None
+                continue
+            current.append(ch)
+            i += 1
+            continue
+        if sql.startswith("--", i):
+            end = sql.find("\n", i)
+            i = len(sql) if end == -1 else end
+            continue
+        if ch in ("'", '"'):
+            quote = ch
+        elif ch == "$":
+            tag = re.match(r"\$[A-Za-z0-9_]*\$", sql[i:])
+            if tag:
+                quote = tag.group(0)
+                current.append(quote)
+                i += len(quote)
+                continue
+        elif ch == ";":
+            statement = "".join(current).strip()
+            if statement:
+                statements.append(statement)
+            current = []
+            i += 1
+            continue
+        current.append(ch)
+        i += 1
+    statement = "".join(current).strip()
+    if statement:
+        statements.append(statement)
+    return statements
+
+def apply(version: str):
+    """1つのマイグレーションを適用して記録する
+
+    CREATE INDEX CONCURRENTLY はトランザクション内で実行できないため、それを含むファイルは
+    1文ずつ自動コミットで実行する（途中で失敗した場合は IF NOT EXISTS などで再実行できるように書くこと）。
+    それ以外は1つのトランザクションで実行し、記録と同時にコミットする。
+    """
+    with open(os.path.join(MIGRATIONS_DIR, f"{version}.sql"), encoding="utf-8") as f:
+        statements = split_statements(f.read())
+
+    if any(_CONCURRENTLY.search(statement) for statement in statements):
+        db.session.commit()
+        with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            for statement in statements:
+                conn.exec_driver_sql(statement)
+        mark_applied(version)
+        db.session.commit()
+        return
+
+    try:
+        conn = db.session.connection()
+        for statement in statements:
+            # text() だと "::" のキャストがバインド変数として解釈されるのでそのまま渡す
+            conn.exec_driver_sql(statement)
+        mark_applied(version)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+def mark_applied(version: str):
+    db.session.merge(SchemaMigration(version=version, applied_at=datetime.utcnow()))
+
+def migrate(target: str = None) -> list:
+    """未適用のマイグレーションを順に適用する（target を指定した場合はそのバージョンまで）"""
+    applied = []
+    for version in pending_versions():
+        if target and version > target:
+            break
+        apply(version)
+        applied.append(version)
+    return applied
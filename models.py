@@ -1,8 +1,14 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql, sqlite
 from datetime import datetime
 
 db = SQLAlchemy()
 
+def dialect_insert(table):
+    """ON CONFLICT が使える INSERT 文（PostgreSQL、検証用の SQLite）"""
+    dialect = postgresql if db.engine.dialect.name == "postgresql" else sqlite
+    return dialect.insert(table)
+
 class User(db.Model):
     __tablename__ = 'users'
     
@@ -23,20 +29,30 @@ class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     image_path = db.Column(db.String(200), nullable=False)
+    # サイズ別の画像URL（images.variants_manifest の形式）。旧投稿は NULL
+    image_variants = db.Column(db.JSON, nullable=True)
     caption = db.Column(db.Text, nullable=False)
     price_range = db.Column(db.String(20), nullable=False)
     area = db.Column(db.String(100), nullable=False)
     store_name = db.Column(db.String(50), nullable=False)
     school = db.Column(db.String(100), nullable=True)
     google_maps_url = db.Column(db.String(300))
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # 検索用に正規化した「店名\n地域\n紹介文」（search.py が書き込み時に更新）
+    search_text = db.Column(db.Text, nullable=False, default='', server_default='')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # リレーションシップ
     likes = db.relationship('Like', backref='post', lazy=True, cascade='all, delete-orphan')
-    
-    @property
-    def like_count(self):
-        return len(self.likes)
+
+    # 一覧の並び（created_at, id の降順）と絞り込みに使うインデックス（sql/20261018_add_listing_indexes.sql）
+    # B-treeは逆順にも読めるので昇順で作る
+    __table_args__ = (
+        db.Index('ix_posts_created_at_id', 'created_at', 'id'),
+        db.Index('ix_posts_school_created_at_id', 'school', 'created_at', 'id'),
+        db.Index('ix_posts_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+        db.Index('ix_posts_like_count_created_at_id', 'like_count', 'created_at', 'id'),
+    )
 
 class Like(db.Model):
     __tablename__ = 'likes'
@@ -46,5 +62,10 @@ class Like(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    # ユニーク制約
-    __table_args__ = (db.UniqueConstraint('post_id', 'user_id'),)
\ No newline at end of file
+    # ユニーク制約（post_id での検索にも使われる）
+    __table_args__ = (
+        db.UniqueConstraint('post_id', 'user_id'),
+        db.Index('ix_likes_user_id', 'user_id'),
+        # CSVエクスポート（created_at の新しい順）
+        db.Index('ix_likes_created_at_id', 'created_at', 'id'),
+    )
\ No newline at end of file
@@ -0,0 +1,144 @@
+import os
+import random
+import threading
+import time
+from flask import g, has_app_context, request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# --- 設定 ---
+# 計測するリクエストの割合（0〜1）。0 なら計測しない（本番では 0.01 などで一部だけ計測する）
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+# ログに残す最も遅いSQL文の長さ
+PROFILE_STATEMENT_MAX_LEN = 300
+
+
+class RequestProfile:
+    """1リクエスト分の計測値"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+        self.template_seconds = 0.0
+        self._template_started = []
+
+    def add_statement(self, statement, seconds):
+        self.statements += 1
+        self.db_seconds += seconds
+        if seconds > self.slowest_seconds:
+            self.slowest_seconds = seconds
+            self.slowest_statement = statement
+
+    def server_timing(self, total_seconds) -> str:
+        return ", ".join([
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.statements} queries"',
+            f"tmpl;dur={self.template_seconds * 1000:.1f}",
+            f"total;dur={total_seconds * 1000:.1f}",
+        ])
+
+    def as_log(self, total_seconds) -> dict:
+        slowest = " ".join(self.slowest_statement.split()) if self.slowest_statement else None
+        return {
+            "method": request.method,
+            "path": request.path,
+            "endpoint": request.endpoint,
+            "total_ms": round(total_seconds * 1000, 1),
+            "db_statements": self.statements,
+            "db_ms": round(self.db_seconds * 1000, 1),
+            "slowest_ms": round(self.slowest_seconds * 1000, 1),
+            "slowest_statement": slowest[:PROFILE_STATEMENT_MAX_LEN] if slowest else None,
+            "template_ms": round(self.template_seconds * 1000, 1),
+        }
+
+
+def _current_profile():
+    # バックグラウンドスレッド（イベント・いいねの書き込み）は別の app_context なので g に計測値が無い
+    if not has_app_context():
+        return None
+    return g.get("_request_profile")
+
+
+class RequestProfiler:
+    """リクエストごとのSQL発行数・DB時間・最も遅いSQL・テンプレート描画時間を計測する
+
+    サンプリングされたリクエストだけ計測し、Server-Timing ヘッダー（ブラウザの開発者ツールで見られる）と
+    ログ1行（計測値は extra の項目として JSON 形式のログに含まれる）を出す。SQLの計測はエンジンのイベント、
+    テンプレートは Flask のシグナルで行うので、ルート側の変更は不要。
+    """
+
+    def __init__(self, sample_rate=PROFILE_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.app = None
+        self._lock = threading.Lock()
+        self.profiled = 0
+
+    def init_app(self, app, skip=None):
+        """skip: 計測しないリクエストを判定する関数（静的ファイルなど）"""
+        self.app = app
+        self.skip = skip
+        app.extensions["request_profiler"] = self
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        # 全エンジン共通（Flask-SQLAlchemy のエンジンは app_context 内で遅延生成されるため）
+        if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        before_render_template.connect(_before_render_template, app)
+        template_rendered.connect(_template_rendered, app)
+
+    def _sampled(self) -> bool:
+        if self.sample_rate <= 0:
+            return False
+        if self.skip is not None and self.skip():
+            return False
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def _before_request(self):
+        if self._sampled():
+            g._request_profile = RequestProfile()
+
+    def _after_request(self, response):
+        profile = g.pop("_request_profile", None)
+        if profile is None:
+            return response
+        total = time.perf_counter() - profile.started
+        response.headers["Server-Timing"] = profile.server_timing(total)
+        entry = profile.as_log(total)
+        self.app.logger.info(
+            f"request_profile {entry['method']} {entry['path']} total={entry['total_ms']}ms "
+            f"db={entry['db_ms']}ms/{entry['db_statements']} queries tmpl={entry['template_ms']}ms",
+            extra=entry,
+        )
+        with self._lock:
+            self.profiled += 1
+        return response
+
+    def stats(self) -> dict:
+        return {"sample_rate": self.sample_rate, "profiled": self.profiled}
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_profile() is not None:
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile()
+    started = conn.info.get("profile_started")
+    if profile is not None and started:
+        profile.add_statement(statement, time.perf_counter() - started.pop())
+
+def _before_render_template(sender, template, context, **extra):
+    profile = _current_profile()
+    if profile is not None:
+        profile._template_started.append(time.perf_counter())
+
+def _template_rendered(sender, template, context, **extra):
+    profile = _current_profile()
+    if profile is not None and profile._template_started:
+        profile.template_seconds += time.perf_counter() - profile._template_started.pop()
+
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,193 @@
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import desc, func
+from sqlalchemy.exc import SQLAlchemyError
+from models import db, Post
+
+# ランキングの表示件数
+RANKING_SIZE = 20
+
+OVERALL_SCOPE = "overall"
+SCHOOLS_SCOPE = "schools"
+
+# --- 集計済みランキングテーブル ---
+class RankingSnapshot(db.Model):
+    """ランキングの事前集計結果（scope ごとに1行）
+
+    - overall / school:<高校名>: [[post_id, like_count, created_at(ISO)], ...] をランキング順に保持
+    - schools: [[高校名, 投稿数], ...] を投稿数の多い順に保持
+    """
+    __tablename__ = "ranking_snapshots"
+    scope = db.Column(db.String(120), primary_key=True)
+    entries = db.Column(db.JSON, nullable=False, default=list)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+def school_scope(school: str) -> str:
+    return f"school:{school}"
+
+def _post_scopes(school):
+    scopes = [OVERALL_SCOPE]
+    if school:
+        scopes.append(school_scope(school))
+    return scopes
+
+def _entry_key(entry):
+    # いいね数 → 投稿日時 → ID の降順（ranking のクエリと同じ並び）
+    return (entry[1], entry[2], entry[0])
+
+def _schools_key(entry):
+    return (-entry[1], entry[0])
+
+# --- 全件再計算 ---
+def compute_scope(scope: str) -> list:
+    if scope == SCHOOLS_SCOPE:
+        rows = db.session.query(
+            Post.school,
+            func.count(Post.id).label("post_count")
+        ).filter(
+            Post.school.isnot(None),
+            Post.school != ""
+        ).group_by(Post.school).all()
+        return sorted(([r.school, r.post_count] for r in rows), key=_schools_key)
+
+    query = db.session.query(Post.id, Post.like_count, Post.created_at)
+    if scope.startswith("school:"):
+        query = query.filter(Post.school == scope[len("school:"):])
+    rows = query.order_by(desc(Post.like_count), desc(Post.created_at), desc(Post.id)) \
+                .limit(RANKING_SIZE).all()
+    return [[r.id, r.like_count, r.created_at.isoformat()] for r in rows]
+
+def _save(scope: str, entries: list) -> RankingSnapshot:
+    snapshot = db.session.get(RankingSnapshot, scope)
+    if snapshot is None:
+        snapshot = RankingSnapshot(scope=scope, entries=entries)
+        db.session.add(snapshot)
+    else:
+        snapshot.entries = entries
+        snapshot.updated_at = datetime.utcnow()
+    return snapshot
+
+def rebuild_scope(scope: str) -> RankingSnapshot:
+    return _save(scope, compute_scope(scope))
+
+def rebuild_all() -> int:
+    """全ランキングを作り直す（不要になった高校別ランキングは削除）"""
+    schools = rebuild_scope(SCHOOLS_SCOPE).entries
+    scopes = [OVERALL_SCOPE] + [school_scope(school) for school, _ in schools]
+    for scope in scopes:
+        rebuild_scope(scope)
+    RankingSnapshot.query.filter(
+        RankingSnapshot.scope.like("school:%"),
+        RankingSnapshot.scope.notin_(scopes)
+    ).delete(synchronize_session=False)
+    return len(scopes) + 1
+
+# --- 読み出し ---
+def get_entries(scope: str) -> list:
+    """主キーでランキングを読む。未作成なら作成して保存する"""
+    snapshot = db.session.get(RankingSnapshot, scope)
+    if snapshot is None:
+        snapshot = rebuild_scope(scope)
+        db.session.commit()
+    return snapshot.entries
+
+def get_ranked_post_ids(scope: str) -> list:
+    return [entry[0] for entry in get_entries(scope)]
+
+def get_schools_with_posts() -> list:
+    return [{"school": school, "post_count": count} for school, count in get_entries(SCHOOLS_SCOPE)]
+
+# --- 差分更新 ---
+def _locked_entries(scope: str):
+    # セッションに読み込み済みの古い entries を使わないよう、ロックを取った上で読み直す
+    snapshot = db.session.query(RankingSnapshot).filter_by(scope=scope) \
+        .with_for_update().populate_existing().first()
+    return None if snapshot is None else [list(e) for e in snapshot.entries]
+
+def _apply_score(scope: str, post_id: int, like_count: int, created_at: str):
+    entries = _locked_entries(scope)
+    if entries is None:
+        return  # 未作成のランキングは次回の読み出し時に作られる
+    entry = [post_id, like_count, created_at]
+    previous = next((e for e in entries if e[0] == post_id), None)
+    if previous is None and len(entries) >= RANKING_SIZE \
+            and _entry_key(entry) <= _entry_key(entries[-1]):
+        return  # ランキング圏外のまま
+    was_full = len(entries) >= RANKING_SIZE
+    entries = [e for e in entries if e[0] != post_id]
+    entries.append(entry)
+    entries.sort(key=_entry_key, reverse=True)
+
+    if previous and was_full and entries[-1][0] == post_id and like_count < previous[1]:
+        # 最下位まで落ちた場合は圏外の投稿に抜かれている可能性があるので再計算
+        rebuild_scope(scope)
+        return
+    _save(scope, entries[:RANKING_SIZE])
+
+def _remove_post(scope: str, post_id: int):
+    entries = _locked_entries(scope)
+    if entries is None or not any(e[0] == post_id for e in entries):
+        return
+    if len(entries) >= RANKING_SIZE:
+        # 繰り上がる投稿を知るために再計算
+        rebuild_scope(scope)
+    else:
+        _save(scope, [e for e in entries if e[0] != post_id])
+
+def _add_school_count(school: str, delta: int):
+    entries = _locked_entries(SCHOOLS_SCOPE)
+    if entries is None:
+        return
+    counts = dict((name, count) for name, count in entries)
+    counts[school] = counts.get(school, 0) + delta
+    if counts[school] <= 0:
+        del counts[school]
+        db.session.query(RankingSnapshot).filter_by(scope=school_scope(school)).delete()
+    _save(SCHOOLS_SCOPE, sorted(([name, count] for name, count in counts.items()), key=_schools_key))
+
+def _run_safely(fn, *args):
+    # ランキング更新の失敗で本来の書き込み（いいね・投稿）を失敗させない
+    try:
+        with db.session.begin_nested():
+            fn(*args)
+    except SQLAlchemyError as e:
+        current_app.logger.warning(f"Ranking update failed ({fn.__name__}): {e}")
+
+def _like_changed(post_id, school, like_count, created_at):
+    for scope in _post_scopes(school):
+        _apply_score(scope, post_id, like_count, created_at.isoformat())
+
+def _post_created(post):
+    for scope in _post_scopes(post.school):
+        _apply_score(scope, post.id, post.like_count or 0, post.created_at.isoformat())
+    if post.school:
+        _add_school_count(post.school, 1)
+
+def _post_deleted(post_id, school):
+    for scope in _post_scopes(school):
+        _remove_post(scope, post_id)
+    if school:
+        _add_school_count(school, -1)
+
+def _post_school_changed(post, old_school):
+    if old_school:
+        _remove_post(school_scope(old_school), post.id)
+        _add_school_count(old_school, -1)
+    if post.school:
+        _apply_score(school_scope(post.school), post.id, post.like_count or 0, post.created_at.isoformat())
+        _add_school_count(post.school, 1)
+
+def on_like_changed(post_id, school, like_count, created_at):
+    """いいね数が変わった投稿をランキングに反映（呼び出し元のトランザクション内）"""
+    _run_safely(_like_changed, post_id, school, like_count, created_at)
+
+def on_post_created(post):
+    """flush済みの新規投稿をランキングに反映"""
+    _run_safely(_post_created, post)
+
+def on_post_deleted(post_id, school):
+    _run_safely(_post_deleted, post_id, school)
+
+def on_post_school_changed(post, old_school):
+    if (old_school or None) != (post.school or None):
+        _run_safely(_post_school_changed, post, old_school)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""静的ファイル・ヘルスチェックの before_request 省略（ファストパス）の効果を測る
+
+ログイン済みセッション（Cookieあり）で各パスを叩き、ファストパスを無効にした場合
+（変更前の挙動）と有効にした場合の1リクエストあたりの時間とSQL発行数を比較する。
+
+    python scripts/bench_before_request.py [--requests 500]
+"""
+import argparse
+
+from bench_common import disable_request_limits, measure, reset_database, setup_environment
+
+setup_environment()
+
+import app as app_module
+from app import app
+
+PATHS = ['/static/style.css', '/robots.txt', '/health', '/uptimerobot']
+USER_ID = 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=500)
+    args = parser.parse_args()
+
+    disable_request_limits()
+    with app.app_context():
+        reset_database(viewer_ids=[USER_ID])
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = USER_ID
+
+    enabled_endpoints = set(app_module.FAST_PATH_ENDPOINTS)
+    for path in PATHS:
+        client.get(path)  # ウォームアップ
+        app_module.FAST_PATH_ENDPOINTS = set()
+        before = measure(client, path, args.requests)
+        app_module.FAST_PATH_ENDPOINTS = enabled_endpoints
+        after = measure(client, path, args.requests)
+        print(f'{path}')
+        print(f"  before: mean={before['mean_ms']}ms p95={before['p95_ms']}ms sql/req={before['statements_per_request']}")
+        print(f"  after : mean={after['mean_ms']}ms p95={after['p95_ms']}ms sql/req={after['statements_per_request']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""ベンチマーク・検証スクリプト共通の準備処理
+
+app をインポートする前に setup_environment() を呼ぶと、一時ディレクトリの
+SQLite と仮の Supabase 設定でアプリを起動できる。
+app を使うヘルパー（disable_request_limits など）は setup_environment() の後に呼ぶ。
+"""
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AD_USER_ID = 1
+HEADERS = {'User-Agent': 'Mozilla/5.0 (iPhone; Mobile) Safari'}
+
+
+def setup_environment(database_url=None):
+    """ローカル実行用の環境変数を設定し、リポジトリ直下を import パスに追加する"""
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('SUPABASE_URL', 'https://example.supabase.co')
+    os.environ.setdefault('SUPABASE_ANON_KEY', 'dummy')
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    # ログは標準エラー出力だけにする（リポジトリ直下に app.log を作らない）
+    os.environ.setdefault('LOG_FILE', '')
+    return database_url
+
+
+def disable_request_limits():
+    """既定のレート制限（100回/時）・CSRFトークンの確認を無効化する（同じクライアントで何百回も叩くため）"""
+    import app as app_module
+    app_module.limiter.enabled = False
+    app_module.app.config['WTF_CSRF_ENABLED'] = False
+
+
+def reset_database(viewer_ids=()):
+    """テーブルを作り直し、広告アカウント（ID=1）と閲覧ユーザーを登録する"""
+    from app import db
+    from models import User
+    db.drop_all()
+    db.create_all()
+    db.session.add(User(id=AD_USER_ID, username='【広告】', is_admin=True, is_advertiser=True))
+    for user_id in viewer_ids:
+        db.session.add(User(id=user_id, username=f'viewer {user_id}'))
+    db.session.commit()
+
+
+def new_post(post_id, user_id=AD_USER_ID, **fields):
+    """検証用の投稿（必須項目は仮の値。fields で上書きする）"""
+    from models import Post
+    values = dict(image_path=f'https://example.supabase.co/p{post_id}.jpg', caption='caption',
+                  price_range='〜500円', area='甲府市', store_name=f'店{post_id}')
+    values.update(fields)
+    return Post(id=post_id, user_id=user_id, **values)
+
+
+@contextmanager
+def recorded_statements():
+    """with の間にこのスレッドから発行されたSQLを (statement, parameters) の list に記録する
+
+    バックグラウンドの書き込み（クリック・いいね後の集計）の分は含めない。
+    """
+    from sqlalchemy import event
+    from app import app, db
+    statements = []
+    thread_id = threading.get_ident()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == thread_id:
+            statements.append((statement, parameters))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def measure(client, path, count, method='GET', before_each=None, **kwargs):
+    """time_requests で測り、summarize の結果に1リクエストあたりのSQL発行数を加えて返す"""
+    kwargs.setdefault('headers', HEADERS)
+    with recorded_statements() as statements:
+        durations = time_requests(client, path, count, method=method, before_each=before_each, **kwargs)
+    result = summarize(durations)
+    result['statements_per_request'] = round(len(statements) / count, 2)
+    return result
+
+
+def percentile(values, pct):
+    """最近傍法のパーセンタイル（values はソート不要）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def time_requests(client, path, count, method='GET', before_each=None, **kwargs):
+    """同じリクエストを count 回送り、1回ごとの所要時間（秒）のリストを返す
+
+    before_each: 各リクエストの前に呼ぶ関数（キャッシュを消すなど。所要時間には含めない）
+    """
+    durations = []
+    for _ in range(count):
+        if before_each is not None:
+            before_each()
+        started = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        durations.append(time.perf_counter() - started)
+        response.close()
+    return durations
+
+
+def summarize(durations):
+    total = sum(durations)
+    return {
+        'requests': len(durations),
+        'rps': round(len(durations) / total, 1) if total else None,
+        'mean_ms': round(total / len(durations) * 1000, 3) if durations else None,
+        'p50_ms': round(percentile(durations, 50) * 1000, 3) if durations else None,
+        'p95_ms': round(percentile(durations, 95) * 1000, 3) if durations else None,
+        'p99_ms': round(percentile(durations, 99) * 1000, 3) if durations else None,
+    }
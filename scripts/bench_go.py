@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""広告のリダイレクト（/go/<post_id>）の1秒あたりの処理数を測る
+
+広告投稿への /go を繰り返し叩き、広告情報がキャッシュ済みの場合（通常時）と
+毎回キャッシュが無い場合（必要な列だけのSELECTが走る）を比較する。
+最後にクリックのバッファを書き込み、記録漏れが無いことも確認する。
+
+    python scripts/bench_go.py [--requests 2000]
+"""
+import argparse
+import sys
+
+from bench_common import disable_request_limits, measure, new_post, reset_database, setup_environment
+
+setup_environment()
+
+from app import app, db
+from cache import post_info_cache
+from tracking_ad import MapClick, map_click_buffer
+
+POST_ID = 1
+GO_PATH = f'/go/{POST_ID}'
+# キャッシュが無い場合の1リクエストあたりのSQL発行数（ad_info_for_id の1文）
+COLD_STATEMENTS_MIN = 0.9
+COLD_STATEMENTS_MAX = 1.1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    disable_request_limits()
+    with app.app_context():
+        reset_database()
+        db.session.add(new_post(POST_ID, caption='長い紹介文' * 100, store_name='ベンチ食堂',
+                                google_maps_url='https://maps.app.goo.gl/example'))
+        db.session.commit()
+
+    client = app.test_client()
+    response = client.get(GO_PATH)  # ウォームアップ
+    assert response.status_code == 302, f'/go returned {response.status_code}'
+
+    warm = measure(client, GO_PATH, args.requests)
+    # 毎回キャッシュを消す（ttl を変えても保存済みの値の期限は変わらないため）
+    cold = measure(client, GO_PATH, args.requests, before_each=lambda: post_info_cache.invalidate(POST_ID))
+
+    for label, result in (('cached', warm), ('uncached', cold)):
+        print(f"{label:9}: {result['rps']} req/s mean={result['mean_ms']}ms "
+              f"p95={result['p95_ms']}ms p99={result['p99_ms']}ms sql/req={result['statements_per_request']}")
+
+    # キャッシュが無い場合は必要な列だけのSELECTが1回だけ走ること
+    if not COLD_STATEMENTS_MIN <= cold['statements_per_request'] <= COLD_STATEMENTS_MAX:
+        print(f"ERROR: uncached /go should issue one SELECT per request (sql/req={cold['statements_per_request']})")
+        sys.exit(1)
+
+    expected = 1 + 2 * args.requests
+    with app.app_context():
+        map_click_buffer.flush()
+        recorded = MapClick.query.filter_by(post_id=POST_ID).count()
+    print(f'map_clicks: {recorded} / {expected}')
+    if recorded != expected:
+        print('ERROR: some clicks were not recorded')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
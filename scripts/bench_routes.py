@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""主要なルートのスループットとレイテンシ（p50/p95/p99）を測り、結果をJSONで保存する
+
+件数を指定してユーザー・投稿・いいね・地図クリック・クーポン発行をDBに投入し、
+/、/search、/ranking、/like/<id>、/go/<id>、CSVエクスポートをそれぞれ繰り返し叩く。
+画像のストレージはローカルディレクトリに差し替えるので Supabase には接続しない。
+既定は一時ディレクトリのSQLite。--database-url でPostgreSQL（中身を作り直すので検証用DB）でも実行できる。
+乱数のシードを固定しているので、同じ引数なら同じデータで測れる。
+
+結果は bench_results/routes-<コミット>-<日時>.json に保存する。--compare に以前の結果を渡すと
+ルートごとの rps と p95 の差を表示する（コミット間の性能の比較用）。
+
+    python scripts/bench_routes.py [--posts 5000 --likes 50000 ...] [--requests 300]
+                                   [--database-url URL] [--output PATH] [--compare OLD.json]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+from bench_common import AD_USER_ID, HEADERS, ROOT, disable_request_limits, measure, reset_database, setup_environment
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--users', type=int, default=500)
+parser.add_argument('--posts', type=int, default=5000)
+parser.add_argument('--likes', type=int, default=50000)
+parser.add_argument('--map-clicks', type=int, default=100000)
+parser.add_argument('--coupons', type=int, default=5000)
+parser.add_argument('--requests', type=int, default=300, help='requests per route')
+parser.add_argument('--export-requests', type=int, default=10, help='requests per CSV export')
+parser.add_argument('--routes', default=None, help='comma-separated route names to run (default: all)')
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--database-url', default=None)
+parser.add_argument('--output', default=None)
+parser.add_argument('--compare', default=None, help='previous result JSON to compare against')
+args = parser.parse_args()
+
+setup_environment(args.database_url)
+os.environ['STORAGE_BACKEND'] = 'local'
+os.environ['LOCAL_STORAGE_DIR'] = tempfile.mkdtemp()
+
+import analytics
+import app as app_module
+import rankings
+from app import app, db
+from models import User, Post, Like
+from search import rebuild_search_text
+from storage import LocalStorage, set_storage
+from tracking_ad import MapClick, CouponEvent, map_click_buffer
+
+XHR_HEADERS = dict(HEADERS, **{'X-Requested-With': 'XMLHttpRequest'})
+INSERT_BATCH = 5000
+SCHOOLS = app_module.SCHOOLS
+AREAS = ['甲府市', '富士吉田市', '都留市', '山梨市', '韮崎市', '南アルプス市', '北杜市', '笛吹市']
+PRICES = app_module.PRICE_OPTIONS
+WORDS = ['ラーメン', 'カフェ', 'ほうとう', '定食', 'パン', 'スイーツ', '焼肉', 'うどん', 'カレー', '寿司']
+
+
+def insert_rows(table, rows):
+    for i in range(0, len(rows), INSERT_BATCH):
+        db.session.execute(table.insert(), rows[i:i + INSERT_BATCH])
+    db.session.commit()
+
+
+def unique_pairs(rng, count, post_ids, user_ids):
+    """(post_id, user_id) の重複しない組を count 個（組み合わせの数が上限）"""
+    count = min(count, len(post_ids) * len(user_ids))
+    pairs = set()
+    while len(pairs) < count:
+        pairs.add((rng.choice(post_ids), rng.choice(user_ids)))
+    return sorted(pairs)
+
+
+def seed():
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+
+    def recent(days=90):
+        return now - timedelta(seconds=rng.randrange(days * 86400))
+
+    reset_database()
+    insert_rows(User.__table__, [
+        dict(id=user_id, username=f'bench-{user_id}', is_admin=False, is_advertiser=False, created_at=recent())
+        for user_id in range(2, args.users + 2)
+    ])
+    user_ids = list(range(2, args.users + 2))
+
+    posts = []
+    for post_id in range(1, args.posts + 1):
+        # 約5%を広告投稿にする
+        is_ad = post_id % 20 == 0
+        word = rng.choice(WORDS)
+        posts.append(dict(
+            id=post_id, user_id=AD_USER_ID if is_ad else rng.choice(user_ids),
+            image_path=f'/static/uploads/bench-{post_id}.jpg',
+            caption=f'{word}がおいしいお店です。' * rng.randint(1, 5),
+            price_range=rng.choice(PRICES), area=rng.choice(AREAS), store_name=f'{word}店{post_id}',
+            school=rng.choice(SCHOOLS) if rng.random() < 0.8 else None,
+            google_maps_url='https://maps.app.goo.gl/bench' if is_ad else None,
+            like_count=0, search_text='', created_at=recent(),
+        ))
+    post_ids = [post['id'] for post in posts]
+    ad_post_ids = [post['id'] for post in posts if post['user_id'] == AD_USER_ID]
+
+    likes = [dict(post_id=post_id, user_id=user_id, created_at=recent())
+             for post_id, user_id in unique_pairs(rng, args.likes, post_ids, user_ids)]
+    for like in likes:
+        posts[like['post_id'] - 1]['like_count'] += 1
+    insert_rows(Post.__table__, posts)
+    insert_rows(Like.__table__, likes)
+    if ad_post_ids:
+        insert_rows(MapClick.__table__, [dict(post_id=rng.choice(ad_post_ids), created_at=recent())
+                                         for _ in range(args.map_clicks)])
+        insert_rows(CouponEvent.__table__, [dict(post_id=post_id, user_id=user_id, code='BENCH', created_at=recent())
+                                            for post_id, user_id in unique_pairs(rng, args.coupons, ad_post_ids, user_ids)])
+
+    # 一括INSERTでは作られない検索用テキスト・事前集計を作る
+    rebuild_search_text()
+    rankings.rebuild_all()
+    db.session.commit()
+    analytics.rebuild_rollups()
+    return {'ad_post_id': ad_post_ids[0] if ad_post_ids else None, 'school': posts[0]['school'] or SCHOOLS[0]}
+
+
+def routes(seeded):
+    """(名前, メソッド, パス, 管理者で叩くか, 回数, 追加の引数)"""
+    ad_post_id = seeded['ad_post_id']
+    result = [
+        ('index', 'GET', '/', False, args.requests, {}),
+        ('search_keyword', 'GET', '/search?q=ラーメン+甲府', False, args.requests, {}),
+        ('search_school', 'GET', f"/search?school={seeded['school']}", False, args.requests, {}),
+        ('ranking', 'GET', '/ranking', False, args.requests, {}),
+        ('ranking_school', 'GET', f"/ranking?type=school&school={seeded['school']}", False, args.requests, {}),
+        ('like', 'POST', '/like/1', False, args.requests, {'headers': XHR_HEADERS}),
+    ]
+    if ad_post_id:
+        result.append(('go', 'GET', f'/go/{ad_post_id}', False, args.requests, {}))
+    for name in ('map_clicks', 'coupon_events', 'posts', 'likes'):
+        # ストリーミングのレスポンスは本文を読み切るまでを測る
+        result.append((f'export_{name}', 'GET', f'/admin/export/{name}.csv', True, args.export_requests, {'buffered': True}))
+    if args.routes:
+        selected = set(args.routes.split(','))
+        result = [route for route in result if route[0] in selected]
+    return result
+
+
+def run(client, method, path, count, **kwargs):
+    kwargs.setdefault('headers', HEADERS)
+    # 初回だけのキャッシュ作成を除くため1回叩いてから測る
+    response = client.open(path, method=method, **kwargs)
+    assert response.status_code in (200, 302), f'{method} {path} returned {response.status_code}'
+    response.close()
+    return measure(client, path, count, method=method, **kwargs)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    with open(path, encoding='utf-8') as f:
+        previous = json.load(f)
+    print(f"\ncompared with {path} (commit {previous['meta'].get('commit')})")
+    for name, result in results.items():
+        old = previous['results'].get(name)
+        if not old or not old.get('rps') or not old.get('p95_ms'):
+            continue
+        rps_change = (result['rps'] - old['rps']) / old['rps'] * 100
+        p95_change = (result['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100
+        print(f'{name:16}: rps {old["rps"]} -> {result["rps"]} ({rps_change:+.1f}%)  '
+              f'p95 {old["p95_ms"]} -> {result["p95_ms"]}ms ({p95_change:+.1f}%)')
+
+
+def main():
+    disable_request_limits()
+    set_storage(LocalStorage(os.environ['LOCAL_STORAGE_DIR']))
+
+    with app.app_context():
+        seeded = seed()
+
+    viewer = app.test_client()
+    with viewer.session_transaction() as sess:
+        sess['user_id'] = 2
+    admin = app.test_client()
+    with admin.session_transaction() as sess:
+        sess['user_id'] = AD_USER_ID
+        sess['is_admin'] = True
+
+    results = {}
+    for name, method, path, as_admin, count, kwargs in routes(seeded):
+        result = run(admin if as_admin else viewer, method, path, count, **kwargs)
+        results[name] = result
+        print(f"{name:16}: {result['rps']} req/s p50={result['p50_ms']}ms p95={result['p95_ms']}ms "
+              f"p99={result['p99_ms']}ms sql/req={result['statements_per_request']}")
+
+    with app.app_context():
+        map_click_buffer.flush()
+        dialect = db.engine.dialect.name
+
+    commit = git_commit()
+    output = args.output or os.path.join(
+        ROOT, 'bench_results', f"routes-{commit or 'unknown'}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'meta': {
+                'commit': commit,
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'python': sys.version.split()[0],
+                'database': dialect,
+                'volumes': {'users': args.users, 'posts': args.posts, 'likes': args.likes,
+                            'map_clicks': args.map_clicks, 'coupons': args.coupons},
+                'requests': args.requests,
+                'export_requests': args.export_requests,
+                'seed': args.seed,
+            },
+            'results': results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f'saved {output}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
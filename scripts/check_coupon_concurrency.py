@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""クーポン発行の同時リクエストで重複が出ないことを確認する
+
+複数ユーザーがそれぞれ同じ広告のクーポンを同時に何回も開き、coupon_events に
+ユーザー×投稿ごとにちょうど1件だけ記録され、コードが表示されるのも1回だけであることを確認する。
+既定は一時ディレクトリのSQLite。--database-url でPostgreSQL（検証用DB）でも実行できる。
+
+    python scripts/check_coupon_concurrency.py [--users 5] [--taps 8] [--database-url URL]
+"""
+import argparse
+import threading
+
+from bench_common import HEADERS, disable_request_limits, new_post, reset_database, setup_environment
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--users', type=int, default=5)
+parser.add_argument('--taps', type=int, default=8, help='parallel requests per user')
+parser.add_argument('--database-url', default=None)
+args = parser.parse_args()
+
+setup_environment(args.database_url)
+
+from sqlalchemy import func
+
+from app import app, db
+from tracking_ad import CouponEvent
+
+POST_ID = 1
+
+
+def seed(user_ids):
+    reset_database(viewer_ids=user_ids)
+    db.session.add(new_post(POST_ID, store_name='同時検証店'))
+    db.session.commit()
+
+
+def tap(user_id, barrier, results):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+    barrier.wait()
+    response = client.get(f'/coupon/{POST_ID}', headers=HEADERS)
+    body = response.get_data(as_text=True)
+    results.append((user_id, response.status_code, 'クーポン使用済み' not in body))
+
+
+def check(label, condition):
+    print(f"{'OK' if condition else 'NG'}: {label}")
+    return condition
+
+
+def main():
+    disable_request_limits()
+    user_ids = [100 + i for i in range(args.users)]
+    with app.app_context():
+        seed(user_ids)
+
+    barrier = threading.Barrier(args.users * args.taps)
+    results = []
+    threads = [threading.Thread(target=tap, args=(user_id, barrier, results))
+               for user_id in user_ids for _ in range(args.taps)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        counts = dict(db.session.query(CouponEvent.user_id, func.count(CouponEvent.id))
+                      .filter(CouponEvent.post_id == POST_ID)
+                      .group_by(CouponEvent.user_id).all())
+
+    ok = True
+    ok &= check('all requests succeeded', all(status == 200 for _, status, _ in results))
+    ok &= check('exactly one coupon_event per user', all(counts.get(user_id) == 1 for user_id in user_ids))
+    shown = {user_id: sum(1 for uid, _, issued in results if uid == user_id and issued) for user_id in user_ids}
+    ok &= check('code shown once per user, "used" for the other taps', all(n == 1 for n in shown.values()))
+    print('OK' if ok else 'NG')
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""一覧ページのSQL発行数が表示件数に依存しないことを確認する（SQLiteで実行）
+
+広告投稿の件数を変えて同じページを描画し、発行されたSQL文の数が
+変わらないこと（N+1になっていないこと）をチェックする。
+いいね（/like）の1タップが LIKE_MAX_STATEMENTS 文以内で終わることも確認する。
+
+    python scripts/check_query_counts.py
+"""
+import sys
+from datetime import datetime, timedelta
+
+from bench_common import disable_request_limits, new_post, recorded_statements, reset_database, setup_environment
+
+setup_environment()
+
+from app import app, db
+from cache import app_cache
+from tracking_ad import CouponEvent
+
+PAGES = ['/', '/ranking', '/advertisements']
+VIEWER_ID = 2
+LIKE_PATH = '/like/1'
+# ユーザーの読み込み + 付け外し（PostgreSQLでは1文のCTE、SQLiteでは 投稿の確認・DELETE・INSERT・UPDATE）
+# 集計・ランキングの更新はバックグラウンド（likes.like_hook_buffer）なので含まない
+LIKE_MAX_STATEMENTS = 5
+
+
+def seed(ad_post_count):
+    reset_database(viewer_ids=[VIEWER_ID])
+    base = datetime(2025, 1, 1)
+    for i in range(1, ad_post_count + 1):
+        db.session.add(new_post(i, created_at=base + timedelta(minutes=i)))
+    db.session.commit()
+    # 半分の広告でクーポン使用済みにする
+    for i in range(1, ad_post_count + 1, 2):
+        db.session.add(CouponEvent(post_id=i, user_id=VIEWER_ID, code='TEST'))
+    db.session.commit()
+
+
+def count_statements(client, path, method='GET', **kwargs):
+    # 初回描画で作られるキャッシュ・集計の影響を除くため、一度描画してから数える
+    client.open(path, method=method, **kwargs)
+    with recorded_statements() as statements:
+        response = client.open(path, method=method, **kwargs)
+    assert response.status_code == 200, f'{path} returned {response.status_code}'
+    return len(statements)
+
+
+def main():
+    disable_request_limits()
+    results = {}
+    for ad_post_count in (2, 12):
+        with app.app_context():
+            seed(ad_post_count)
+        app_cache.clear()
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = VIEWER_ID
+        results[ad_post_count] = {path: count_statements(client, path) for path in PAGES}
+
+    failed = False
+    for path in PAGES:
+        small, large = results[2][path], results[12][path]
+        status = 'OK' if small == large else 'NG'
+        failed |= small != large
+        print(f'{status}: {path} statements={small} (2 ads) / {large} (12 ads)')
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = VIEWER_ID
+    like_statements = count_statements(client, LIKE_PATH, method='POST',
+                                       headers={'X-Requested-With': 'XMLHttpRequest'})
+    like_ok = like_statements <= LIKE_MAX_STATEMENTS
+    print(f"{'OK' if like_ok else 'NG'}: POST {LIKE_PATH} statements={like_statements} (max {LIKE_MAX_STATEMENTS})")
+
+    if failed:
+        print('ERROR: statement count grows with the number of rendered posts')
+        sys.exit(1)
+    if not like_ok:
+        print('ERROR: a like issues more statements than expected')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""一覧系のクエリが全件スキャンになっていないことを実行計画で確認する
+
+ホーム（フィードの次ページ）・検索（高校で絞り込み）・アカウント・広告一覧・ランキングを描画し、
+発行された SELECT 文をそれぞれ EXPLAIN して posts / likes / coupon_events を全件読んでいないかを調べる。
+インデックスが無い・使われない形のクエリを追加した場合に NG になる。
+
+- SQLite（既定）: EXPLAIN QUERY PLAN で「SCAN <表>」（インデックスを使わない走査）を検出
+- PostgreSQL: 件数が少なくても計画がインデックスを選ぶよう enable_seqscan を切った上で「Seq Scan on <表>」を検出
+  （--database-url に検証用DBを指定。先に flask db-migrate でインデックスを作っておくこと）
+
+    python scripts/check_query_plans.py [--database-url URL]
+"""
+import argparse
+import re
+import sys
+from datetime import datetime, timedelta
+
+from bench_common import AD_USER_ID, disable_request_limits, new_post, recorded_statements, reset_database, setup_environment
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--database-url', default=None)
+args = parser.parse_args()
+
+setup_environment(args.database_url)
+
+from app import app, db
+from cache import app_cache
+from models import Like
+from tracking_ad import CouponEvent
+
+VIEWER_ID = 2
+SCHOOL = '甲府第一高校'
+PAGES = [
+    '/',
+    '/search?school=' + SCHOOL,
+    '/account',
+    '/advertisements',
+    '/ranking',
+    '/ranking?type=school&school=' + SCHOOL,
+]
+# 行数が投稿数に比例してよいテーブル
+CHECKED_TABLES = ('posts', 'likes', 'coupon_events')
+# 全件読むのが正しいクエリ（SQLiteの検索用 n-gram インデックスの構築）
+ALLOWED_FULL_SCANS = [
+    re.compile(r'^SELECT posts\.id, posts\.search_text\s+FROM posts$'),
+]
+
+
+def seed(post_count=300):
+    reset_database(viewer_ids=[VIEWER_ID])
+    base = datetime(2025, 1, 1)
+    for i in range(1, post_count + 1):
+        db.session.add(new_post(
+            i, user_id=AD_USER_ID if i % 10 == 0 else VIEWER_ID,
+            school=SCHOOL if i % 3 == 0 else 'その他の高校', like_count=i % 7,
+            created_at=base + timedelta(minutes=i)
+        ))
+    db.session.commit()
+    for i in range(1, post_count + 1, 4):
+        db.session.add(Like(post_id=i, user_id=VIEWER_ID))
+    for i in range(10, post_count + 1, 20):
+        db.session.add(CouponEvent(post_id=i, user_id=VIEWER_ID, code='TEST'))
+    db.session.commit()
+
+
+def capture_selects(client, paths):
+    """paths を描画し、発行された SELECT 文と引数を (statement, parameters) の list で返す"""
+    with recorded_statements() as statements:
+        for path in paths:
+            response = client.get(path)
+            assert response.status_code == 200, f'{path} returned {response.status_code}'
+    captured = {}
+    for statement, parameters in statements:
+        if statement.lstrip().upper().startswith('SELECT'):
+            captured.setdefault(statement, parameters)
+    return list(captured.items())
+
+
+def full_scans(conn, statement, parameters):
+    """statement の実行計画のうち、CHECKED_TABLES を全件走査している行を返す"""
+    if conn.dialect.name == 'postgresql':
+        plan = [row[0] for row in conn.exec_driver_sql('EXPLAIN ' + statement, parameters)]
+        pattern = re.compile(r'Seq Scan on (\w+)')
+    else:
+        plan = [row[-1] for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+        pattern = re.compile(r'\bSCAN (?:TABLE )?(\w+)\b(?! USING)')
+    return [line.strip() for line in plan
+            if (match := pattern.search(line)) and match.group(1) in CHECKED_TABLES]
+
+
+def main():
+    disable_request_limits()
+    with app.app_context():
+        seed()
+    app_cache.clear()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = VIEWER_ID
+    # 2ページ目のカーソル付きフィードも対象にする
+    first_page = client.get('/').get_data(as_text=True)
+    cursor = re.search(r'data-next-cursor="([^"]+)"', first_page)
+    paths = PAGES + ([f'/?cursor={cursor.group(1)}'] if cursor else [])
+    statements = capture_selects(client, paths)
+
+    failed = False
+    with app.app_context():
+        with db.engine.connect() as conn:
+            if conn.dialect.name == 'postgresql':
+                conn.exec_driver_sql('SET enable_seqscan = off')
+            for statement, parameters in statements:
+                one_line = ' '.join(statement.split())
+                if any(pattern.match(one_line) for pattern in ALLOWED_FULL_SCANS):
+                    continue
+                scans = full_scans(conn, statement, parameters)
+                if scans:
+                    failed = True
+                    print(f'NG: {one_line[:160]}')
+                    for line in scans:
+                        print(f'      {line}')
+    print(f'checked {len(statements)} statements from {len(paths)} pages')
+
+    if failed:
+        print('ERROR: some listing queries scan a whole table (add or fix an index)')
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""画像のアップロード・削除ジョブ（jobs.py）の動作確認（SQLite + ローカルストレージで実行）
+
+- 投稿リクエストはストレージに触れずにジョブを登録するだけであること
+- ジョブ実行でサイズ別画像が保存され、投稿に記録されること
+- ストレージの一時的な失敗は再試行されること
+- 投稿削除（画像処理前の削除を含む）で画像が残らないこと
+- 壊れた画像は投稿時に弾かれ、変換に失敗したジョブの投稿は準備中のまま残らないこと
+
+    python scripts/check_storage_jobs.py
+"""
+import io
+import os
+import tempfile
+
+from bench_common import disable_request_limits, reset_database, setup_environment
+
+setup_environment()
+STORAGE_DIR = tempfile.mkdtemp()
+os.environ['STORAGE_BACKEND'] = 'local'
+os.environ['LOCAL_STORAGE_DIR'] = STORAGE_DIR
+# バックグラウンドのスレッドは使わず、run_pending() で同期的に処理する
+os.environ['JOB_WORKER_THREADS'] = '0'
+
+from PIL import Image
+
+import jobs
+from app import app, db
+from models import Post
+from storage import LocalStorage, set_storage
+
+HEADERS = {'User-Agent': 'Mozilla/5.0 (check_storage_jobs)'}
+
+
+class FlakyStorage(LocalStorage):
+    """最初の fail_count 回のアップロードを失敗させる"""
+
+    def __init__(self, root, fail_count):
+        super().__init__(root)
+        self.fail_count = fail_count
+        self.calls = 0
+
+    def upload(self, key, data, content_type):
+        self.calls += 1
+        if self.calls <= self.fail_count:
+            raise OSError('simulated storage outage')
+        return super().upload(key, data, content_type)
+
+
+def jpeg_bytes(width=2000, height=1500):
+    buf = io.BytesIO()
+    Image.new('RGB', (width, height), (180, 120, 60)).save(buf, 'JPEG', quality=95)
+    return buf.getvalue()
+
+
+def post_image(client, data=None, filename='photo.jpg'):
+    return client.post('/post', data={
+        'image': (io.BytesIO(data or jpeg_bytes()), filename),
+        'price_range': '〜500円', 'area': '甲府市', 'store_name': '検証店', 'caption': 'check',
+    }, content_type='multipart/form-data', headers=HEADERS)
+
+
+def create_post(client, data=None, filename='photo.jpg'):
+    response = post_image(client, data, filename)
+    assert response.status_code == 302, f'/post returned {response.status_code}'
+    with app.app_context():
+        return Post.query.order_by(Post.id.desc()).first().id
+
+
+def stored_files():
+    return sorted(os.listdir(STORAGE_DIR))
+
+
+def check(label, condition):
+    print(f"{'OK' if condition else 'NG'}: {label}")
+    return condition
+
+
+def main():
+    disable_request_limits()
+    jobs.JOB_RETRY_BASE_SECONDS = 0
+    with app.app_context():
+        reset_database()
+
+    client = app.test_client()
+    ok = True
+
+    # 1. 投稿 → ジョブ実行 → サイズ別画像が保存される
+    post_id = create_post(client)
+    with app.app_context():
+        post = db.session.get(Post, post_id)
+        ok &= check('post is saved before any upload', post.image_variants == {'pending': True} and stored_files() == [])
+        ok &= check('page renders while image is pending', 'post-image-pending' in client.get('/', headers=HEADERS).get_data(as_text=True))
+        ok &= check('jobs run', jobs.run_pending() == (1, 0))
+        post = db.session.get(Post, post_id)
+        ok &= check('4 variants stored', len(stored_files()) == 4 and post.image_variants['thumb']['width'] == 480)
+        ok &= check('image_path points at medium jpeg', post.image_path.endswith('_medium.jpg'))
+
+    # 2. 一時的な失敗は再試行される
+    set_storage(FlakyStorage(STORAGE_DIR, fail_count=1))
+    flaky_post_id = create_post(client)
+    with app.app_context():
+        ok &= check('first attempt fails and is rescheduled', jobs.run_pending(limit=1) == (0, 1))
+        ok &= check('retry succeeds', jobs.run_pending() == (1, 0))
+        ok &= check('retried post has variants', 'thumb' in db.session.get(Post, flaky_post_id).image_variants)
+    set_storage(LocalStorage(STORAGE_DIR))
+
+    # 3. 投稿削除で全サイズの画像が消える
+    for pid in (post_id, flaky_post_id):
+        client.post(f'/delete_post/{pid}', headers=HEADERS)
+    with app.app_context():
+        jobs.run_pending()
+    ok &= check('deleting posts removes their images', stored_files() == [])
+
+    # 4. 画像処理前に削除された投稿の画像も残らない
+    early_post_id = create_post(client)
+    client.post(f'/delete_post/{early_post_id}', headers=HEADERS)
+    with app.app_context():
+        jobs.run_pending()
+        ok &= check('no images left for a post deleted before processing', stored_files() == [])
+        ok &= check('job table is empty', jobs.job_counts() == {})
+
+    # 5. 途中で切れた画像（ヘッダーの検証は通る）は投稿時に弾かれる
+    with app.app_context():
+        posts_before = Post.query.count()
+    response = post_image(client, data=jpeg_bytes()[:2000])
+    with app.app_context():
+        ok &= check('truncated image is rejected on upload',
+                    response.status_code == 200 and Post.query.count() == posts_before and jobs.job_counts() == {})
+
+    # 6. 変換できなかったジョブは再試行せずに failed になり、投稿は「表示できない」状態になる
+    broken_post_id = create_post(client)
+    with app.app_context():
+        jobs.StorageJob.query.filter_by(kind=jobs.JOB_PROCESS_POST_IMAGE).update({'data': jpeg_bytes()[:2000]})
+        db.session.commit()
+        ok &= check('broken image fails without retry', jobs.run_pending() == (0, 1))
+        ok &= check('failed job is kept for inspection', jobs.job_counts() == {jobs.JOB_STATUS_FAILED: 1})
+        ok &= check('post is marked as failed', db.session.get(Post, broken_post_id).image_variants == {'failed': True})
+        ok &= check('page renders the failed image', 'post-image-failed' in client.get('/', headers=HEADERS).get_data(as_text=True))
+        ok &= check('retry puts the post back to pending',
+                    jobs.retry_failed() == 1 and db.session.get(Post, broken_post_id).image_variants == {'pending': True})
+
+    print('OK' if ok else 'NG')
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,233 @@
+import hashlib
+import html
+import json
+import re
+import threading
+import unicodedata
+from sqlalchemy import event, desc, func
+from models import db, Post
+from cache import app_cache, CACHE_PREFIX_SEARCH
+
+# 1回の検索で返す最大件数（関連度順の上位）
+SEARCH_RESULT_LIMIT = 200
+
+# 検索結果の1ページあたりの件数
+SEARCH_PAGE_SIZE = 20
+
+# 検索結果（投稿IDの並びと各ページの表示用の行）をキャッシュする秒数。投稿の書き込みでも無効化される
+SEARCH_CACHE_TTL = 120
+
+# PostgreSQL以外（SQLiteでの検証）で使うN-gramの長さ
+NGRAM_SIZE = 2
+
+# search_text の各行の重み（店名 > 地域 > 紹介文）。SQLiteの関連度計算で使う
+FIELD_WEIGHTS = (3, 2, 1)
+
+# --- 正規化 ---
+# カタカナ → ひらがな（ァ〜ヶ）
+_KATAKANA_TO_HIRAGANA = {cp: cp - 0x60 for cp in range(0x30A1, 0x30F7)}
+_SPACES = re.compile(r"\s+")
+
+def normalize_text(text) -> str:
+    """検索用の正規化
+
+    全角英数・半角カナの統一（NFKC）、小文字化、カタカナのひらがな化、空白の圧縮。
+    「ｶﾌｪ」「カフェ」「かふぇ」や「ＣＡＦＥ」「cafe」を同じ文字列にする。
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text).lower().translate(_KATAKANA_TO_HIRAGANA)
+    return _SPACES.sub(" ", text).strip()
+
+def search_terms(*queries) -> list:
+    """検索語を正規化して空白で分割（重複は除く）"""
+    terms = []
+    for query in queries:
+        for term in normalize_text(query).split(" "):
+            if term and term not in terms:
+                terms.append(term)
+    return terms
+
+def build_search_text(store_name, area, caption) -> str:
+    # 1行目: 店名 / 2行目: 地域 / 3行目: 紹介文（投稿時にHTMLエスケープされているので戻してから正規化）
+    return "\n".join(normalize_text(html.unescape(value or "")) for value in (store_name, area, caption))
+
+@event.listens_for(Post, "before_insert")
+@event.listens_for(Post, "before_update")
+def _update_search_text(mapper, connection, target):
+    target.search_text = build_search_text(target.store_name, target.area, target.caption)
+
+
+# --- N-gramインデックス（SQLite用） ---
+def _ngrams(text, n=NGRAM_SIZE):
+    if len(text) < n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+class NgramIndex:
+    """Pythonだけで作る転置インデックス（PostgreSQLの pg_trgm の代わり）
+
+    投稿の書き込みで無効化し、次の検索時に作り直す。テスト・ローカル検証用。
+    """
+
+    def __init__(self, n=NGRAM_SIZE):
+        self.n = n
+        self._postings = {}
+        self._texts = {}
+        self._built = False
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._built = False
+
+    def _build(self):
+        postings = {}
+        texts = {}
+        for post_id, text in db.session.query(Post.id, Post.search_text):
+            text = text or ""
+            texts[post_id] = text
+            for gram in _ngrams(text, self.n) | set(text):
+                postings.setdefault(gram, set()).add(post_id)
+        self._postings = postings
+        self._texts = texts
+        self._built = True
+
+    def search(self, terms) -> dict:
+        """全ての検索語を含む投稿の {post_id: 関連度}"""
+        with self._lock:
+            if not self._built:
+                self._build()
+            candidates = None
+            for term in terms:
+                # 1文字の語は文字単位、それ以外はN-gramの積集合で候補を絞る
+                grams = set(term) if len(term) < self.n else _ngrams(term, self.n)
+                for gram in grams:
+                    ids = self._postings.get(gram, set())
+                    candidates = ids.copy() if candidates is None else candidates & ids
+                    if not candidates:
+                        return {}
+            scores = {}
+            for post_id in candidates or ():
+                fields = self._texts[post_id].split("\n")
+                score = 0
+                for term in terms:
+                    hits = [weight * field.count(term) for weight, field in zip(FIELD_WEIGHTS, fields)]
+                    if not any(hits):
+                        # N-gramは含むが語としては含まない
+                        score = None
+                        break
+                    score += sum(hits)
+                if score is not None:
+                    scores[post_id] = score
+            return scores
+
+_ngram_index = NgramIndex()
+
+@event.listens_for(Post, "after_insert")
+@event.listens_for(Post, "after_update")
+@event.listens_for(Post, "after_delete")
+def _invalidate_ngram_index(mapper, connection, target):
+    _ngram_index.invalidate()
+
+
+# --- 検索 ---
+def _escape_like(term):
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _apply_filters(query, price_range=None, school=None):
+    if price_range:
+        query = query.filter(Post.price_range == price_range)
+    if school:
+        query = query.filter(Post.school == school)
+    return query
+
+def search_post_ids(terms, price_range=None, school=None, limit=SEARCH_RESULT_LIMIT) -> list:
+    """条件に合う投稿IDを関連度順（同じなら新しい順）で返す
+
+    PostgreSQL: search_text の pg_trgm インデックス（GIN）で LIKE を絞り込み、word_similarity で並べる。
+    それ以外: NgramIndex で絞り込み、店名・地域・紹介文の出現回数で並べる。
+    """
+    if not terms:
+        query = _apply_filters(db.session.query(Post.id), price_range, school)
+        return [row.id for row in query.order_by(desc(Post.created_at), desc(Post.id)).limit(limit)]
+
+    if db.engine.dialect.name == "postgresql":
+        query = db.session.query(Post.id).filter(
+            *[Post.search_text.like(f"%{_escape_like(term)}%", escape="\\") for term in terms]
+        )
+        query = _apply_filters(query, price_range, school)
+        relevance = sum(func.word_similarity(term, Post.search_text) for term in terms)
+        return [row.id for row in query.order_by(desc(relevance), desc(Post.created_at), desc(Post.id)).limit(limit)]
+
+    scores = _ngram_index.search(terms)
+    if not scores:
+        return []
+    query = _apply_filters(db.session.query(Post.id, Post.created_at).filter(Post.id.in_(list(scores))), price_range, school)
+    rows = sorted(query, key=lambda row: (scores[row.id], row.created_at, row.id), reverse=True)
+    return [row.id for row in rows[:limit]]
+
+def search_cache_key(terms, price_range=None, school=None) -> str:
+    """検索条件のキャッシュキー
+
+    検索語は正規化済み（search_terms）のものを並べ替えて使うので、語順や表記ゆれが
+    違うだけの検索（「甲府 カフェ」と「ｶﾌｪ　甲府」）は同じキーになる。
+    """
+    criteria = json.dumps([sorted(terms), price_range or "", school or ""], ensure_ascii=False)
+    return CACHE_PREFIX_SEARCH + hashlib.sha1(criteria.encode("utf-8")).hexdigest()
+
+def cached_search_post_ids(terms, price_range=None, school=None) -> list:
+    """search_post_ids の結果をプロセス内キャッシュ（cache.app_cache）経由で返す"""
+    return app_cache.get_or_set(
+        search_cache_key(terms, price_range, school),
+        lambda: search_post_ids(terms, price_range=price_range, school=school),
+        ttl=SEARCH_CACHE_TTL,
+    )
+
+def cached_page_rows(page_ids, loader) -> list:
+    """1ページ分の投稿の表示用の行（loader(page_ids) の結果）を、投稿IDの並びごとにキャッシュして返す
+
+    よく使われる検索でページを開くたびに posts を読まないようにする。いいね数はキャッシュの間
+    （最大 SEARCH_CACHE_TTL 秒）古いことがある。閲覧者がいいね済みかどうかは呼び出し側で毎回調べる。
+    """
+    key = "rows:" + ",".join(str(post_id) for post_id in page_ids)
+    return app_cache.get_or_set(
+        CACHE_PREFIX_SEARCH + hashlib.sha1(key.encode("utf-8")).hexdigest(),
+        lambda: loader(page_ids),
+        ttl=SEARCH_CACHE_TTL,
+    )
+
+def paginate_post_ids(post_ids, cursor=None, page_size=SEARCH_PAGE_SIZE):
+    """並び順の決まった投稿IDから1ページ分を切り出し、(page_ids, next_cursor) を返す
+
+    カーソルは前のページの最後の投稿ID。件数のオフセットではないので、ページの間に
+    結果が増減しても続きの位置がずれない。カーソルが不正・結果に無い場合は None。
+    """
+    start = 0
+    if cursor:
+        try:
+            start = post_ids.index(int(cursor)) + 1
+        except ValueError:
+            return None
+    page_ids = post_ids[start:start + page_size]
+    next_cursor = str(page_ids[-1]) if page_ids and start + page_size < len(post_ids) else None
+    return page_ids, next_cursor
+
+def rebuild_search_text(batch_size=500) -> int:
+    """全投稿の search_text を作り直す（正規化ルールの変更時・既存データの移行用）"""
+    updated = 0
+    last_id = 0
+    while True:
+        posts = Post.query.filter(Post.id > last_id).order_by(Post.id).limit(batch_size).all()
+        if not posts:
+            break
+        for post in posts:
+            search_text = build_search_text(post.store_name, post.area, post.caption)
+            if post.search_text != search_text:
+                post.search_text = search_text
+                updated += 1
+        db.session.commit()
+        last_id = posts[-1].id
+    _ngram_index.invalidate()
+    app_cache.invalidate_prefix(CACHE_PREFIX_SEARCH)
+    return updated
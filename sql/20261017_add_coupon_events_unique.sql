@@ -0,0 +1,16 @@
+-- クーポン発行を1ユーザー1投稿につき1件に制限する一意インデックスを追加
+-- 実行日: 2026-10-17
+-- 発行は INSERT ... ON CONFLICT (post_id, user_id) DO NOTHING RETURNING id で行う（tracking_ad.issue_coupon）
+
+-- 同時アクセスで重複した既存の発行記録は、最初の1件だけ残して削除
+DELETE FROM coupon_events a
+USING coupon_events b
+WHERE a.post_id = b.post_id
+  AND a.user_id = b.user_id
+  AND a.id > b.id;
+
+-- CONCURRENTLY は書き込みを止めずに作成できる（トランザクション外で実行すること）
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_coupon_events_post_user
+ON coupon_events (post_id, user_id);
+
+-- 重複を削除した場合は flask rebuild-ad-stats で集計を作り直す
@@ -0,0 +1,7 @@
+-- postsテーブルにサイズ別画像（サムネイル・詳細用）のURLを保存するカラムを追加
+-- 実行日: 2026-10-17
+-- 形式: {"thumb": {"width": 480, "height": 360, "webp": "...", "jpeg": "..."}, "medium": {...}}
+-- 既存の投稿は NULL のまま（テンプレートは image_path にフォールバックする）
+
+ALTER TABLE posts
+ADD COLUMN IF NOT EXISTS image_variants JSON;
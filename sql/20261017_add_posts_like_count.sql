@@ -0,0 +1,17 @@
+-- postsテーブルにいいね数の非正規化カラムを追加
+-- 実行日: 2026-10-17
+
+ALTER TABLE posts
+ADD COLUMN IF NOT EXISTS like_count INTEGER NOT NULL DEFAULT 0;
+
+-- 既存の投稿のいいね数をlikesテーブルから埋める
+-- （以後のずれは flask reconcile-like-counts で修正できる）
+UPDATE posts
+SET like_count = sub.cnt
+FROM (
+    SELECT post_id, COUNT(*) AS cnt
+    FROM likes
+    GROUP BY post_id
+) AS sub
+WHERE posts.id = sub.post_id
+  AND posts.like_count <> sub.cnt;
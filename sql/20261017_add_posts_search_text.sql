@@ -0,0 +1,16 @@
+-- 検索用の正規化テキストとトライグラムインデックスを追加
+-- 実行日: 2026-10-17
+-- search_text は「店名\n地域\n紹介文」をNFKC・小文字・ひらがなに揃えたもの（search.py）
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE posts
+ADD COLUMN IF NOT EXISTS search_text TEXT NOT NULL DEFAULT '';
+
+-- LIKE '%語%' をインデックスで絞り込めるようにする
+CREATE INDEX IF NOT EXISTS ix_posts_search_text_trgm
+ON posts USING gin (search_text gin_trgm_ops);
+
+-- 既存の投稿の search_text は Python 側の正規化が必要なため、適用後に
+--   flask rebuild-search-index
+-- を実行して埋める
@@ -0,0 +1,19 @@
+-- 広告投稿の時間別・日別の集計テーブルを作成
+-- 実行日: 2026-10-17
+-- 地図クリック・クーポン発行・いいねの書き込み時に加算される（analytics.py）
+
+CREATE TABLE IF NOT EXISTS ad_stats_rollups (
+    post_id INTEGER NOT NULL REFERENCES posts(id) ON DELETE CASCADE,
+    granularity VARCHAR(8) NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    map_clicks INTEGER NOT NULL DEFAULT 0,
+    coupon_issues INTEGER NOT NULL DEFAULT 0,
+    likes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (post_id, granularity, bucket_start)
+);
+
+-- 期間指定の一覧表示用
+CREATE INDEX IF NOT EXISTS ix_ad_stats_rollups_granularity_bucket
+ON ad_stats_rollups (granularity, bucket_start);
+
+-- 作成後に flask rebuild-ad-stats で既存のイベントから集計を作る
@@ -0,0 +1,11 @@
+-- ランキングの事前集計テーブルを作成
+-- 実行日: 2026-10-17
+
+CREATE TABLE IF NOT EXISTS ranking_snapshots (
+    scope VARCHAR(120) PRIMARY KEY,
+    entries JSON NOT NULL DEFAULT '[]',
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- 作成後に flask rebuild-rankings で全ランキングを作成する
+-- （未作成のランキングは初回表示時にも作られる）
@@ -0,0 +1,18 @@
+-- 画像のアップロード・削除をバックグラウンドで行うジョブテーブル
+-- 実行日: 2026-10-17
+-- 成功したジョブは削除される。failed のものは flask retry-storage-jobs で再実行できる
+
+CREATE TABLE IF NOT EXISTS storage_jobs (
+    id SERIAL PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL,
+    payload JSON NOT NULL,
+    data BYTEA,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    run_after TIMESTAMP NOT NULL DEFAULT NOW(),
+    locked_at TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS ix_storage_jobs_status ON storage_jobs (status);
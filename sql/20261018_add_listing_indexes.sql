@@ -0,0 +1,25 @@
+-- 一覧・検索・ランキングのクエリ用のインデックスを追加
+-- 実行日: 2026-10-18
+-- flask db-migrate で適用する（CONCURRENTLY を含むので1文ずつ自動コミットで実行される）
+-- B-treeは逆順にも読めるので、ORDER BY ... DESC の一覧にも昇順のインデックスが使われる
+
+-- ホームのフィード（created_at, id のキーセットページネーション）・検索のキーワードなし
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_created_at_id
+ON posts (created_at, id);
+
+-- 高校での絞り込み（検索・高校別ランキング・高校の使用頻度）
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_school_created_at_id
+ON posts (school, created_at, id);
+
+-- 投稿者の一覧（アカウント・広告一覧）と users 削除時の外部キー
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_user_id_created_at_id
+ON posts (user_id, created_at, id);
+
+-- 総合ランキングの全件再計算（like_count, created_at, id の降順）
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_like_count_created_at_id
+ON posts (like_count, created_at, id);
+
+-- いいね済みの判定（user_id = ? AND post_id IN (...)）と users 削除時の外部キー
+-- post_id での検索は既存の一意制約 (post_id, user_id) が使われる
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_likes_user_id
+ON likes (user_id);
@@ -0,0 +1,13 @@
+-- CSVエクスポート（created_at の新しい順）用のインデックスを追加
+-- 実行日: 2026-10-19
+-- flask db-migrate で適用する（CONCURRENTLY を含むので1文ずつ自動コミットで実行される）
+-- 地図クリック・いいねはバッファからまとめて書き込むため、id の順は発生順（created_at）と一致しない
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_map_clicks_created_at_id
+ON map_clicks (created_at, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_coupon_events_created_at_id
+ON coupon_events (created_at, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_likes_created_at_id
+ON likes (created_at, id);
@@ -68,6 +68,9 @@ document.addEventListener('DOMContentLoaded', function() {
     // 8. 画像プレビュー初期化
     initializeImagePreview();
 
+    // 9. フィードの無限スクロール
+    initializeInfiniteScroll();
+
     // === 関数定義 ===
     
     // スムーズアニメーション初期化
@@ -137,7 +140,8 @@ document.addEventListener('DOMContentLoaded', function() {
                     'Content-Type': 'application/x-www-form-urlencoded',
                     'X-CSRFToken': csrfToken
                 },
-                body: `csrf_token=${encodeURIComponent(csrfToken)}`,
+                // 押した後の状態（サーバーの書き込み遅延モードで使う）
+                body: `csrf_token=${encodeURIComponent(csrfToken)}&liked=${button.classList.contains('liked') ? 1 : 0}`,
                 credentials: 'same-origin'
             })
             .then(response => response.json())
@@ -156,6 +160,80 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
+    // 無限スクロール（ホームのフィード・検索結果）
+    function initializeInfiniteScroll() {
+        const sentinel = document.getElementById('feedSentinel');
+        const container = document.querySelector('.posts-container');
+        if (!sentinel || !container || !('IntersectionObserver' in window)) return;
+
+        let nextCursor = sentinel.getAttribute('data-next-cursor');
+        // 続きを返すJSONのURLと、JSが失敗したとき用のページURL（検索条件のクエリ文字列を含む）
+        const feedUrl = sentinel.getAttribute('data-feed-url') || '/feed';
+        const pageUrl = sentinel.getAttribute('data-page-url') || '/';
+
+        function withCursor(url, cursor) {
+            const separator = url.includes('?') ? '&' : '?';
+            return `${url}${separator}cursor=${encodeURIComponent(cursor)}`;
+        }
+        let isLoading = false;
+
+        // JSが有効な場合は「もっと見る」リンクの代わりに読み込み表示
+        sentinel.innerHTML = '<span class="feed-loading">読み込み中...</span>';
+        sentinel.style.visibility = 'hidden';
+
+        const observer = new IntersectionObserver((entries) => {
+            if (entries.some(entry => entry.isIntersecting)) {
+                loadNextPage();
+            }
+        }, {
+            rootMargin: '0px 0px 600px 0px'
+        });
+
+        function finish() {
+            observer.disconnect();
+            sentinel.remove();
+        }
+
+        function loadNextPage() {
+            if (isLoading || !nextCursor) return;
+            isLoading = true;
+            sentinel.style.visibility = 'visible';
+
+            fetch(withCursor(feedUrl, nextCursor), {
+                headers: { 'X-Requested-With': 'XMLHttpRequest' },
+                credentials: 'same-origin'
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (data.status !== 'ok') {
+                    throw new Error(data.message || 'feed error');
+                }
+                container.insertAdjacentHTML('beforeend', data.html);
+                container.querySelectorAll('.post-card').forEach(card => {
+                    card.style.cursor = 'pointer';
+                });
+                nextCursor = data.next_cursor;
+                if (!nextCursor) {
+                    finish();
+                }
+            })
+            .catch(error => {
+                console.error('フィード読み込みエラー:', error);
+                // 失敗時はリンクで続きを読めるようにして終了
+                observer.disconnect();
+                sentinel.innerHTML = `<a href="${withCursor(pageUrl, nextCursor)}" class="feed-more-link">もっと見る</a>`;
+            })
+            .finally(() => {
+                isLoading = false;
+                if (sentinel.isConnected && nextCursor) {
+                    sentinel.style.visibility = 'hidden';
+                }
+            });
+        }
+
+        observer.observe(sentinel);
+    }
+
     // 画像プレビュー機能
     function initializeImagePreview() {
         const imageInput = document.querySelector('input[type="file"][name="image"]');
@@ -485,7 +563,8 @@ document.addEventListener('DOMContentLoaded', function() {
 
         // 画像
         if (image && modalImage) {
-            modalImage.src = image.src;
+            // サイズ別画像がある投稿は詳細用（medium）を表示
+            modalImage.src = image.dataset.fullSrc || image.currentSrc || image.src;
             modalImage.alt = image.alt;
             modalImage.style.display = 'block';
         } else if (modalImage) {
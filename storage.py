@@ -0,0 +1,166 @@
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlparse, unquote
+from supabase import create_client
+from metrics import STORAGE_UPLOAD_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# 画像を保存するバケット
+STORAGE_BUCKET = "uploads"
+
+
+class StorageError(Exception):
+    """ストレージ操作の失敗（ジョブ側で再試行する）"""
+
+
+def extract_storage_filename(image_path):
+    """画像URL（またはパス）からStorage上のファイル名を取り出す"""
+    if not image_path:
+        return None
+
+    filename = None
+
+    # URLパースしてクエリパラメータを除去
+    parsed_url = urlparse(image_path)
+    clean_url = parsed_url.scheme + "://" + parsed_url.netloc + parsed_url.path
+
+    # 1. Supabase公開URLの場合
+    if "supabase.co" in clean_url and "/object/public/uploads/" in clean_url:
+        # 例: https://xxx.supabase.co/storage/v1/object/public/uploads/filename.jpg
+        parts = clean_url.split("/object/public/uploads/")
+        if len(parts) > 1:
+            filename = parts[1]
+    # 2. /uploads/が含まれる場合（従来の方法）
+    elif "/uploads/" in clean_url:
+        filename = clean_url.split("/uploads/")[-1]
+    # 3. 単純なファイル名の場合
+    else:
+        # パス部分からファイル名を抽出
+        path_parts = parsed_url.path.split('/')
+        if path_parts:
+            filename = path_parts[-1]
+
+    # ファイル名のクリーンアップ（追加の安全対策）
+    if filename:
+        # URLデコード（日本語ファイル名対応）
+        filename = unquote(filename)
+        # 不要な文字を除去
+        filename = filename.strip('?&')
+
+    return filename or None
+
+
+# --- Supabase Storage ---
+class SupabaseStorage:
+    """Supabase Storage（本番）"""
+
+    def __init__(self, url, key, bucket=STORAGE_BUCKET):
+        self.url = url
+        self.key = key
+        self.bucket = bucket
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _bucket(self):
+        with self._lock:
+            if self._client is None:
+                self._client = create_client(self.url, self.key)
+        return self._client.storage.from_(self.bucket)
+
+    def public_url(self, key):
+        # URLの組み立てのみ（通信は発生しない）
+        return self._bucket().get_public_url(key)
+
+    def upload(self, key, data, content_type):
+        """アップロードして公開URLを返す。再試行時に同じキーへ上書きできるよう upsert する"""
+        logger.debug(f"Uploading {key} ({len(data)} bytes, {content_type})")
+        started = time.perf_counter()
+        try:
+            result = self._bucket().upload(
+                path=key,
+                file=data,
+                file_options={"content-type": content_type, "x-upsert": "true"}
+            )
+        except Exception as e:
+            STORAGE_UPLOAD_SECONDS.labels("supabase", "error").observe(time.perf_counter() - started)
+            raise StorageError(f"Supabase upload error: {e}") from e
+
+        ok = hasattr(result, 'status_code') and result.status_code == 200
+        STORAGE_UPLOAD_SECONDS.labels("supabase", "ok" if ok else "error").observe(time.perf_counter() - started)
+        if not ok:
+            raise StorageError(f"アップロードエラー: {result}")
+        return self.public_url(key)
+
+    def remove(self, keys):
+        """複数のファイルを1回のリクエストで削除（存在しないファイルは無視）"""
+        if not keys:
+            return
+        try:
+            result = self._bucket().remove(list(keys))
+        except Exception as e:
+            raise StorageError(f"Supabase delete error: {e}") from e
+        logger.debug(f"Supabase delete result: {result}")
+
+        if isinstance(result, dict) and result.get('error'):
+            raise StorageError(f"Supabase delete error: {result['error']}")
+        if isinstance(result, list):
+            errors = [r['error'] for r in result if isinstance(r, dict) and r.get('error')]
+            if errors:
+                raise StorageError(f"Supabase delete error: {errors}")
+
+
+# --- ローカル保存（開発・検証用） ---
+class LocalStorage:
+    """ローカルディレクトリに保存するストレージ（STORAGE_BACKEND=local）"""
+
+    def __init__(self, root, base_url="/static/uploads/"):
+        self.root = root
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        # キーにディレクトリ区切りを含めさせない
+        return os.path.join(self.root, os.path.basename(key))
+
+    def public_url(self, key):
+        return f"{self.base_url}{key}"
+
+    def upload(self, key, data, content_type):
+        with open(self._path(key), "wb") as f:
+            f.write(data)
+        return self.public_url(key)
+
+    def remove(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage():
+    """設定（STORAGE_BACKEND）に応じたストレージを返す"""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            backend = os.environ.get("STORAGE_BACKEND", "supabase").lower()
+            if backend == "local":
+                _storage = LocalStorage(
+                    os.environ.get("LOCAL_STORAGE_DIR", os.path.join(os.path.dirname(__file__), "static", "uploads")),
+                    os.environ.get("LOCAL_STORAGE_URL", "/static/uploads/"),
+                )
+            else:
+                _storage = SupabaseStorage(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_ANON_KEY"))
+        return _storage
+
+def set_storage(storage):
+    """ストレージを差し替える（検証スクリプト用）"""
+    global _storage
+    with _storage_lock:
+        _storage = storage
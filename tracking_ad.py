@@ -1,8 +1,15 @@
-from flask import Blueprint, render_template, redirect, url_for, current_app, abort, session, Response, request
+from flask import Blueprint, render_template, redirect, url_for, current_app, abort, session, Response, request, g, stream_with_context
 from urllib.parse import quote, urlparse
 import io, csv, hmac, hashlib
-from datetime import datetime
-from models import db, Post, User, Like
+from collections import namedtuple
+from datetime import datetime, timezone, timedelta
+from models import db, Post, Like, dialect_insert
+import rankings
+import analytics
+from cache import invalidate_post_caches, post_info_cache
+from accounts import ensure_user
+from events import EventBuffer
+from metrics import AD_EVENTS
 
 tracking_ad_bp = Blueprint("tracking_ad", __name__, template_folder="templates")
 
@@ -13,6 +20,12 @@ class MapClick(db.Model):
     post_id = db.Column(db.Integer, db.ForeignKey("posts.id", ondelete="CASCADE"), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
+    # CSVエクスポート（created_at の新しい順）をソートなしで流す
+    __table_args__ = (db.Index("ix_map_clicks_created_at_id", "created_at", "id"),)
+
+# 地図クリックはバッファにためてまとめて書き込む（app.py で init_app）
+map_click_buffer = EventBuffer(MapClick.__table__, "map_clicks", on_flush=analytics.on_map_clicks_recorded)
+
 class CouponEvent(db.Model):
     __tablename__ = "coupon_events"
     id = db.Column(db.Integer, primary_key=True)
@@ -21,6 +34,12 @@ class CouponEvent(db.Model):
     code = db.Column(db.String(32), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
+    # クーポンは1ユーザー1投稿につき1回（同時に開いても重複しない）
+    __table_args__ = (
+        db.UniqueConstraint("post_id", "user_id", name="uq_coupon_events_post_user"),
+        db.Index("ix_coupon_events_created_at_id", "created_at", "id"),
+    )
+
 # --- 権限ヘルパ ---
 def is_admin() -> bool:
     return bool(session.get("is_admin"))
@@ -40,9 +59,25 @@ def is_ad_post(post: "Post") -> bool:
     adv_id = current_app.config.get("ADVERTISER_USER_ID", 1)
     return (post.user_id == adv_id) or bool(post.google_maps_url)
 
-def has_used_coupon(post_id: int, user_id: int) -> bool:
-    # ユーザーが指定の投稿のクーポンを既に使用しているかチェック
-    return CouponEvent.query.filter_by(post_id=post_id, user_id=user_id).first() is not None
+def issue_coupon(post_id: int, user_id: int, code: str, issued_at: datetime) -> bool:
+    # クーポン発行を1文で記録（INSERT ... ON CONFLICT DO NOTHING RETURNING）
+    # 既に発行済み（同時リクエストで先を越された場合を含む）なら False
+    stmt = dialect_insert(CouponEvent.__table__) \
+        .values(post_id=post_id, user_id=user_id, code=code, created_at=issued_at) \
+        .on_conflict_do_nothing(index_elements=["post_id", "user_id"]) \
+        .returning(CouponEvent.id)
+    return db.session.execute(stmt).scalar() is not None
+
+def used_coupon_post_ids() -> frozenset:
+    # 現在のユーザーが使用済みのクーポン投稿IDを1クエリで取得（リクエスト内でメモ化）
+    if "used_coupon_post_ids" not in g:
+        user_id = current_user_id()
+        if user_id:
+            rows = db.session.query(CouponEvent.post_id).filter(CouponEvent.user_id == user_id).all()
+            g.used_coupon_post_ids = frozenset(r.post_id for r in rows)
+        else:
+            g.used_coupon_post_ids = frozenset()
+    return g.used_coupon_post_ids
 
 # --- 補助 ---
 def _coupon_code(post: "Post") -> str:
@@ -65,6 +100,31 @@ def _maps_url(post: "Post") -> str:
     q = f"{post.store_name} {post.area or ''}".strip()
     return f"https://www.google.com/maps/search/?api=1&query={quote(q)}"
 
+# 広告判定・遷移先の地図URL・クーポンコード
+AdInfo = namedtuple("AdInfo", ["is_ad", "maps_url", "coupon_code"])
+
+# ad_info の計算に必要な列（caption などは読まない）
+AD_INFO_COLUMNS = (Post.id, Post.user_id, Post.google_maps_url, Post.store_name, Post.area)
+
+def _compute_ad_info(post) -> AdInfo:
+    return AdInfo(is_ad_post(post), _maps_url(post), _coupon_code(post))
+
+def ad_info(post: "Post") -> AdInfo:
+    # 投稿ごとに一度だけ計算してメモ化（HMAC・URL解析をリクエストごとにしない）
+    # 編集・削除時は invalidate_post_caches(post_id) で消える（他のワーカーでは POST_INFO_CACHE_TTL 秒以内に反映）
+    return post_info_cache.get_or_set(post.id, lambda: _compute_ad_info(post))
+
+def ad_info_for_id(post_id: int):
+    # 投稿IDから ad_info を返す（投稿が無ければ None）。キャッシュに無い場合も必要な列だけ読む
+    info = post_info_cache.get(post_id)
+    if info is None:
+        row = db.session.query(*AD_INFO_COLUMNS).filter(Post.id == post_id).first()
+        if row is None:
+            return None
+        info = _compute_ad_info(row)
+        post_info_cache.set(post_id, info)
+    return info
+
 def admin_required():
     if not has_export_rights():
         abort(403)
@@ -72,45 +132,55 @@ def admin_required():
 # --- ルート（広告投稿のみ計測） ---
 @tracking_ad_bp.route("/go/<int:post_id>")
 def go(post_id: int):
-    post = Post.query.get_or_404(post_id)
+    # 投稿全体（caption など）は読まず、キャッシュ済みの広告情報だけでリダイレクトする
+    info = ad_info_for_id(post_id)
+    if info is None:
+        abort(404)
     
-    if is_ad_post(post):
+    if info.is_ad:
         try:
-            db.session.add(MapClick(post_id=post.id))
-            db.session.commit()
+            # DBへの書き込みはバックグラウンドでまとめて行うので、リダイレクトを待たせない
+            map_click_buffer.record(post_id=post_id)
+            AD_EVENTS.labels("map_click").inc()
         except Exception as e:
             # テーブルが存在しない場合もリダイレクトは継続
-            print(f"MapClick tracking error: {e}")
+            current_app.logger.warning(f"MapClick tracking error: {e}")
             db.session.rollback()
     
-    return redirect(_maps_url(post), code=302)
+    return redirect(info.maps_url, code=302)
 
 @tracking_ad_bp.route("/coupon/<int:post_id>")
 def coupon(post_id: int):
     post = Post.query.get_or_404(post_id)
-    if not is_ad_post(post):
+    info = ad_info(post)
+    if not info.is_ad:
         abort(404)
     
-    user_id = current_user_id()
-    if not user_id:
-        abort(403)  # ログインが必要
+    # 初めての書き込みであればここでユーザーを作成（ボット等は作成されない）
+    user = ensure_user()
+    if not user:
+        abort(403)
+    user_id = user.id
     
     # 広告アカウント(ID=1)の場合は制限なし・カウントなし
     if is_advertiser_account():
-        code = _coupon_code(post)
+        code = info.coupon_code
         return render_template("coupon.html", post=post, code=code)
     
-    # 一般ユーザーの場合は使用回数制限
-    if has_used_coupon(post_id, user_id):
-        return render_template("coupon_used.html", post=post)
-    
-    code = _coupon_code(post)
+    # 一般ユーザーの場合は1回だけ（発行済みかの確認と記録を1文で行う）
+    code = info.coupon_code
     try:
-        db.session.add(CouponEvent(post_id=post.id, user_id=user_id, code=code))
+        issued_at = datetime.utcnow()
+        if not issue_coupon(post.id, user_id, code, issued_at):
+            db.session.rollback()
+            AD_EVENTS.labels("coupon_repeat").inc()
+            return render_template("coupon_used.html", post=post)
+        analytics.on_coupon_issued(post.id, issued_at)
         db.session.commit()
+        AD_EVENTS.labels("coupon_issued").inc()
     except Exception as e:
         # テーブルが存在しない場合もクーポンは表示
-        print(f"CouponEvent tracking error: {e}")
+        current_app.logger.warning(f"CouponEvent tracking error: {e}")
         db.session.rollback()
     return render_template("coupon.html", post=post, code=code)
 
@@ -126,6 +196,7 @@ def admin_edit_post(post_id: int):
     admin_required()
     post = Post.query.get_or_404(post_id)
     if request.method == "POST":
+        old_school = post.school
         for field in ["store_name","area","caption","price_range","school"]:
             if field in request.form:
                 setattr(post, field, request.form[field])
@@ -136,26 +207,84 @@ def admin_edit_post(post_id: int):
                 post.google_maps_url = gmaps[:300]
         else:
             post.google_maps_url = None
+        rankings.on_post_school_changed(post, old_school)
         db.session.commit()
+        invalidate_post_caches(post.id)
+        # 編集後の広告情報をここで計算しておく
+        ad_info(post)
         return redirect(url_for("tracking_ad.admin_posts"))
     return render_template("admin_edit_post.html", post=post)
 
 # --- 管理：CSV（管理者 or 広告ID=1） ---
+# 全件を読み込まずサーバーサイドカーソルで少しずつ取得し、CSVを分割して送る
+EXPORT_YIELD_PER = 1000
+EXPORT_CHUNK_ROWS = 1000
+
+JST = timezone(timedelta(hours=9))
+
+def _jst_date(dt: datetime) -> str:
+    # JST変換（YYYY-MM-DD形式）
+    return dt.replace(tzinfo=timezone.utc).astimezone(JST).strftime('%Y-%m-%d')
+
+def _parse_export_date(name: str):
+    # ?from= / ?to= はJSTの日付（YYYY-MM-DD）。DBのUTC（naive）に変換する
+    value = (request.args.get(name) or "").strip()
+    if not value:
+        return None
+    try:
+        day = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=JST)
+    except ValueError:
+        abort(400, description=f"{name} は YYYY-MM-DD 形式で指定してください")
+    if name == "to":
+        day += timedelta(days=1)
+    return day.astimezone(timezone.utc).replace(tzinfo=None)
+
+def _apply_export_filters(query, created_at_column, post_id_column):
+    # 任意の絞り込み: ?from=YYYY-MM-DD&to=YYYY-MM-DD（両端を含む）&post_id=N
+    date_from = _parse_export_date("from")
+    date_to = _parse_export_date("to")
+    post_id = request.args.get("post_id", type=int)
+    if date_from:
+        query = query.filter(created_at_column >= date_from)
+    if date_to:
+        query = query.filter(created_at_column < date_to)
+    if post_id:
+        query = query.filter(post_id_column == post_id)
+    return query
+
+def _csv_response(filename: str, header: list, rows) -> Response:
+    """行のイテレータをCSV（UTF-8 BOM付き）としてストリーミングで返す"""
+    def generate():
+        buf = io.StringIO(); w = csv.writer(buf)
+        # Excelで文字化けしないよう先頭にBOM
+        buf.write("\ufeff")
+        w.writerow(header)
+        # 最初の行の取得（大きな表のクエリ）を待たずにダウンロードを始める
+        yield buf.getvalue()
+        buf.seek(0); buf.truncate()
+        for i, row in enumerate(rows, 1):
+            w.writerow(row)
+            if i % EXPORT_CHUNK_ROWS == 0:
+                yield buf.getvalue()
+                buf.seek(0); buf.truncate()
+        yield buf.getvalue()
+    return Response(stream_with_context(generate()),
+                    mimetype="text/csv",
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
 @tracking_ad_bp.route("/admin/export/map_clicks.csv")
 def export_map_clicks():
     admin_required()
     q = (
         db.session.query(MapClick.id, MapClick.created_at, MapClick.post_id, Post.store_name, Post.area)
         .join(Post, Post.id==MapClick.post_id)
-        .order_by(MapClick.created_at.desc())
-    ).all()
-    buf = io.StringIO(); w = csv.writer(buf)
-    w.writerow(["id","created_at","post_id","store_name","area"])
-    for r in q:
-        w.writerow([r.id, r.created_at.isoformat(), r.post_id, r.store_name, r.area or ""])
-    return Response(buf.getvalue().encode("utf-8-sig"),
-                    mimetype="text/csv",
-                    headers={"Content-Disposition":'attachment; filename="map_clicks.csv"'})
+    )
+    # クリックの発生順（id はバッファの書き込み順なので使わない）。(created_at, id) のインデックスでソートなしで流す
+    q = _apply_export_filters(q, MapClick.created_at, MapClick.post_id) \
+        .order_by(MapClick.created_at.desc(), MapClick.id.desc()) \
+        .yield_per(EXPORT_YIELD_PER)
+    rows = ([r.id, r.created_at.isoformat(), r.post_id, r.store_name, r.area or ""] for r in q)
+    return _csv_response("map_clicks.csv", ["id","created_at","post_id","store_name","area"], rows)
 
 @tracking_ad_bp.route("/admin/export/coupon_events.csv")
 def export_coupon_events():
@@ -163,99 +292,94 @@ def export_coupon_events():
     q = (
         db.session.query(CouponEvent.id, CouponEvent.created_at, CouponEvent.post_id, CouponEvent.code, Post.store_name, Post.area)
         .join(Post, Post.id==CouponEvent.post_id)
-        .order_by(CouponEvent.created_at.desc())
-    ).all()
-    buf = io.StringIO(); w = csv.writer(buf)
-    w.writerow(["id","created_at","post_id","code","store_name","area"])
-    for r in q:
-        w.writerow([r.id, r.created_at.isoformat(), r.post_id, r.code, r.store_name, r.area or ""])
-    return Response(buf.getvalue().encode("utf-8-sig"),
-                    mimetype="text/csv",
-                    headers={"Content-Disposition":'attachment; filename="coupon_events.csv"'})
+    )
+    q = _apply_export_filters(q, CouponEvent.created_at, CouponEvent.post_id) \
+        .order_by(CouponEvent.created_at.desc(), CouponEvent.id.desc()) \
+        .yield_per(EXPORT_YIELD_PER)
+    rows = ([r.id, r.created_at.isoformat(), r.post_id, r.code, r.store_name, r.area or ""] for r in q)
+    return _csv_response("coupon_events.csv", ["id","created_at","post_id","code","store_name","area"], rows)
 
 @tracking_ad_bp.route("/admin/export/posts.csv")
 def export_posts():
     admin_required()
-    from datetime import timezone, timedelta
-    
-    # JST タイムゾーンを定義
-    JST = timezone(timedelta(hours=9))
-    
     # 投稿データとライク数を取得
-    q = (
-        db.session.query(
-            Post.id,
-            Post.created_at,
-            Post.area,
-            Post.price_range,
-            Post.school,
-            Post.user_id,
-            Post.google_maps_url,
-            db.func.count(db.distinct(Like.id)).label('like_count')
-        )
-        .outerjoin(Like, Post.id == Like.post_id)
-        .group_by(Post.id, Post.created_at, Post.area, Post.price_range, Post.school, Post.user_id, Post.google_maps_url)
-        .order_by(Post.created_at.desc())
-    ).all()
-    
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(["post_id", "created_at", "area", "price_band", "school", "is_ad", "like_count"])
-    
+    q = db.session.query(
+        Post.id,
+        Post.created_at,
+        Post.area,
+        Post.price_range,
+        Post.school,
+        Post.user_id,
+        Post.google_maps_url,
+        Post.like_count
+    )
+    q = _apply_export_filters(q, Post.created_at, Post.id) \
+        .order_by(Post.created_at.desc()) \
+        .yield_per(EXPORT_YIELD_PER)
+
     # 広告アカウントIDを取得
     adv_id = current_app.config.get("ADVERTISER_USER_ID", 1)
-    
-    for r in q:
-        # JST変換（YYYY-MM-DD形式）
-        jst_date = r.created_at.replace(tzinfo=timezone.utc).astimezone(JST).strftime('%Y-%m-%d')
-        
-        # is_ad判定（投稿者ID=1 または MapsURLあり）
-        is_ad = (r.user_id == adv_id) or bool(r.google_maps_url)
-        
-        # schoolが空の場合は空文字
-        school = r.school or ""
-        
-        w.writerow([
-            r.id,
-            jst_date,
-            r.area or "",
-            r.price_range or "",
-            school,
-            str(is_ad).lower(),  # true/false
-            r.like_count
-        ])
-    
-    return Response(buf.getvalue().encode("utf-8-sig"),
-                    mimetype="text/csv",
-                    headers={"Content-Disposition": 'attachment; filename="posts.csv"'})
+
+    def rows():
+        for r in q:
+            # is_ad判定（投稿者ID=1 または MapsURLあり）
+            is_ad = (r.user_id == adv_id) or bool(r.google_maps_url)
+            yield [
+                r.id,
+                _jst_date(r.created_at),
+                r.area or "",
+                r.price_range or "",
+                r.school or "",
+                str(is_ad).lower(),  # true/false
+                r.like_count
+            ]
+
+    return _csv_response("posts.csv", ["post_id", "created_at", "area", "price_band", "school", "is_ad", "like_count"], rows())
 
 @tracking_ad_bp.route("/admin/export/likes.csv")
 def export_likes():
     admin_required()
-    from datetime import timezone, timedelta
-    
-    # JST タイムゾーンを定義
-    JST = timezone(timedelta(hours=9))
-    
     # ライクデータを取得（個人識別子は除外）
-    q = (
-        db.session.query(Like.post_id, Like.created_at)
-        .order_by(Like.created_at.desc())
-    ).all()
-    
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(["post_id", "created_at"])
-    
-    for r in q:
-        # JST変換（YYYY-MM-DD形式）
-        jst_date = r.created_at.replace(tzinfo=timezone.utc).astimezone(JST).strftime('%Y-%m-%d')
-        
-        w.writerow([r.post_id, jst_date])
-    
-    return Response(buf.getvalue().encode("utf-8-sig"),
-                    mimetype="text/csv",
-                    headers={"Content-Disposition": 'attachment; filename="likes.csv"'})
+    q = db.session.query(Like.post_id, Like.created_at)
+    q = _apply_export_filters(q, Like.created_at, Like.post_id) \
+        .order_by(Like.created_at.desc(), Like.id.desc()) \
+        .yield_per(EXPORT_YIELD_PER)
+    rows = ([r.post_id, _jst_date(r.created_at)] for r in q)
+    return _csv_response("likes.csv", ["post_id", "created_at"], rows)
+
+# --- 管理：広告の集計（集計テーブル analytics.AdStatsRollup のみを読む） ---
+# 期間の指定が無いときの表示範囲
+AD_STATS_DEFAULT_RANGE = {analytics.DAY: timedelta(days=30), analytics.HOUR: timedelta(hours=48)}
+
+def _ad_stats():
+    granularity = request.args.get("granularity", analytics.DAY)
+    if granularity not in analytics.GRANULARITIES:
+        abort(400, description="granularity は day / hour のいずれかです")
+    end = _parse_export_date("to") or analytics.bucket_start(granularity, datetime.utcnow()) + (
+        timedelta(hours=1) if granularity == analytics.HOUR else timedelta(days=1))
+    start = _parse_export_date("from") or end - AD_STATS_DEFAULT_RANGE[granularity]
+    stats = analytics.get_ad_stats(granularity, start, end, post_id=request.args.get("post_id", type=int))
+    # 表示はJST
+    for item in stats:
+        for point in item["series"]:
+            point["bucket_start"] = point["bucket_start"].replace(tzinfo=timezone.utc).astimezone(JST)
+    return granularity, start.replace(tzinfo=timezone.utc).astimezone(JST), end.replace(tzinfo=timezone.utc).astimezone(JST), stats
+
+@tracking_ad_bp.route("/admin/ad_stats")
+def ad_stats():
+    admin_required()
+    granularity, start, end, stats = _ad_stats()
+    return render_template("ad_stats.html", granularity=granularity, start=start, end=end, stats=stats,
+                           post_id=request.args.get("post_id", type=int))
+
+@tracking_ad_bp.route("/admin/ad_stats.json")
+def ad_stats_json():
+    admin_required()
+    granularity, start, end, stats = _ad_stats()
+    for item in stats:
+        for point in item["series"]:
+            point["bucket_start"] = point["bucket_start"].isoformat()
+    return {"granularity": granularity, "from": start.isoformat(), "to": end.isoformat(), "posts": stats}
 
 # --- データリセット ---
 @tracking_ad_bp.route("/admin/reset_coupon_data", methods=["POST"])